@@ -0,0 +1,87 @@
+"""
+Per-frame cost of evaluating skinning matrices for hundreds of animated
+characters on a procedural 64 joint skeleton. Runs without a window or
+OpenGL context.
+
+  python benchmarks/animation.py
+"""
+
+import os
+import sys
+import time
+import numpy
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from engine.animation import Skeleton, AnimationClip, PoseCache
+
+
+JOINTS = 64
+INSTANCES = 500
+PHASES = 16
+FRAMES = 100
+
+
+def random_quaternions(rng, shape, angle):
+    axis = rng.normal(size=shape + (3,))
+    axis /= numpy.linalg.norm(axis, axis=-1, keepdims=True)
+    theta = rng.uniform(-angle, angle, size=shape + (1,))
+    return numpy.concatenate((axis * numpy.sin(theta / 2), numpy.cos(theta / 2)), axis=-1)
+
+
+rng = numpy.random.default_rng(0)
+
+# A spine of 16 joints with four limbs of 12 joints hanging off it
+parents = [-1] + list(range(15))
+for limb in range(4):
+    start = len(parents)
+    parents += [4 * limb + 2] + list(range(start, start + 11))
+
+translations = numpy.tile([0.0, 0.2, 0.0], (JOINTS, 1))
+rotations = numpy.tile([0.0, 0.0, 0.0, 1.0], (JOINTS, 1))
+scales = numpy.ones((JOINTS, 3))
+
+skeleton = Skeleton([f"joint{i}" for i in range(JOINTS)], parents, translations, rotations, scales,
+                    numpy.tile(numpy.identity(4), (JOINTS, 1, 1)))
+
+# Two second clip baked at 30 frames per second
+frames = 61
+clip = AnimationClip(
+    "procedural", 30.0,
+    numpy.tile(translations, (frames, 1, 1)),
+    random_quaternions(rng, (frames, JOINTS), 0.5),
+    numpy.tile(scales, (frames, 1, 1)))
+
+# Characters are spread over a few phases of the clip, like crowds usually are
+phases = rng.integers(0, PHASES, INSTANCES) * (clip.duration / PHASES)
+
+
+def per_instance(t):
+    for phase in phases:
+        translations, rotations, scales, _ = clip.sample(numpy.array([t + phase]))
+        skeleton.skinning_matrices(translations, rotations, scales)
+
+
+def vectorized(t):
+    translations, rotations, scales, _ = clip.sample(phases + t)
+    skeleton.skinning_matrices(translations, rotations, scales)
+
+
+cache = PoseCache()
+def cached(t):
+    cache.evaluate(skeleton, clip, phases + t)
+
+
+print(f"{JOINTS} joints, {INSTANCES} instances, {PHASES} distinct phases")
+
+for name, evaluate in (("per instance", per_instance), ("vectorized", vectorized), ("pose cache", cached)):
+    runs = 5 if evaluate is per_instance else FRAMES
+
+    start = time.perf_counter()
+    for frame in range(runs):
+        evaluate(frame / 60)
+    elapsed = (time.perf_counter() - start) / runs
+
+    print(f"  {name:<13} {elapsed*1000:8.2f} ms/frame")
+
+print(f"  pose cache hits {cache.hits}, misses {cache.misses}")
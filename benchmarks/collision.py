@@ -0,0 +1,58 @@
+"""
+Per-step cost of moving the player capsule through a scene with thousands of
+triangles. Runs without a window or OpenGL context.
+
+  python benchmarks/collision.py
+"""
+
+import os
+import sys
+import time
+import numpy
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+os.chdir(os.path.join(os.path.dirname(__file__), ".."))
+
+from engine.objparser import parse
+from engine.collision import CollisionWorld, Capsule
+
+
+def mesh_triangles(filepath, offset, scale=1.0):
+    vertices = numpy.asarray(parse(filepath).vertices, dtype=numpy.float64).reshape(-1, 3, 3)
+    return vertices * scale + offset
+
+
+world = CollisionWorld()
+
+t = time.perf_counter()
+floor = numpy.array([
+    [[-50, -5, -50], [-50, -5, 50], [50, -5, 50]],
+    [[-50, -5, -50], [50, -5, 50], [50, -5, -50]]
+], dtype=numpy.float64)
+world.add_triangles("floor", floor)
+world.add_triangles("wolf", mesh_triangles("assets/models/wolf.obj", (2, -5, 0)))
+world.add_triangles("sphere", mesh_triangles("assets/models/sphere.obj", (-3, -4, 2)))
+world.add_triangles("bunny", mesh_triangles("assets/models/bunny.obj", (0, -5, 6), scale=20.0))
+build_time = time.perf_counter() - t
+
+triangles = sum(len(bvh) for bvh in world.meshes.values())
+print(f"{triangles} triangles, BVH build {build_time*1000:.1f} ms")
+
+body = Capsule()
+position = numpy.array([-8.0, -2.0, -8.0])
+times = []
+grounded = 0
+
+for frame in range(2000):
+    angle = frame * 0.01
+    delta = numpy.array([numpy.cos(angle) * 0.1, -0.05, numpy.sin(angle * 1.3) * 0.1])
+
+    t = time.perf_counter()
+    position, contact = world.move_capsule(body, position, delta)
+    times.append(time.perf_counter() - t)
+    grounded += contact.ground
+
+times = numpy.array(times) * 1e6
+print(f"move_capsule: mean {times.mean():.0f} us, p50 {numpy.percentile(times, 50):.0f} us, "
+      f"p99 {numpy.percentile(times, 99):.0f} us, max {times.max():.0f} us")
+print(f"grounded {grounded}/{len(times)} frames, final position {position.round(2)}")
@@ -0,0 +1,118 @@
+"""
+Load time of the same meshes as OBJ and as binary glTF. Each OBJ is
+converted to a .glb with an indexed, interleaved vertex buffer under cache/
+first. "parse" reads the file to vertex data and "load" also uploads it.
+Runs headless on an EGL context (or the default standalone context if EGL
+isn't available).
+
+  python benchmarks/gltf.py
+"""
+
+import os
+import sys
+import json
+import struct
+import time
+import numpy
+import moderngl
+
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+import pygame
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+os.chdir(os.path.join(os.path.dirname(__file__), ".."))
+
+from engine.objparser import parse
+from engine.gltf import GLTFFile
+from engine.model import load_obj, load_model
+
+
+MODELS = ("assets/models/wolf.obj", "assets/models/sphere.obj", "assets/models/bunny.obj")
+RUNS = 5
+
+
+def write_glb(obj_filepath: str, filepath: str):
+    """
+    Converts an OBJ to a .glb with one indexed mesh
+    """
+    obj = parse(obj_filepath)
+    vertices = numpy.concatenate((
+        numpy.array(obj.vertices, dtype=numpy.float32).reshape(-1, 3),
+        numpy.array(obj.uv_coords, dtype=numpy.float32).reshape(-1, 2),
+        numpy.array(obj.vertex_normals, dtype=numpy.float32).reshape(-1, 3)
+    ), axis=1)
+
+    vertices, indices = numpy.unique(vertices, axis=0, return_inverse=True)
+    # glTF texture coordinates start at the top of the image
+    vertices[:, 4] = 1 - vertices[:, 4]
+
+    vertex_data = vertices.tobytes()
+    index_data = indices.reshape(-1).astype(numpy.uint32).tobytes()
+    count = len(vertices)
+
+    document = json.dumps({
+        "asset": {"version": "2.0"},
+        "scene": 0,
+        "scenes": [{"nodes": [0]}],
+        "nodes": [{"mesh": 0}],
+        "meshes": [{"primitives": [{"attributes": {"POSITION": 0, "TEXCOORD_0": 1, "NORMAL": 2}, "indices": 3}]}],
+        "accessors": [
+            {"bufferView": 0, "byteOffset": 0, "componentType": 5126, "count": count, "type": "VEC3",
+             "min": vertices[:, :3].min(axis=0).tolist(), "max": vertices[:, :3].max(axis=0).tolist()},
+            {"bufferView": 0, "byteOffset": 12, "componentType": 5126, "count": count, "type": "VEC2"},
+            {"bufferView": 0, "byteOffset": 20, "componentType": 5126, "count": count, "type": "VEC3"},
+            {"bufferView": 1, "componentType": 5125, "count": len(indices), "type": "SCALAR"}
+        ],
+        "bufferViews": [
+            {"buffer": 0, "byteOffset": 0, "byteLength": len(vertex_data), "byteStride": 32},
+            {"buffer": 0, "byteOffset": len(vertex_data), "byteLength": len(index_data)}
+        ],
+        "buffers": [{"byteLength": len(vertex_data) + len(index_data)}]
+    }).encode()
+    document += b" " * (-len(document) % 4)
+
+    binary = vertex_data + index_data
+    with open(filepath, "wb") as f:
+        f.write(struct.pack("<4sII", b"glTF", 2, 28 + len(document) + len(binary)))
+        f.write(struct.pack("<II", len(document), 0x4E4F534A) + document)
+        f.write(struct.pack("<II", len(binary), 0x004E4942) + binary)
+
+
+def timed(function) -> float:
+    start = time.perf_counter()
+    for _ in range(RUNS): function()
+    return (time.perf_counter() - start) / RUNS
+
+
+pygame.init()
+pygame.display.set_mode((64, 64))
+
+try:
+    ctx = moderngl.create_standalone_context(backend="egl")
+except Exception:
+    ctx = moderngl.create_standalone_context()
+
+texture = pygame.Surface((1, 1))
+os.makedirs("cache", exist_ok=True)
+
+for obj_filepath in MODELS:
+    glb_filepath = os.path.join("cache", os.path.basename(obj_filepath).replace(".obj", ".glb"))
+    write_glb(obj_filepath, glb_filepath)
+
+    def load_as_obj():
+        load_obj(ctx, obj_filepath, texture, (0, 0, 0)).dispose()
+        ctx.finish()
+
+    def load_as_glb():
+        load_model(ctx, glb_filepath, texture).dispose()
+        ctx.finish()
+
+    def parse_glb():
+        gltf = GLTFFile(glb_filepath)
+        gltf.primitives(0)
+
+    triangles = len(parse(obj_filepath).vertices) // 9
+    print(f"{obj_filepath}  {triangles} triangles, "
+          f"obj {os.path.getsize(obj_filepath) // 1024} KiB, glb {os.path.getsize(glb_filepath) // 1024} KiB")
+    print(f"  obj  parse {timed(lambda: parse(obj_filepath))*1000:8.2f} ms   load {timed(load_as_obj)*1000:8.2f} ms")
+    print(f"  glb  parse {timed(parse_glb)*1000:8.2f} ms   load {timed(load_as_glb)*1000:8.2f} ms")
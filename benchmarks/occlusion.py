@@ -0,0 +1,114 @@
+"""
+Frame cost with and without occlusion culling in a walled grid of models,
+the kind of indoor layout where most of what's in the frustum is hidden.
+The walls have gaps part of the grid is seen through, the frames drawn with
+and without culling have to match. Runs headless on an EGL context (or the default standalone context if EGL
+isn't available), "total" waits for the GPU to finish.
+
+  python benchmarks/occlusion.py
+"""
+
+import os
+import sys
+import time
+import numpy
+import moderngl
+
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+import pygame
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+os.chdir(os.path.join(os.path.dirname(__file__), ".."))
+
+from engine.model import load_obj, PROGRAMS
+from engine.camera import Camera
+from engine.light import BasicLight
+from engine.occlusion import OcclusionCuller
+
+
+GRID = 30
+FRAMES = 20
+
+
+pygame.init()
+pygame.display.set_mode((64, 64))
+
+try:
+    ctx = moderngl.create_standalone_context(backend="egl")
+except Exception:
+    ctx = moderngl.create_standalone_context()
+
+fbo = ctx.simple_framebuffer((1280, 720))
+fbo.use()
+ctx.enable(moderngl.DEPTH_TEST | moderngl.CULL_FACE)
+
+texture = pygame.Surface((1, 1))
+texture.fill((200, 200, 200))
+
+# Spheres on a grid behind a row of walls in front of the camera, with gaps
+# between the walls
+models = [
+    load_obj(ctx, "assets/models/sphere.obj", texture, (x * 3.0 - GRID * 1.5, 0.0, -10.0 - z * 3.0))
+    for z in range(GRID) for x in range(GRID)
+]
+
+walls = []
+for x in range(-3, 4):
+    wall = load_obj(ctx, "assets/models/cube.obj", texture, (x * 8.0, 0.0, -6.0))
+    wall.scale.x, wall.scale.y, wall.scale.z = 3.4, 6.0, 0.2
+    walls.append(wall)
+
+PROGRAMS["default"]["skybox"].value = 1
+skybox_texture = ctx.texture_cube((1, 1), 3, b"\xff" * 18)
+class Skybox: texture = skybox_texture
+
+camera = Camera(1280 / 720, position=(0.0, 1.0, 0.0))
+light = BasicLight()
+culler = OcclusionCuller((256, 128))
+
+print(f"{len(models)} models, {len(walls)} occluders, {ctx.info['GL_RENDERER']}")
+
+# Model bounds are computed once on first use
+culler.begin(camera)
+culler.cull(models)
+
+frames = {}
+for culling in (False, True):
+    cpu = 0.0
+    start = time.perf_counter()
+    for _ in range(FRAMES):
+        t = time.perf_counter()
+        fbo.clear()
+
+        visible = models
+        if culling:
+            culler.begin(camera)
+            culler.add_occluders(walls)
+            visible = culler.cull(models)
+
+        for model in walls + visible:
+            model.update(camera, light)
+            model.render(Skybox)
+
+        cpu += time.perf_counter() - t
+    ctx.finish()
+    total = time.perf_counter() - start
+    frames[culling] = numpy.frombuffer(fbo.read(components=3), dtype=numpy.uint8).reshape(-1, 3)
+
+    print(f"  culling {'on ' if culling else 'off'}  drawn {len(visible):>4}  "
+          f"cpu {cpu/FRAMES*1000:7.2f} ms/frame  total {total/FRAMES*1000:7.2f} ms/frame")
+
+print(f"  {culler.stats()}")
+
+# Spheres seen through the gaps, compared to the walls drawn alone
+fbo.clear()
+for wall in walls:
+    wall.update(camera, light)
+    wall.render(Skybox)
+walls_only = numpy.frombuffer(fbo.read(components=3), dtype=numpy.uint8).reshape(-1, 3)
+seen = int(numpy.count_nonzero(numpy.any(frames[False] != walls_only, axis=1)))
+
+# Culling is conservative, it must not change a single pixel
+different = int(numpy.count_nonzero(numpy.any(frames[False] != frames[True], axis=1)))
+print(f"  {seen} pixels of models seen through the walls, {different} differ with culling on")
+if seen == 0 or different: sys.exit(1)
@@ -0,0 +1,70 @@
+"""
+Frame cost of GPU particle emitters from ten thousand to one million
+particles. Runs headless on an EGL context (or the default standalone
+context if EGL isn't available). "cpu" is the time spent issuing the frame
+and "total" also waits for the GPU to finish. The Python side is the same
+few calls at any particle count, with a software renderer like llvmpipe the
+driver simulates and rasterizes on the CPU and both columns grow with it.
+
+  python benchmarks/particles.py
+"""
+
+import os
+import sys
+import time
+import moderngl
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+os.chdir(os.path.join(os.path.dirname(__file__), ".."))
+
+from engine.particles import ParticleEmitter
+from engine.camera import Camera
+
+
+COUNTS = (10_000, 100_000, 1_000_000)
+FRAMES = 60
+DT = 1 / 60
+
+
+try:
+    ctx = moderngl.create_standalone_context(backend="egl")
+except Exception:
+    ctx = moderngl.create_standalone_context()
+
+print(ctx.info["GL_RENDERER"])
+
+fbo = ctx.simple_framebuffer((1280, 720))
+fbo.use()
+ctx.enable(moderngl.DEPTH_TEST)
+
+camera = Camera(1280 / 720, position=(0.0, 2.0, 12.0))
+
+for count in COUNTS:
+    # Rate and lifetime keep the emitter full
+    emitter = ParticleEmitter(
+        ctx, count,
+        rate=count / 2.0,
+        lifetime=(2.0, 2.0),
+        speed=(2.0, 6.0),
+        spread=0.8,
+        size=(0.05, 0.01))
+
+    for _ in range(int(2.0 / DT)):
+        emitter.update(DT)
+    ctx.finish()
+
+    cpu = 0.0
+    start = time.perf_counter()
+    for _ in range(FRAMES):
+        t = time.perf_counter()
+        fbo.clear()
+        emitter.update(DT)
+        emitter.render(camera)
+        cpu += time.perf_counter() - t
+    ctx.finish()
+    total = time.perf_counter() - start
+
+    print(f"{count:>9} particles  {emitter.alive():>9} alive  "
+          f"cpu {cpu/FRAMES*1000:6.3f} ms/frame  total {total/FRAMES*1000:7.2f} ms/frame")
+
+    emitter.dispose()
@@ -0,0 +1,104 @@
+"""
+Frame cost of keeping reflection probes current while a model orbits
+between them, capturing every dirty face at once against the default of one
+face per frame. Runs headless on an EGL context (or the default standalone
+context if EGL isn't available), times wait for the GPU to finish.
+
+  python benchmarks/probes.py
+"""
+
+import os
+import sys
+import time
+from math import sin, cos
+import moderngl
+
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+import pygame
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+os.chdir(os.path.join(os.path.dirname(__file__), ".."))
+
+from engine.model import load_obj, load_cubemap, create_skybox
+from engine.camera import Camera
+from engine.light import BasicLight
+from engine.probes import ReflectionProbes
+
+
+GRID = 10
+FRAMES = 60
+
+
+pygame.init()
+pygame.display.set_mode((64, 64))
+
+try:
+    ctx = moderngl.create_standalone_context(backend="egl")
+except Exception:
+    ctx = moderngl.create_standalone_context()
+
+fbo = ctx.simple_framebuffer((1280, 720))
+fbo.use()
+ctx.enable(moderngl.DEPTH_TEST | moderngl.CULL_FACE)
+
+texture = pygame.Surface((1, 1))
+texture.fill((200, 200, 200))
+
+models = [
+    load_obj(ctx, "assets/models/sphere.obj", texture, (x * 3.0 - GRID * 1.5, 0.0, -z * 3.0))
+    for z in range(GRID) for x in range(GRID)
+]
+mover = load_obj(ctx, "assets/models/cube.obj", texture, (0.0, 0.0, -10.0))
+
+skybox = create_skybox(ctx, load_cubemap(ctx, "assets/skybox/generic"), None)
+camera = Camera(1280 / 720, position=(0.0, 1.0, 5.0))
+light = BasicLight()
+
+
+def draw(view, probes=None):
+    ctx.disable(moderngl.DEPTH_TEST)
+    ctx.front_face = "cw"
+    skybox.update(view)
+    skybox.render()
+    ctx.front_face = "ccw"
+    ctx.enable(moderngl.DEPTH_TEST)
+
+    for model in models + [mover]:
+        model.update(view, light)
+        model.render(skybox if probes is None else probes.environment(model.posmat[3][:3], skybox))
+
+
+print(f"{len(models) + 1} models, {ctx.info['GL_RENDERER']}")
+
+for faces_per_frame in (None, 6, 1):
+    probes = ReflectionProbes(ctx, capacity=4, size=128, faces_per_frame=faces_per_frame or 1)
+    for position in ((-8.0, 0.0, -6.0), (8.0, 0.0, -6.0), (-8.0, 0.0, -20.0), (8.0, 0.0, -20.0)):
+        probes.add(position, radius=12.0)
+    probes.track([mover])
+
+    # Every probe captured once before timing
+    probes.faces_per_frame = 24
+    probes.update(camera, draw)
+    probes.faces_per_frame = faces_per_frame or 1
+
+    worst = 0.0
+    start = time.perf_counter()
+    for frame in range(FRAMES):
+        t = time.perf_counter()
+        mover.posmat[3][0] = sin(frame * 0.1) * 10.0
+        mover.posmat[3][2] = -13.0 + cos(frame * 0.1) * 7.0
+
+        if faces_per_frame is not None:
+            probes.update(camera, draw)
+
+        fbo.use()
+        fbo.clear()
+        draw(camera, probes)
+        ctx.finish()
+        worst = max(worst, time.perf_counter() - t)
+    total = time.perf_counter() - start
+
+    name = "no probe updates" if faces_per_frame is None else f"{faces_per_frame} face(s) per frame"
+    print(f"  {name:<20}  avg {total/FRAMES*1000:7.2f} ms/frame  worst {worst*1000:7.2f} ms  "
+          f"captures {probes.captures}")
+    probes.dispose()
@@ -0,0 +1,161 @@
+"""
+Loads and disposes models, glTF files, scenes and UI text over and over,
+checking that the tracked GPU memory and the process' resident memory stay
+flat. Shaders are recompiled under a live model each cycle, which has to
+keep drawing with its old programs until it's disposed. Exits with an
+error and a leak report if anything is left behind. Runs headless on an
+EGL context (or the default standalone context if EGL isn't available).
+
+  python benchmarks/resource_stress.py
+"""
+
+import os
+import sys
+import time
+import numpy
+import moderngl
+
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+import pygame
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+os.chdir(os.path.join(os.path.dirname(__file__), ".."))
+
+from engine.model import PROGRAMS, load_model, load_cubemap, create_skybox, _compile_programs
+from engine.scene import Scene, load_scene
+from engine.camera import Camera
+from engine.light import BasicLight
+from engine.ui import Text
+from engine.resources import RESOURCES
+
+
+WARMUP = 3
+CYCLES = 20
+MODELS = (
+    ("assets/models/cube.obj", "assets/textures/green.png"),
+    ("assets/models/sphere.obj", "assets/textures/white.png"),
+    ("assets/models/wolf.obj", "assets/textures/white.png")
+)
+
+# The peak resident memory of the second half of the cycles may exceed the
+# first half's by this much (allocator and driver caches come and go)
+RSS_TOLERANCE = 16 * 1024 * 1024
+
+
+def resident_bytes() -> int:
+    """
+    Current resident set size, 0 where /proc isn't available
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        return 0
+
+
+pygame.init()
+pygame.display.set_mode((64, 64))
+
+try:
+    ctx = moderngl.create_standalone_context(backend="egl")
+except Exception:
+    ctx = moderngl.create_standalone_context()
+
+fbo = ctx.simple_framebuffer((320, 180))
+fbo.use()
+
+_compile_programs(ctx)
+
+scene = Scene()
+for i, (mesh, texture) in enumerate(MODELS):
+    scene.add_many(mesh, texture, [(x * 2.0, 0.0, i * 2.0) for x in range(50)])
+scene.skybox = "assets/skybox/generic"
+
+camera = Camera(320 / 180, position=(0.0, 1.0, 5.0))
+light = BasicLight()
+
+glb = "cache/sphere.glb"
+if not os.path.exists(glb):
+    glb = None
+    print("cache/sphere.glb not found, run benchmarks/gltf.py to include glTF loading")
+
+
+def drawn(model) -> int:
+    """
+    Pixels 'model' covers when drawn alone
+    """
+    fbo.clear(1.0, 0.0, 1.0)
+    model.update(camera, light)
+    model.render()
+    pixels = numpy.frombuffer(fbo.read(components=3), dtype=numpy.uint8).reshape(-1, 3)
+    return int(numpy.count_nonzero(numpy.any(pixels != (255, 0, 255), axis=1)))
+
+
+def recompile():
+    with load_model(ctx, *MODELS[0], (0.0, 1.0, 0.0)) as model:
+        before = drawn(model)
+        _compile_programs(ctx, force=True)
+        after = drawn(model)
+
+        error = ctx.error
+        if before == 0 or after != before or error != "GL_NO_ERROR":
+            sys.exit(f"model drew {after} pixels instead of {before} after recompiling the shaders ({error})")
+
+
+def cycle():
+    for mesh, texture in MODELS:
+        with load_model(ctx, mesh, texture, (0.0, 0.0, 0.0)):
+            pass
+
+    if glb is not None:
+        with load_model(ctx, glb):
+            pass
+
+    with load_scene(ctx, scene, (320, 180)) as loaded:
+        loaded.render(camera)
+
+    with Text(ctx, (320, 180), (0, 0), "@@@@@@@@@@@@") as text:
+        for i in range(50): text.change_text(str(i))
+
+    cubemap = load_cubemap(ctx, "assets/skybox/generic")
+    create_skybox(ctx, cubemap).dispose()
+    RESOURCES.release(cubemap)
+
+    recompile()
+
+    ctx.finish()
+
+
+# The first cycles fill caches (fonts, programs, driver pools)
+for _ in range(WARMUP): cycle()
+baseline = RESOURCES.snapshot()
+tracked = RESOURCES.usage()
+resident = []
+
+print(f"{tracked['objects']} tracked objects, {tracked['bytes'] / 1024:.1f} KiB after warm-up, {ctx.info['GL_RENDERER']}")
+
+start = time.perf_counter()
+for i in range(CYCLES):
+    cycle()
+    usage = RESOURCES.usage()
+    resident.append(resident_bytes())
+    print(f"  cycle {i+1:>3}  tracked {usage['objects']:>4} objects {usage['bytes'] / 1024:10.1f} KiB  "
+          f"resident {resident[-1] / 1024 / 1024:8.1f} MiB  created {RESOURCES.created}  freed {RESOURCES.freed}")
+
+elapsed = time.perf_counter() - start
+print(f"  {elapsed / CYCLES * 1000:.1f} ms per cycle")
+
+# The program cache is replaced by each recompile, only the old programs
+# should be gone
+leaks = [r for r in RESOURCES.leaks(baseline) if r.obj not in PROGRAMS.values()]
+growth = max(resident[CYCLES // 2:]) - max(resident[:CYCLES // 2])
+
+if leaks:
+    print(RESOURCES.report(baseline | {id(program) for program in PROGRAMS.values()}))
+if growth > RSS_TOLERANCE:
+    print(f"resident memory grew by {growth / 1024 / 1024:.1f} MiB")
+
+if leaks or growth > RSS_TOLERANCE:
+    sys.exit(1)
+
+print("no leaks")
@@ -0,0 +1,92 @@
+"""
+Save and load times of a 50 000 object scene in both scene file forms, and
+the time to get it onto the GPU. "assets" is the part of loading spent
+reading and uploading the meshes and textures, "objects" the transforms,
+grouping and instance buffer uploads, as measured by LoadedScene. Programs
+are compiled and the asset files read once before timing. Runs headless on an EGL context (or the default standalone context if EGL
+isn't available).
+
+  python benchmarks/scene.py
+"""
+
+import os
+import sys
+import time
+import numpy
+import moderngl
+
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+import pygame
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+os.chdir(os.path.join(os.path.dirname(__file__), ".."))
+
+from engine.scene import Scene, read_scene, load_scene
+
+
+OBJECTS = 50_000
+ASSETS = (
+    ("assets/models/cube.obj", "assets/textures/green.png"),
+    ("assets/models/sphere.obj", "assets/textures/white.png"),
+    ("assets/models/wolf.obj", "assets/textures/white.png"),
+    ("assets/models/obamium.obj", "assets/textures/obamium.png")
+)
+
+
+def timed(function):
+    start = time.perf_counter()
+    result = function()
+    return result, time.perf_counter() - start
+
+
+pygame.init()
+pygame.display.set_mode((64, 64))
+
+try:
+    ctx = moderngl.create_standalone_context(backend="egl")
+except Exception:
+    ctx = moderngl.create_standalone_context()
+
+rng = numpy.random.default_rng(0)
+count = OBJECTS // len(ASSETS)
+
+def build():
+    scene = Scene()
+    for mesh, texture in ASSETS:
+        scene.add_many(
+            mesh, texture,
+            rng.uniform(-500, 500, (count, 3)),
+            rng.uniform(0, 2 * numpy.pi, (count, 3)),
+            rng.uniform(0.5, 2.0, (count, 1)).repeat(3, axis=1))
+    return scene
+
+scene, elapsed = timed(build)
+print(f"{len(scene)} objects, {len(scene.meshes)} meshes, {len(scene.textures)} textures")
+print(f"  build            {elapsed*1000:8.2f} ms")
+
+os.makedirs("cache", exist_ok=True)
+for filepath in ("cache/benchmark.json", "cache/benchmark.scene"):
+    _, save_time = timed(lambda: scene.save(filepath))
+    _, read_time = timed(lambda: read_scene(filepath))
+    print(f"  {os.path.splitext(filepath)[1]:<6} {os.path.getsize(filepath) // 1024:>6} KiB  "
+          f"save {save_time*1000:8.2f} ms  read {read_time*1000:8.2f} ms")
+
+
+def load(scene):
+    loaded = load_scene(ctx, scene, (1280, 720))
+    ctx.finish()
+    return loaded
+
+
+# Compiles the programs and brings the asset files into the OS cache
+warmup = Scene()
+for mesh, texture in ASSETS:
+    warmup.add(mesh, texture, (0.0, 0.0, 0.0))
+load(warmup).dispose()
+
+scene = read_scene("cache/benchmark.scene")
+loaded, total = timed(lambda: load(scene))
+print(f"  load to GPU      {total*1000:8.2f} ms  assets {loaded.asset_time*1000:.2f} ms, "
+      f"objects {loaded.object_time*1000:.2f} ms, {loaded.draw_calls} draw calls")
+
+loaded.dispose()
@@ -0,0 +1,613 @@
+"""
+Skeletal and morph target animation
+
+Clips are baked to a fixed frame rate when loaded, so sampling any number
+of characters at once is a couple of array lookups and interpolations over
+(instances, joints) arrays. Joint hierarchies are evaluated one depth level
+at a time, every joint of a level in a single matrix product.
+
+Skinning matrices and morph weights of all instances of a model are uploaded
+to float textures and the model is drawn with one instanced call using the
+skinned vertex shader. Instances playing the same clip at the same time share
+one evaluation through a PoseCache.
+"""
+
+from typing import Union, Optional
+
+from pathlib import Path
+from collections import OrderedDict
+from math import ceil
+import numpy
+import pygame
+import moderngl
+import pyrr
+
+from .gltf import GLTFFile, Primitive, trs_matrices
+from .model import PROGRAMS, _compile_programs, _write_camera
+from .camera import Camera
+from .resources import Disposable, track, retain, release
+from .light import BasicLight
+from .pack import AssetPack
+from .utils import rotation_matrix
+
+
+def _normalize(q: numpy.ndarray) -> numpy.ndarray:
+    return q / numpy.linalg.norm(q, axis=-1, keepdims=True)
+
+
+def _nlerp(q0: numpy.ndarray, q1: numpy.ndarray, a: numpy.ndarray) -> numpy.ndarray:
+    """
+    Normalized lerp through the shorter arc, close enough to slerp between baked frames
+    """
+    sign = numpy.where(numpy.sum(q0 * q1, axis=-1, keepdims=True) < 0, -1.0, 1.0)
+    return _normalize(q0 * (1 - a) + q1 * sign * a)
+
+
+def _slerp(q0: numpy.ndarray, q1: numpy.ndarray, a: numpy.ndarray) -> numpy.ndarray:
+    d = numpy.sum(q0 * q1, axis=-1, keepdims=True)
+    q1 = numpy.where(d < 0, -q1, q1)
+    d = numpy.abs(d)
+
+    theta = numpy.arccos(numpy.clip(d, -1.0, 1.0))
+    sin_theta = numpy.sin(theta)
+    close = sin_theta < 1e-6
+
+    safe = numpy.where(close, 1.0, sin_theta)
+    w0 = numpy.where(close, 1 - a, numpy.sin((1 - a) * theta) / safe)
+    w1 = numpy.where(close, a, numpy.sin(a * theta) / safe)
+    return _normalize(q0 * w0 + q1 * w1)
+
+
+class Skeleton:
+    """
+    Joint hierarchy with its rest pose and inverse bind matrices
+
+    Matrices transform column vectors. 'root_matrices' hold the transform
+    of whatever is above each root joint, they are ignored for other joints.
+    """
+    def __init__(self,
+            names: list[str],
+            parents: list[int],
+            translations: numpy.ndarray,
+            rotations: numpy.ndarray,
+            scales: numpy.ndarray,
+            inverse_bind: numpy.ndarray,
+            root_matrices: numpy.ndarray = None):
+
+        self.names = names
+        self.parents = numpy.asarray(parents, dtype=numpy.int64)
+        self.translations = numpy.asarray(translations, dtype=numpy.float64)
+        self.rotations = numpy.asarray(rotations, dtype=numpy.float64)
+        self.scales = numpy.asarray(scales, dtype=numpy.float64)
+        self.inverse_bind = numpy.asarray(inverse_bind, dtype=numpy.float64)
+
+        n = len(names)
+        if root_matrices is None: root_matrices = numpy.tile(numpy.identity(4), (n, 1, 1))
+        self.root_matrices = numpy.asarray(root_matrices, dtype=numpy.float64)
+
+        # Joints grouped by depth, every level only depends on the previous one
+        depth = numpy.zeros(n, dtype=numpy.int64)
+        for i in range(n):
+            parent = self.parents[i]
+            while parent >= 0:
+                depth[i] += 1
+                parent = self.parents[parent]
+
+        self.roots = numpy.flatnonzero(depth == 0)
+        self.levels = [numpy.flatnonzero(depth == d) for d in range(1, depth.max() + 1)]
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    @classmethod
+    def from_gltf(cls, gltf: GLTFFile, skin: int = 0, mesh_node: int = None) -> "Skeleton":
+        """
+        'mesh_node' is the node instancing the skinned mesh, its transform is
+        factored out as glTF skinning ignores it
+        """
+        skin = gltf.json["skins"][skin]
+        joints = skin["joints"]
+        index = {node: i for i, node in enumerate(joints)}
+
+        parents = [index.get(gltf.parents[node], -1) for node in joints]
+        trs = [gltf.node_trs(node) for node in joints]
+
+        if "inverseBindMatrices" in skin:
+            inverse_bind = gltf.accessor(skin["inverseBindMatrices"]).astype(numpy.float64)
+        else:
+            inverse_bind = numpy.tile(numpy.identity(4), (len(joints), 1, 1))
+
+        to_mesh = numpy.identity(4)
+        if mesh_node is not None:
+            to_mesh = numpy.linalg.inv(gltf.global_matrix(mesh_node))
+
+        root_matrices = numpy.tile(numpy.identity(4), (len(joints), 1, 1))
+        for i, node in enumerate(joints):
+            if parents[i] < 0:
+                parent = gltf.parents[node]
+                root_matrices[i] = to_mesh @ (gltf.global_matrix(parent) if parent >= 0 else numpy.identity(4))
+
+        return cls(
+            [gltf.nodes[node].get("name", f"joint{i}") for i, node in enumerate(joints)],
+            parents,
+            numpy.array([t for t, _, _ in trs]),
+            numpy.array([r for _, r, _ in trs]),
+            numpy.array([s for _, _, s in trs]),
+            inverse_bind,
+            root_matrices)
+
+    def global_matrices(self, local: numpy.ndarray) -> numpy.ndarray:
+        """
+        (k, n, 4, 4) joint to model space matrices from local matrices
+        """
+        world = numpy.empty_like(local)
+        world[:, self.roots] = self.root_matrices[self.roots] @ local[:, self.roots]
+
+        for level in self.levels:
+            world[:, level] = world[:, self.parents[level]] @ local[:, level]
+
+        return world
+
+    def skinning_matrices(self,
+            translations: numpy.ndarray,
+            rotations: numpy.ndarray,
+            scales: numpy.ndarray) -> numpy.ndarray:
+        """
+        (k, n, 4, 4) skinning matrices from (k, n, ...) local joint poses
+        """
+        return self.global_matrices(trs_matrices(translations, rotations, scales)) @ self.inverse_bind
+
+
+class AnimationClip:
+    """
+    Joint poses and morph weights baked at a fixed frame rate
+
+    Joints that aren't animated hold their rest pose. 'weights' is None
+    when the clip doesn't animate morph targets.
+    """
+    def __init__(self,
+            name: str,
+            rate: float,
+            translations: numpy.ndarray,
+            rotations: numpy.ndarray,
+            scales: numpy.ndarray,
+            weights: numpy.ndarray = None):
+
+        self.name = name
+        self.rate = rate
+        self.translations = translations
+        self.rotations = rotations
+        self.scales = scales
+        self.weights = weights
+
+        self.frames = len(translations)
+        self.duration = (self.frames - 1) / rate
+
+    @classmethod
+    def from_gltf(cls,
+            gltf: GLTFFile,
+            animation: int,
+            skeleton: Skeleton,
+            joints: list[int],
+            rate: float = 30.0,
+            mesh_node: int = None,
+            morph_targets: int = 0) -> "AnimationClip":
+        """
+        'joints' are the node indices of the skeleton's joints
+        """
+        animation = gltf.json["animations"][animation]
+        index = {node: i for i, node in enumerate(joints)}
+
+        channels = []
+        duration = 0.0
+        for channel in animation["channels"]:
+            sampler = animation["samplers"][channel["sampler"]]
+            times = gltf.accessor(sampler["input"]).reshape(-1).astype(numpy.float64)
+            duration = max(duration, float(times[-1]))
+            channels.append((channel["target"], sampler, times))
+
+        frames = max(2, ceil(duration * rate) + 1)
+        frame_times = numpy.arange(frames) / rate
+
+        n = len(skeleton)
+        translations = numpy.tile(skeleton.translations, (frames, 1, 1))
+        rotations = numpy.tile(skeleton.rotations, (frames, 1, 1))
+        scales = numpy.tile(skeleton.scales, (frames, 1, 1))
+        weights = None
+
+        for target, sampler, times in channels:
+            node = target.get("node")
+            path = target["path"]
+
+            values = gltf.accessor(sampler["output"]).astype(numpy.float64)
+            interpolation = sampler.get("interpolation", "LINEAR")
+
+            if path == "weights":
+                if node != mesh_node or morph_targets == 0: continue
+                values = values.reshape(-1, morph_targets)
+            elif node not in index:
+                continue
+
+            # Cubic spline keys store in-tangent, value and out-tangent, only values are used
+            if interpolation == "CUBICSPLINE":
+                values = values.reshape(len(times), 3, -1)[:, 1]
+
+            values = values.reshape(len(times), -1)
+            sampled = cls._bake(times, values, frame_times, interpolation, path == "rotation")
+
+            if path == "translation": translations[:, index[node]] = sampled
+            elif path == "rotation": rotations[:, index[node]] = sampled
+            elif path == "scale": scales[:, index[node]] = sampled
+            elif path == "weights": weights = sampled
+
+        return cls(animation.get("name", ""), rate, translations, rotations, scales, weights)
+
+    @staticmethod
+    def _bake(times: numpy.ndarray,
+            values: numpy.ndarray,
+            frame_times: numpy.ndarray,
+            interpolation: str,
+            rotation: bool) -> numpy.ndarray:
+
+        if len(times) == 1:
+            return numpy.repeat(values, len(frame_times), axis=0)
+
+        i0 = numpy.clip(numpy.searchsorted(times, frame_times, side="right") - 1, 0, len(times) - 2)
+        i1 = i0 + 1
+
+        if interpolation == "STEP":
+            i0 = numpy.where(frame_times >= times[i1], i1, i0)
+            return values[i0]
+
+        a = numpy.clip((frame_times - times[i0]) / (times[i1] - times[i0]), 0.0, 1.0)[:, None]
+        if rotation: return _slerp(values[i0], values[i1], a)
+        return values[i0] * (1 - a) + values[i1] * a
+
+    def sample(self,
+            times: numpy.ndarray,
+            loop: bool = True) -> tuple[numpy.ndarray, numpy.ndarray, numpy.ndarray, Optional[numpy.ndarray]]:
+        """
+        Joint poses of (k,) times as (k, n, 3), (k, n, 4), (k, n, 3) arrays and (k, m) morph weights
+        """
+        f = numpy.asarray(times, dtype=numpy.float64) * self.rate
+        if loop: f = f % (self.frames - 1)
+        else: f = numpy.clip(f, 0, self.frames - 1)
+
+        i0 = numpy.minimum(f.astype(numpy.int64), self.frames - 1)
+        i1 = numpy.minimum(i0 + 1, self.frames - 1)
+        a = (f - i0)[:, None, None]
+
+        translations = self.translations[i0] * (1 - a) + self.translations[i1] * a
+        rotations = _nlerp(self.rotations[i0], self.rotations[i1], a)
+        scales = self.scales[i0] * (1 - a) + self.scales[i1] * a
+
+        weights = None
+        if self.weights is not None:
+            weights = self.weights[i0] * (1 - a[:, 0]) + self.weights[i1] * a[:, 0]
+
+        return translations, rotations, scales, weights
+
+
+class PoseCache:
+    """
+    Skinning matrices by clip and time, shared by instances in the same pose
+
+    Times are snapped to 'steps' subdivisions of the clip's baked frames,
+    the least recently used poses are dropped past 'max_entries'. Entries
+    are keyed on the clip and skeleton objects, which they keep alive until
+    dropped.
+    """
+    def __init__(self, steps: int = 2, max_entries: int = 4096):
+        self.steps = steps
+        self.max_entries = max_entries
+        self.entries: OrderedDict[tuple, tuple[numpy.ndarray, Optional[numpy.ndarray]]] = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+
+    def evaluate(self,
+            skeleton: Skeleton,
+            clip: AnimationClip,
+            times: numpy.ndarray,
+            loop: bool = True) -> tuple[numpy.ndarray, Optional[numpy.ndarray]]:
+        """
+        (k, n, 4, 4) skinning matrices and (k, m) morph weights
+        """
+        step = clip.rate * self.steps
+        f = numpy.asarray(times, dtype=numpy.float64) * step
+        if loop: f = f % ((clip.frames - 1) * self.steps)
+        keys, inverse = numpy.unique(numpy.rint(f).astype(numpy.int64), return_inverse=True)
+
+        entries = self.entries
+        missing = [k for k in keys.tolist() if (clip, skeleton, k) not in entries]
+        self.misses += len(missing)
+        self.hits += len(keys) - len(missing)
+
+        if missing:
+            translations, rotations, scales, weights = clip.sample(numpy.array(missing) / step, loop=False)
+            skins = skeleton.skinning_matrices(translations, rotations, scales).astype(numpy.float32)
+            for i, k in enumerate(missing):
+                entries[(clip, skeleton, k)] = (skins[i], None if weights is None else weights[i])
+
+        poses = []
+        for k in keys.tolist():
+            key = (clip, skeleton, k)
+            entries.move_to_end(key)
+            poses.append(entries[key])
+
+        while len(entries) > self.max_entries:
+            entries.popitem(last=False)
+
+        skins = numpy.stack([skin for skin, _ in poses])[inverse.reshape(-1)]
+        weights = None
+        if clip.weights is not None:
+            weights = numpy.stack([w for _, w in poses])[inverse.reshape(-1)]
+
+        return skins, weights
+
+
+class AnimationInstance:
+    """
+    One character drawn by a SkinnedModel
+    """
+    def __init__(self,
+            clip: AnimationClip,
+            position: tuple[float, float, float],
+            time: float = 0.0,
+            speed: float = 1.0,
+            loop: bool = True):
+
+        self.clip = clip
+        self.time = time
+        self.speed = speed
+        self.loop = loop
+
+        self.position = pyrr.Vector3(position)
+        self.rotation = pyrr.Vector3([0.0, 0.0, 0.0])
+        self.scale = pyrr.Vector3([1.0, 1.0, 1.0])
+
+
+class SkinnedModel(Disposable):
+    """
+    Skinned mesh drawn once for all of its instances
+
+    Bone matrices are stored in a float texture with four texels (columns)
+    per joint and a row per instance, morph target deltas in another one.
+    """
+    def __init__(self,
+            ctx: moderngl.Context,
+            primitive: Primitive,
+            skeleton: Skeleton,
+            texture: Union[str, pygame.Surface, moderngl.Texture],
+            clips: dict[str, AnimationClip],
+            max_instances: int = 256,
+            morph_weights: list[float] = None,
+            pose_cache: PoseCache = None):
+
+        self.ctx = ctx
+        self.program = retain(PROGRAMS["skinned"])
+        self.skeleton = skeleton
+        self.clips = clips
+        self.max_instances = max_instances
+        self.pose_cache = pose_cache
+
+        self.instances: list[AnimationInstance] = []
+
+        self.vertex_count = primitive.vertex_count
+        self.morph_count = len(primitive.targets)
+        self.morph_weights = numpy.zeros(self.morph_count, dtype=numpy.float32)
+        if morph_weights is not None: self.morph_weights[:] = morph_weights
+
+        self.owns_texture = not isinstance(texture, moderngl.Texture)
+        if self.owns_texture:
+            surface = texture if isinstance(texture, pygame.Surface) else pygame.image.load(texture)
+            self.texture = track(ctx.texture(surface.get_size(), 4, pygame.image.tostring(surface, "RGBA", True)), self)
+            self.texture.build_mipmaps()
+        else:
+            self.texture = retain(texture)
+
+        self.create_vao(primitive)
+        self.create_textures(primitive)
+
+        self._bones = numpy.zeros((max_instances, len(skeleton), 4, 4), dtype=numpy.float32)
+        self._weights = numpy.zeros((max_instances, max(self.morph_count, 1)), dtype=numpy.float32)
+        self._models = numpy.zeros((max_instances, 4, 4), dtype=numpy.float32)
+
+    def create_vao(self, primitive: Primitive):
+        n = primitive.vertex_count
+        vertices = numpy.zeros((n, 16), dtype=numpy.float32)
+        vertices[:, 0:3] = primitive.positions
+
+        # glTF texture coordinates start at the top of the image
+        if primitive.uv is not None:
+            vertices[:, 3] = primitive.uv[:, 0]
+            vertices[:, 4] = 1.0 - primitive.uv[:, 1]
+        if primitive.normals is not None:
+            vertices[:, 5:8] = primitive.normals
+
+        if primitive.joints is not None:
+            vertices[:, 8:12] = primitive.joints
+            weights = numpy.asarray(primitive.weights, dtype=numpy.float32)
+            vertices[:, 12:16] = weights / numpy.maximum(weights.sum(axis=1, keepdims=True), 1e-8)
+        else:
+            vertices[:, 12] = 1.0
+
+        self.vbo = track(self.ctx.buffer(vertices), self)
+        self.instance_buffer = track(self.ctx.buffer(reserve=self.max_instances * 64), self)
+
+        self.ibo = None
+        if primitive.indices is not None:
+            self.ibo = track(self.ctx.buffer(primitive.indices.astype(numpy.uint32)), self)
+
+        self.vao = track(self.ctx.vertex_array(
+            self.program, [
+                (self.vbo, "3f 2f 3f 4f 4f", "a_position", "a_texture", "a_normal", "a_joints", "a_weights"),
+                (self.instance_buffer, "16f/i", "a_model")
+            ],
+            index_buffer=self.ibo,
+            index_element_size=4), self)
+
+    def create_textures(self, primitive: Primitive):
+        self.bone_texture = track(self.ctx.texture((4 * len(self.skeleton), self.max_instances), 4, dtype="f4"), self)
+        self.bone_texture.filter = (moderngl.NEAREST, moderngl.NEAREST)
+
+        # Position and normal deltas of every target, one block of vertices each
+        deltas = numpy.zeros((max(self.morph_count, 1) * 2, self.vertex_count, 3), dtype=numpy.float32)
+        for i, target in enumerate(primitive.targets):
+            if "POSITION" in target: deltas[i*2] = target["POSITION"]
+            if "NORMAL" in target: deltas[i*2 + 1] = target["NORMAL"]
+
+        deltas = deltas.reshape(-1, 3)
+        width = min(len(deltas), 4096)
+        height = ceil(len(deltas) / width)
+        data = numpy.zeros((width * height, 3), dtype=numpy.float32)
+        data[:len(deltas)] = deltas
+
+        self.morph_texture = track(self.ctx.texture((width, height), 3, data, dtype="f4"), self)
+        self.morph_texture.filter = (moderngl.NEAREST, moderngl.NEAREST)
+
+        self.weight_texture = track(self.ctx.texture((max(self.morph_count, 1), self.max_instances), 1, dtype="f4"), self)
+        self.weight_texture.filter = (moderngl.NEAREST, moderngl.NEAREST)
+
+    def add_instance(self,
+            clip: str,
+            position: tuple[float, float, float],
+            time: float = 0.0,
+            speed: float = 1.0,
+            loop: bool = True) -> AnimationInstance:
+
+        if len(self.instances) >= self.max_instances:
+            raise ValueError(f"model already has {self.max_instances} instances")
+
+        instance = AnimationInstance(self.clips[clip], position, time, speed, loop)
+        self.instances.append(instance)
+        return instance
+
+    def remove_instance(self, instance: AnimationInstance):
+        self.instances.remove(instance)
+
+    def advance(self, dt: float):
+        """
+        Advance every instance's clip time by 'dt' seconds
+        """
+        for instance in self.instances:
+            instance.time += dt * instance.speed
+
+    def evaluate(self):
+        """
+        Sample the poses of all instances and upload them
+        """
+        k = len(self.instances)
+        if k == 0: return
+
+        groups: dict[tuple[int, bool], list[int]] = {}
+        for i, instance in enumerate(self.instances):
+            groups.setdefault((id(instance.clip), instance.loop), []).append(i)
+
+        for indices in groups.values():
+            first = self.instances[indices[0]]
+            clip = first.clip
+            times = numpy.array([self.instances[i].time for i in indices])
+
+            if self.pose_cache is not None:
+                skins, weights = self.pose_cache.evaluate(self.skeleton, clip, times, first.loop)
+            else:
+                translations, rotations, scales, weights = clip.sample(times, first.loop)
+                skins = self.skeleton.skinning_matrices(translations, rotations, scales)
+
+            self._bones[indices] = skins
+            if self.morph_count:
+                self._weights[indices] = self.morph_weights if weights is None else weights
+
+        # Same model transform as BaseModel, rotation and scale then translation
+        rotations = numpy.array([instance.rotation for instance in self.instances])
+        scales = numpy.array([instance.scale for instance in self.instances])
+        models = self._models[:k]
+        models[:] = 0
+        models[:, :3, :3] = rotation_matrix(rotations) * scales[:, None, :]
+        models[:, :3, 3] = [instance.position for instance in self.instances]
+        models[:, 3, 3] = 1
+
+        # Matrices are stored column by column like GLSL expects
+        self.instance_buffer.write(numpy.ascontiguousarray(models.transpose(0, 2, 1)))
+        self.bone_texture.write(
+            numpy.ascontiguousarray(self._bones[:k].transpose(0, 1, 3, 2)),
+            viewport=(0, 0, 4 * len(self.skeleton), k))
+
+        if self.morph_count:
+            self.weight_texture.write(self._weights[:k], viewport=(0, 0, self.morph_count, k))
+
+    def update(self, camera: Camera, light_source: BasicLight):
+        self.evaluate()
+
+        _write_camera(self.program, camera)
+        self.program["lightpos"].value = tuple(light_source.position.tolist())
+        self.program["color"].value = light_source.color
+        self.program["ambient_intensity"].value = light_source.ambient_intensity
+        self.program["diffuse_intensity"].value = light_source.diffuse_intensity
+        self.program["specular_intensity"].value = light_source.specular_intensity
+        self.program["specular_power"].value = light_source.specular_power
+
+        if "morph_count" in self.program:
+            self.program["morph_count"].value = self.morph_count
+            self.program["vertex_count"].value = self.vertex_count
+
+    def render(self, skybox=None):
+        if not self.instances: return
+
+        self.texture.use(location=0)
+        if skybox: skybox.texture.use(location=1)
+        self.bone_texture.use(location=2)
+        self.morph_texture.use(location=3)
+        self.weight_texture.use(location=4)
+
+        self.vao.render(instances=len(self.instances))
+
+    def dispose(self):
+        release(self.vao)
+        release(self.vbo)
+        release(self.instance_buffer)
+        release(self.ibo)
+        release(self.bone_texture)
+        release(self.morph_texture)
+        release(self.weight_texture)
+        release(self.texture)
+        release(self.program)
+
+
+def load_skinned(
+        ctx: moderngl.Context,
+        filepath: Union[Path, str],
+        texture: Union[str, pygame.Surface, moderngl.Texture],
+        mesh: int = 0,
+        skin: int = 0,
+        rate: float = 30.0,
+        max_instances: int = 256,
+        pose_cache: PoseCache = None,
+        pack: AssetPack = None) -> SkinnedModel:
+    """
+    Load the first primitive of a skinned glTF mesh and all of the file's animations
+    """
+    _compile_programs(ctx, pack=pack)
+
+    gltf = GLTFFile(filepath)
+    primitive = gltf.primitives(mesh)[0]
+    mesh_node = gltf.mesh_node(mesh)
+
+    skeleton = Skeleton.from_gltf(gltf, skin, mesh_node)
+    joints = gltf.json["skins"][skin]["joints"]
+
+    clips = {}
+    for i, animation in enumerate(gltf.json.get("animations", [])):
+        clip = AnimationClip.from_gltf(gltf, i, skeleton, joints, rate, mesh_node, len(primitive.targets))
+        clips[animation.get("name", f"animation{i}")] = clip
+
+    return SkinnedModel(
+        ctx,
+        primitive,
+        skeleton,
+        texture,
+        clips,
+        max_instances,
+        gltf.json["meshes"][mesh].get("weights"),
+        pose_cache)
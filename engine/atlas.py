@@ -0,0 +1,370 @@
+"""
+Texture atlas
+
+Small textures are packed into a single texture so models using them share
+one texture bind and can be drawn together. Each texture is surrounded by a
+border of its own edge pixels and placed on a grid aligned to the number of
+mip levels built, so neither bilinear filtering nor mipmapping samples a
+neighbouring texture.
+
+Textures are named like asset pack entries (see pack.texture_name), so a
+flipped texture is a separate entry. A built atlas can be cached as a PNG
+and a JSON index next to each other. Report the packing of a set of textures with:
+  python -m engine.atlas texture [texture ...]
+"""
+
+from typing import Union, Optional
+
+from pathlib import Path
+from math import ceil, log2
+import sys
+import json
+import hashlib
+import numpy
+import pygame
+import moderngl
+
+from .pack import texture_name
+from .resources import Disposable, track, release
+
+
+def _next_power_of_two(n: int) -> int:
+    return 1 << max(0, ceil(log2(max(n, 1))))
+
+
+def _align(n: int, alignment: int) -> int:
+    return -(-n // alignment) * alignment
+
+
+class AtlasRegion:
+    """
+    Placement of a texture in the atlas, in pixels from the top left
+    """
+    def __init__(self, name: str, x: int, y: int, width: int, height: int):
+        self.name = name
+        self.x = x
+        self.y = y
+        self.width = width
+        self.height = height
+
+    def uv_transform(self, atlas_size: tuple[int, int]) -> tuple[float, float, float, float]:
+        """
+        Offset and scale mapping the texture's UVs into the atlas,
+        the atlas is uploaded bottom row first like model textures
+        """
+        w, h = atlas_size
+        return (
+            self.x / w,
+            (h - self.y - self.height) / h,
+            self.width / w,
+            self.height / h
+        )
+
+
+class TextureAtlas(Disposable):
+    """
+    Packed atlas surface and the region of every texture in it
+    """
+    def __init__(self,
+            surface: pygame.Surface,
+            regions: dict[str, AtlasRegion],
+            texture_format: str,
+            mip_levels: int,
+            key: str = ""):
+
+        self.surface = surface
+        self.regions = regions
+        self.texture_format = texture_format
+        self.mip_levels = mip_levels
+        self.key = key
+
+        self.texture: Optional[moderngl.Texture] = None
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.regions
+
+    @property
+    def size(self) -> tuple[int, int]:
+        return self.surface.get_size()
+
+    @property
+    def efficiency(self) -> float:
+        """
+        Ratio of atlas area covered by source texels, borders excluded
+        """
+        w, h = self.size
+        return sum(r.width * r.height for r in self.regions.values()) / (w * h)
+
+    def report(self) -> str:
+        w, h = self.size
+        used = sum(r.width * r.height for r in self.regions.values())
+        return (f"{len(self.regions)} textures in {w}x{h} {self.texture_format} atlas, "
+                f"{used} of {w*h} texels used ({self.efficiency:.1%}), "
+                f"{self.mip_levels} mip levels")
+
+    def create_texture(self, ctx: moderngl.Context) -> moderngl.Texture:
+        """
+        Upload the atlas once, models using it share the texture
+        """
+        if self.texture is not None: return self.texture
+
+        self.texture = track(ctx.texture(
+            self.size,
+            len(self.texture_format),
+            pygame.image.tostring(self.surface, self.texture_format, True)
+        ), self)
+
+        self.texture.repeat_x = False
+        self.texture.repeat_y = False
+
+        # Coarser levels would average texels across the borders
+        self.texture.build_mipmaps(0, self.mip_levels)
+
+        return self.texture
+
+    def dispose(self):
+        """
+        Drop the atlas' reference to its texture, it's freed once the models
+        sharing it are disposed too
+        """
+        release(self.texture)
+        self.texture = None
+
+    def remap(self, name: str, tex_coords) -> numpy.ndarray:
+        """
+        Texture coordinates of a model using texture 'name' moved into the atlas,
+        coordinates are clamped to the texture like the models' own textures
+        """
+        u0, v0, su, sv = self.regions[name].uv_transform(self.size)
+
+        uv = numpy.clip(numpy.asarray(tex_coords, dtype=numpy.float32).reshape(-1, 2), 0.0, 1.0)
+        uv *= (su, sv)
+        uv += (u0, v0)
+        return uv.reshape(-1)
+
+    def save(self, filepath: Union[Path, str]):
+        """
+        Writes 'filepath'.png and 'filepath'.json
+        """
+        filepath = Path(filepath)
+        filepath.parent.mkdir(parents=True, exist_ok=True)
+
+        pygame.image.save(self.surface, filepath.with_suffix(".png"))
+
+        index = {
+            "key": self.key,
+            "format": self.texture_format,
+            "mip_levels": self.mip_levels,
+            "regions": {
+                name: [r.x, r.y, r.width, r.height] for name, r in self.regions.items()
+            }
+        }
+        with open(filepath.with_suffix(".json"), "w") as f:
+            json.dump(index, f)
+
+    @classmethod
+    def load(cls, filepath: Union[Path, str], key: str = None) -> Optional["TextureAtlas"]:
+        """
+        Returns None if there is no cached atlas or it was built from different sources
+        """
+        filepath = Path(filepath)
+        if not filepath.with_suffix(".json").exists() or not filepath.with_suffix(".png").exists():
+            return None
+
+        with open(filepath.with_suffix(".json")) as f:
+            index = json.load(f)
+
+        if key is not None and index["key"] != key:
+            return None
+
+        surface = pygame.image.load(filepath.with_suffix(".png"))
+        regions = {
+            name: AtlasRegion(name, *rect) for name, rect in index["regions"].items()
+        }
+
+        return cls(surface, regions, index["format"], index["mip_levels"], index["key"])
+
+
+class AtlasBuilder:
+    """
+    Packs textures into an atlas with shelf packing
+
+    'padding' is the width of the extruded border around every texture,
+    mipmaps are built down to the level where a texel still fits in it.
+    """
+    def __init__(self, padding: int = 8, max_size: int = 4096):
+        self.padding = padding
+        self.max_size = max_size
+        self.mip_levels = max(0, int(log2(max(padding, 1))))
+
+        self.sources: dict[str, tuple[Path, bool]] = {}
+        self.surfaces: dict[str, pygame.Surface] = {}
+
+    def add(self, filepath: Union[Path, str], flip: bool = False) -> str:
+        """
+        Returns the name of the texture in the atlas
+        """
+        name = texture_name(filepath, flip)
+        self.sources[name] = (Path(filepath), flip)
+        return name
+
+    def add_surface(self, name: str, surface: pygame.Surface):
+        self.surfaces[name] = surface
+
+    def cache_key(self) -> str:
+        """
+        Changes when a source file, the set of textures or the packing options change
+        """
+        h = hashlib.sha1()
+        h.update(f"{self.padding} {self.max_size}".encode())
+
+        for name, (filepath, _) in sorted(self.sources.items()):
+            stat = filepath.stat()
+            h.update(f"{name} {stat.st_size} {stat.st_mtime_ns}".encode())
+
+        for name, surface in sorted(self.surfaces.items()):
+            h.update(name.encode())
+            h.update(pygame.image.tostring(surface, "RGBA"))
+
+        return h.hexdigest()
+
+    def _load_surfaces(self) -> dict[str, pygame.Surface]:
+        surfaces = {}
+
+        for name, (filepath, flip) in self.sources.items():
+            surface = pygame.image.load(filepath)
+            if flip: surface = pygame.transform.flip(surface, False, True)
+            surfaces[name] = surface
+
+        surfaces.update(self.surfaces)
+        return surfaces
+
+    def _pack(self, sizes: dict[str, tuple[int, int]], width: int) -> Optional[tuple[dict[str, tuple[int, int]], int]]:
+        """
+        Shelf packing of padded sizes in an atlas 'width' wide,
+        returns texture positions and the height used
+        """
+        alignment = 1 << self.mip_levels
+        positions = {}
+        x = y = shelf_height = 0
+
+        for name in sorted(sizes, key=lambda n: (-sizes[n][1], -sizes[n][0], n)):
+            w, h = sizes[name]
+            cell_w = _align(w + 2 * self.padding, alignment)
+            cell_h = _align(h + 2 * self.padding, alignment)
+            if cell_w > width: return None
+
+            if x + cell_w > width:
+                y += shelf_height
+                x = shelf_height = 0
+
+            positions[name] = (x + self.padding, y + self.padding)
+            x += cell_w
+            shelf_height = max(shelf_height, cell_h)
+
+        return positions, y + shelf_height
+
+    def build(self, key: str = None) -> TextureAtlas:
+        surfaces = self._load_surfaces()
+        if not surfaces:
+            raise ValueError("atlas has no textures")
+
+        sizes = {name: surface.get_size() for name, surface in surfaces.items()}
+        area = sum((w + 2*self.padding) * (h + 2*self.padding) for w, h in sizes.values())
+
+        # Try every power of two width and keep the smallest atlas
+        best = None
+        width = _next_power_of_two(max(w for w, _ in sizes.values()) + 2 * self.padding)
+        while width <= self.max_size:
+            packed = self._pack(sizes, width)
+            if packed is not None:
+                positions, used_height = packed
+                # Non power of two heights are fine for OpenGL 3.3, only mip alignment matters
+                height = _align(used_height, 1 << self.mip_levels)
+                if height <= self.max_size and (best is None or width * height < best[0] * best[1]):
+                    best = (width, height, positions)
+
+            if width * width >= 4 * area: break
+            width *= 2
+
+        if best is None:
+            raise ValueError(f"textures don't fit in a {self.max_size}x{self.max_size} atlas")
+
+        width, height, positions = best
+
+        alpha = any(surface.get_flags() & pygame.SRCALPHA for surface in surfaces.values())
+        texture_format = "RGBA" if alpha else "RGB"
+
+        atlas = pygame.Surface((width, height), pygame.SRCALPHA if alpha else 0, 32)
+        regions = {}
+
+        for name, surface in surfaces.items():
+            x, y = positions[name]
+            w, h = sizes[name]
+            self._blit_extruded(atlas, surface.convert_alpha() if alpha else surface.convert(), x, y)
+            regions[name] = AtlasRegion(name, x, y, w, h)
+
+        return TextureAtlas(atlas, regions, texture_format, self.mip_levels,
+                            key if key is not None else self.cache_key())
+
+    def _blit_extruded(self, atlas: pygame.Surface, surface: pygame.Surface, x: int, y: int):
+        """
+        Blit the texture and repeat its edge pixels into the border around it
+        """
+        p = self.padding
+        w, h = surface.get_size()
+        atlas.blit(surface, (x, y))
+        if p == 0: return
+
+        scale = pygame.transform.scale
+        atlas.blit(scale(surface.subsurface((0, 0, w, 1)), (w, p)), (x, y - p))
+        atlas.blit(scale(surface.subsurface((0, h - 1, w, 1)), (w, p)), (x, y + h))
+        atlas.blit(scale(surface.subsurface((0, 0, 1, h)), (p, h)), (x - p, y))
+        atlas.blit(scale(surface.subsurface((w - 1, 0, 1, h)), (p, h)), (x + w, y))
+
+        atlas.fill(surface.get_at((0, 0)),         (x - p, y - p, p, p))
+        atlas.fill(surface.get_at((w - 1, 0)),     (x + w, y - p, p, p))
+        atlas.fill(surface.get_at((0, h - 1)),     (x - p, y + h, p, p))
+        atlas.fill(surface.get_at((w - 1, h - 1)), (x + w, y + h, p, p))
+
+
+def load_atlas(
+        textures: list[Union[Path, str, tuple[Union[Path, str], bool]]],
+        cache: Union[Path, str] = None,
+        padding: int = 8,
+        max_size: int = 4096) -> TextureAtlas:
+    """
+    Build an atlas from texture files, entries can be (filepath, flip) pairs
+
+    With 'cache', a previously saved atlas is reused as long as it was built
+    from the same files and options, otherwise the new atlas is saved there.
+    """
+    builder = AtlasBuilder(padding, max_size)
+    for texture in textures:
+        if isinstance(texture, tuple): builder.add(*texture)
+        else: builder.add(texture)
+
+    key = builder.cache_key()
+
+    if cache is not None:
+        atlas = TextureAtlas.load(cache, key)
+        if atlas is not None: return atlas
+
+    atlas = builder.build(key)
+    if cache is not None: atlas.save(cache)
+
+    return atlas
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("usage: python -m engine.atlas texture [texture ...]")
+        sys.exit(1)
+
+    pygame.display.init()
+    pygame.display.set_mode((1, 1), pygame.HIDDEN)
+
+    atlas = load_atlas(sys.argv[1:])
+    print(atlas.report())
+    for name, region in atlas.regions.items():
+        print(f"  {name}: {region.width}x{region.height} at {region.x},{region.y}")
@@ -0,0 +1,201 @@
+"""
+Audio playback
+
+Sounds are declared in categories and loaded together into a sound bank.
+AudioManager plays categories on a fixed budget of mixer channels, stealing
+the lowest priority voice when all of them are busy. Cooldowns are measured
+with the engine clock advanced by update(), not with wall-clock time.
+"""
+
+from typing import Optional
+
+from pathlib import Path
+import os
+import random
+import pygame
+
+from .pack import AssetPack
+
+
+def init_mixer(
+        headless: bool = False,
+        frequency: int = 44100,
+        size: int = -16,
+        channels: int = 2,
+        buffer: int = 512):
+    """
+    'headless' keyword uses SDL's dummy audio driver, for benchmarks and machines without audio output
+    """
+    if headless:
+        os.environ["SDL_AUDIODRIVER"] = "dummy"
+
+    pygame.mixer.init(frequency, size, channels, buffer)
+
+
+class SoundCategory:
+    """
+    A group of interchangeable sounds, a random one is played each time
+    without playing the same sound twice in a row
+    """
+    def __init__(self,
+            name: str,
+            sounds: list[pygame.mixer.Sound],
+            priority: int = 0,
+            volume: float = 1.0,
+            cooldown: int = 0):
+
+        self.name = name
+        self.sounds = sounds
+        self.priority = priority
+        self.volume = volume
+        self.cooldown = cooldown
+
+        self._last = -1
+
+    def pick(self) -> pygame.mixer.Sound:
+        n = len(self.sounds)
+        if n == 1 or self._last < 0:
+            i = random.randrange(n)
+        else:
+            i = random.randrange(n - 1)
+            if i >= self._last: i += 1
+
+        self._last = i
+        return self.sounds[i]
+
+
+class SoundBank:
+    """
+    Loads all sounds of the declared categories in one pass
+
+    Categories are declared as
+      {"walk": {"sounds": ["assets/sounds/fs0.wav", ...], "priority": 1, "volume": 1.0, "cooldown": 470}}
+    where cooldown is in milliseconds.
+    """
+    def __init__(self, categories: dict[str, dict], pack: AssetPack = None):
+        loaded: dict[str, pygame.mixer.Sound] = {}
+
+        for declaration in categories.values():
+            for filepath in declaration["sounds"]:
+                filepath = Path(filepath).as_posix()
+                if filepath in loaded: continue
+
+                if pack is not None and filepath in pack:
+                    loaded[filepath] = pack.sound(filepath)
+                else:
+                    loaded[filepath] = pygame.mixer.Sound(filepath)
+
+        self.categories = {
+            name: SoundCategory(
+                name,
+                [loaded[Path(filepath).as_posix()] for filepath in declaration["sounds"]],
+                declaration.get("priority", 0),
+                declaration.get("volume", 1.0),
+                declaration.get("cooldown", 0))
+            for name, declaration in categories.items()
+        }
+
+    def __getitem__(self, name: str) -> SoundCategory:
+        return self.categories[name]
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.categories
+
+
+class AudioManager:
+    """
+    Plays sound bank categories on a limited number of voices
+    """
+    def __init__(self, bank: SoundBank, voices: int = 8):
+        self.bank = bank
+
+        pygame.mixer.set_num_channels(voices)
+        self.channels = [pygame.mixer.Channel(i) for i in range(voices)]
+        self._voices: list[Optional[tuple[int, int]]] = [None] * voices
+
+        # Engine clock in milliseconds
+        self.time = 0
+        self._timers: dict[str, int] = {}
+        self._scheduled: list[tuple[int, str]] = []
+
+        self.played = 0
+        self.stolen = 0
+        self.dropped = 0
+
+    def _find_voice(self, priority: int) -> Optional[int]:
+        steal = None
+
+        for i, channel in enumerate(self.channels):
+            if not channel.get_busy():
+                return i
+
+            # Channels used outside the manager count as lowest priority
+            voice = self._voices[i] or (0, 0)
+            if voice[0] <= priority:
+                if steal is None or voice < (self._voices[steal] or (0, 0)):
+                    steal = i
+
+        return steal
+
+    def play(self, name: str, priority: int = None) -> Optional[pygame.mixer.Channel]:
+        """
+        Returns the channel the sound is played on or None if no voice could be taken
+        """
+        category = self.bank[name]
+        if priority is None: priority = category.priority
+
+        i = self._find_voice(priority)
+        if i is None:
+            self.dropped += 1
+            return None
+
+        channel = self.channels[i]
+        if channel.get_busy():
+            channel.stop()
+            self.stolen += 1
+
+        channel.set_volume(category.volume)
+        channel.play(category.pick())
+        self._voices[i] = (priority, self.time)
+        self.played += 1
+
+        return channel
+
+    def trigger(self, name: str, timer: str = None) -> Optional[pygame.mixer.Channel]:
+        """
+        Play the category if its cooldown has passed on the engine clock,
+        categories passing the same 'timer' share one cooldown. The cooldown
+        only restarts when a voice actually plays.
+        """
+        if timer is None: timer = name
+        last = self._timers.get(timer)
+
+        if last is not None and self.time - last < self.bank[name].cooldown:
+            return None
+
+        channel = self.play(name)
+        if channel is not None: self._timers[timer] = self.time
+        return channel
+
+    def schedule(self, name: str, delay: int):
+        """
+        Play the category 'delay' milliseconds from now on the engine clock
+        """
+        self._scheduled.append((self.time + delay, name))
+
+    def update(self, dt: int):
+        """
+        Advance the engine clock by 'dt' milliseconds and play due sounds
+        """
+        self.time += dt
+
+        if self._scheduled:
+            due = [name for when, name in self._scheduled if when <= self.time]
+            self._scheduled = [(when, name) for when, name in self._scheduled if when > self.time]
+            for name in due:
+                self.play(name)
+
+    def stop(self):
+        for channel in self.channels:
+            channel.stop()
+        self._voices = [None] * len(self.channels)
@@ -0,0 +1,306 @@
+"""
+Static geometry batching
+
+Models marked static are transformed into world space once and merged into
+indexed vertex buffers shared by every model with the same material (program,
+texture and roughness) in the same cell of the world. Each of these chunks is drawn
+with a single call, after culling its bounding box against the camera frustum.
+
+Changing or removing a static model only rebuilds the chunk it was in, the
+rebuild happens on the next render().
+"""
+
+from typing import Optional, Union
+
+from math import floor
+import numpy
+import moderngl
+
+from .model import BaseModel, ModelGroup, PROGRAMS, _compile_programs, _write_camera, _bind_environment
+from .camera import Camera
+from .light import BasicLight
+from .pack import AssetPack
+from .occlusion import OcclusionCuller
+from .probes import ReflectionProbes
+from .resources import Disposable, track, retain, release
+from .utils import rotation_matrix, frustum_planes, boxes_in_frustum
+
+
+class BatchChunk(Disposable):
+    """
+    Merged geometry of the static models sharing a material in one cell
+    """
+    def __init__(self, key: tuple, program: moderngl.Program, texture: moderngl.Texture, roughness: float = 0.0):
+        self.key = key
+        self.program = retain(program)
+        self.texture = texture
+        self.roughness = roughness
+        self.models: list[BaseModel] = []
+
+        self.vao: Optional[moderngl.VertexArray] = None
+        self.vbo: Optional[moderngl.Buffer] = None
+        self.ibo: Optional[moderngl.Buffer] = None
+
+        self.vertex_count = 0
+        self.index_count = 0
+        self.bounds = (numpy.zeros(3), numpy.zeros(3))
+        self.dirty = True
+
+    def gpu_size(self) -> int:
+        if self.vbo is None: return 0
+        return self.vbo.size + self.ibo.size
+
+    def build(self, ctx: moderngl.Context):
+        """
+        Pre-transform the models' vertices, remove duplicates and upload
+        """
+        self._release_geometry()
+        self.dirty = False
+
+        vertices = []
+        for model in self.models:
+            positions = model.world_vertices()
+
+            # The vertex shaders rotate normals but don't scale them
+            normals = numpy.asarray(model.norm_coords, dtype=numpy.float32).reshape(-1, 3)
+            normals = normals @ rotation_matrix(model.rotation).T
+
+            uv = numpy.asarray(model.texture_coords, dtype=numpy.float32).reshape(-1, 2)
+
+            vertices.append(numpy.hstack((positions, uv, normals)).astype(numpy.float32))
+
+        vertices = numpy.concatenate(vertices)
+        vertices, indices = numpy.unique(vertices, axis=0, return_inverse=True)
+
+        self.vertex_count = len(vertices)
+        self.index_count = indices.size
+        self.bounds = (vertices[:, :3].min(axis=0), vertices[:, :3].max(axis=0))
+
+        self.vbo = track(ctx.buffer(numpy.ascontiguousarray(vertices)), self)
+        self.ibo = track(ctx.buffer(indices.reshape(-1).astype(numpy.uint32)), self)
+
+        if "a_normal" in self.program:
+            content = [(self.vbo, "3f 2f 3f", "a_position", "a_texture", "a_normal")]
+        else:
+            content = [(self.vbo, "3f 2f 12x", "a_position", "a_texture")]
+
+        self.vao = track(ctx.vertex_array(self.program, content, index_buffer=self.ibo, index_element_size=4), self)
+
+    def _release_geometry(self):
+        if self.vao is not None:
+            release(self.vao)
+            release(self.vbo)
+            release(self.ibo)
+
+        self.vao = None
+        self.vbo = None
+        self.ibo = None
+
+    def dispose(self):
+        self._release_geometry()
+        release(self.program)
+
+
+class StaticBatcher(Disposable):
+    """
+    Draws static models in merged chunks
+
+    'cell_size' is the side of the square world cells on the XZ plane that
+    chunks are split by, it's the granularity of both culling and rebuilds.
+    """
+    def __init__(self, ctx: moderngl.Context, cell_size: float = 50.0, pack: AssetPack = None):
+        self.ctx = ctx
+        self.cell_size = cell_size
+
+        _compile_programs(ctx, pack=pack)
+
+        self.chunks: dict[tuple, BatchChunk] = {}
+        self.models: dict[BaseModel, Optional[BatchChunk]] = {}
+
+        # Chunk bounds as arrays for culling, rebuilt when chunks change
+        self._chunk_list: list[BatchChunk] = []
+        self._mins = numpy.zeros((0, 3))
+        self._maxs = numpy.zeros((0, 3))
+        self._bounds_dirty = True
+
+        self.draw_calls = 0
+        self.culled = 0
+        self.occluded = 0
+        self.rebuilds = 0
+
+    def _program(self, model: BaseModel) -> str:
+        if model.program_name == "default": return "batched"
+        if model.program_name == "unlit": return "batched_unlit"
+        raise ValueError(f"{type(model).__name__} can't be batched")
+
+    def _key(self, model: BaseModel) -> tuple:
+        x, _, z = model.posmat[3][:3]
+        cell = (floor(x / self.cell_size), floor(z / self.cell_size))
+        return (self._program(model), model.texture.glo, model.roughness, cell)
+
+    def _insert(self, model: BaseModel):
+        key = self._key(model)
+
+        chunk = self.chunks.get(key)
+        if chunk is None:
+            chunk = BatchChunk(key, PROGRAMS[key[0]], model.texture, model.roughness)
+            self.chunks[key] = chunk
+            self._bounds_dirty = True
+
+        chunk.models.append(model)
+        chunk.dirty = True
+        self.models[model] = chunk
+
+    def _extract(self, model: BaseModel):
+        chunk = self.models.get(model)
+        if chunk is None: return
+
+        chunk.models.remove(model)
+        chunk.dirty = True
+        self.models[model] = None
+
+        if not chunk.models:
+            chunk.dispose()
+            del self.chunks[chunk.key]
+            self._bounds_dirty = True
+
+    def add(self, model: Union[BaseModel, ModelGroup]):
+        """
+        Mark the model static and draw it as part of its chunk, a group's
+        models are batched where the group places them
+        """
+        if isinstance(model, ModelGroup):
+            model.transform_matrix()
+            for part in model.models: self._program(part)
+            for part in model.models: self.add(part)
+            return
+
+        self._program(model)
+
+        model.batcher = self
+        self.models[model] = None
+        model._static = True
+        self._insert(model)
+
+    def remove(self, model: Union[BaseModel, ModelGroup]):
+        """
+        Stop batching the model, it's drawn on its own again
+        """
+        if isinstance(model, ModelGroup):
+            for part in model.models: self.remove(part)
+            return
+
+        if model not in self.models: return
+
+        self._extract(model)
+        del self.models[model]
+        model.batcher = None
+        model._static = False
+
+    def update(self, model: BaseModel):
+        """
+        Called when the model is marked static or non-static, call it directly
+        to move a static model without leaving its batch
+        """
+        self._extract(model)
+        if model.static: self._insert(model)
+
+    def _rebuild(self):
+        for chunk in self.chunks.values():
+            if chunk.dirty:
+                chunk.build(self.ctx)
+                self.rebuilds += 1
+                self._bounds_dirty = True
+
+        if self._bounds_dirty:
+            # Sorted by material so consecutive draws share programs and textures
+            self._chunk_list = sorted(self.chunks.values(), key=lambda c: c.key[:2])
+            self._mins = numpy.array([c.bounds[0] for c in self._chunk_list]).reshape(-1, 3)
+            self._maxs = numpy.array([c.bounds[1] for c in self._chunk_list]).reshape(-1, 3)
+            self._bounds_dirty = False
+
+    def visible_chunks(self, camera: Camera, culler: OcclusionCuller = None) -> list[BatchChunk]:
+        """
+        Chunks in the camera's frustum, and not hidden behind the occluders
+        of 'culler' if given (it must have begun the frame with 'camera')
+        """
+        self._rebuild()
+        self.occluded = 0
+        if not self._chunk_list: return []
+
+        if culler is not None:
+            occluded = culler.occluded
+            visible = culler.test_boxes(self._mins, self._maxs)
+            self.occluded = culler.occluded - occluded
+        else:
+            camera.update_matrices()
+            visible = boxes_in_frustum(frustum_planes(camera.view_projection), self._mins, self._maxs)
+
+        return [chunk for chunk, v in zip(self._chunk_list, visible) if v]
+
+    def render(self,
+            camera: Camera,
+            light_source: BasicLight = None,
+            skybox=None,
+            culler: OcclusionCuller = None,
+            probes: ReflectionProbes = None):
+        """
+        Draw the visible chunks, each reflecting the probe nearest its center
+        if 'probes' is given and 'skybox' otherwise
+        """
+        chunks = self.visible_chunks(camera, culler)
+
+        self.draw_calls = len(chunks)
+        self.culled = len(self._chunk_list) - len(chunks)
+
+        program = None
+        texture = None
+        environment = None
+        for chunk in chunks:
+            if chunk.program is not program:
+                program = chunk.program
+                environment = None
+                _write_camera(program, camera)
+
+                if light_source is not None and "lightpos" in program:
+                    program["lightpos"].value = tuple(light_source.position.tolist())
+                    program["color"].value = light_source.color
+                    program["ambient_intensity"].value = light_source.ambient_intensity
+                    program["diffuse_intensity"].value = light_source.diffuse_intensity
+                    program["specular_intensity"].value = light_source.specular_intensity
+                    program["specular_power"].value = light_source.specular_power
+
+            if chunk.texture is not texture:
+                texture = chunk.texture
+                texture.use(location=0)
+
+            chunk_environment = skybox
+            if probes is not None:
+                chunk_environment = probes.environment((chunk.bounds[0] + chunk.bounds[1]) * 0.5, skybox)
+
+            if (chunk_environment, chunk.roughness) != environment:
+                environment = (chunk_environment, chunk.roughness)
+                _bind_environment(program, chunk_environment, chunk.roughness)
+
+            chunk.vao.render()
+
+    def stats(self) -> dict:
+        return {
+            "models": sum(chunk is not None for chunk in self.models.values()),
+            "chunks": len(self.chunks),
+            "draw_calls": self.draw_calls,
+            "culled_chunks": self.culled,
+            "occluded_chunks": self.occluded,
+            "rebuilds": self.rebuilds,
+            "vertices": sum(c.vertex_count for c in self.chunks.values()),
+            "gpu_bytes": sum(c.gpu_size() for c in self.chunks.values())
+        }
+
+    def dispose(self):
+        for model in list(self.models):
+            self.remove(model)
+
+        for chunk in self.chunks.values():
+            chunk.dispose()
+        self.chunks.clear()
+        self._bounds_dirty = True
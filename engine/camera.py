@@ -1,45 +1,93 @@
-from math import sin, cos, radians
+from math import sin, cos, radians, sqrt
+from itertools import count
+import numpy
 import pygame
 import pyrr
 
+from .collision import Capsule
+
 
 class Camera:
     """
     Base camera class
+
+    Position, basis vectors and matrices are preallocated float32 arrays that
+    are updated in place. Matrices are only rebuilt when yaw, pitch, fov or
+    final_position changed, and 'version' changes every time they are, so
+    consumers can skip re-uploading uniforms.
     """
+
+    _versions = count(1)
+
     def __init__(self,
             aspect_ratio: float,
             fov: float = 80.0,
             position: tuple[float, float, float] = (0.0, 0.0, 0.0),
-            ortho: bool = False):
+            ortho: bool = False,
+            ortho_size: float = 720.0):
 
         self.ortho = ortho
+        # Height of the orthographic view volume, its width follows the aspect ratio
+        self.ortho_size = ortho_size
+
+        self._position = pyrr.Vector3(position, dtype=numpy.float32)
+        self._final_position = pyrr.Vector3(position, dtype=numpy.float32)
+        self.front = pyrr.Vector3([0.0, 0.0, -1.0], dtype=numpy.float32)
+        self.up    = pyrr.Vector3([0.0, 1.0, 0.0], dtype=numpy.float32)
+        self.right = pyrr.Vector3([1.0, 0.0, 0.0], dtype=numpy.float32)
 
-        self.aspect_ratio = aspect_ratio
+        self.projection = numpy.zeros((4, 4), dtype=numpy.float32)
+        self.view = numpy.identity(4, dtype=numpy.float32)
+        self.view_projection = numpy.zeros((4, 4), dtype=numpy.float32)
+        self._view_eye = numpy.zeros(3, dtype=numpy.float32)
+
+        self._aspect_ratio = aspect_ratio
         self._fov = fov
-        self.fov = fov # create projection matrix
-        self.position = pyrr.Vector3(position)
+        self._yaw = -90
+        self._pitch = 0
 
-        self.final_position = pyrr.Vector3(position)
-        self.front = pyrr.Vector3([0.0, 0.0, -1.0])
-        self.up    = pyrr.Vector3([0.0, 1.0, 0.0])
-        self.right = pyrr.Vector3([1.0, 0.0, 0.0])
+        self._vectors_dirty = True
+        self._view_dirty = True
+        self._projection_dirty = True
+        self.version = 0
 
-        self.yaw = -90
-        self.pitch = 0
+        self.update_matrices()
 
-    def get_view_matrix(self):
-        return pyrr.matrix44.create_look_at(self.final_position, self.final_position + self.front, self.up)
+    @property
+    def position(self) -> pyrr.Vector3:
+        return self._position
 
-    def update_vectors(self):
-        front = pyrr.Vector3([0.0, 0.0, 0.0])
-        front.x = cos(radians(self.yaw)) * cos(radians(self.pitch))
-        front.y = sin(radians(self.pitch))
-        front.z = sin(radians(self.yaw)) * cos(radians(self.pitch))
+    @position.setter
+    def position(self, value):
+        self._position[:] = value
+
+    @property
+    def final_position(self) -> pyrr.Vector3:
+        return self._final_position
 
-        self.front = pyrr.vector.normalise(front)
-        self.right = pyrr.vector.normalise(pyrr.vector3.cross(self.front, pyrr.Vector3([0.0, 1.0, 0.0])))
-        self.up    = pyrr.vector.normalise(pyrr.vector3.cross(self.right, self.front))
+    @final_position.setter
+    def final_position(self, value):
+        self._final_position[:] = value
+
+    @property
+    def yaw(self) -> float:
+        return self._yaw
+
+    @yaw.setter
+    def yaw(self, value: float):
+        if value != self._yaw:
+            self._yaw = value
+            self._vectors_dirty = True
+
+    @property
+    def pitch(self) -> float:
+        return self._pitch
+
+    @pitch.setter
+    def pitch(self, value: float):
+        if value != self._pitch:
+            self._pitch = value
+            self._vectors_dirty = True
 
     @property
     def fov(self):
@@ -48,10 +96,120 @@ class Camera:
     @fov.setter
     def fov(self, new_fov):
         self._fov = new_fov
+        self._projection_dirty = True
+
+    @property
+    def aspect_ratio(self) -> float:
+        return self._aspect_ratio
+
+    @aspect_ratio.setter
+    def aspect_ratio(self, value: float):
+        self._aspect_ratio = value
+        self._projection_dirty = True
+
+    def get_view_matrix(self) -> numpy.ndarray:
+        """
+        The cached view matrix, copy it before modifying
+        """
+        self.update_matrices()
+        return self.view
+
+    def update_vectors(self):
+        if not self._vectors_dirty: return
+
+        yaw = radians(self._yaw)
+        pitch = radians(self._pitch)
+        fx = cos(yaw) * cos(pitch)
+        fy = sin(pitch)
+        fz = sin(yaw) * cos(pitch)
+
+        # right = normalize(front x world up), kept as is when looking straight up or down
+        length = sqrt(fx*fx + fz*fz)
+        if length > 1e-9:
+            rx = -fz / length
+            rz = fx / length
+        else:
+            rx = float(self.right[0])
+            rz = float(self.right[2])
+
+        front = self.front
+        right = self.right
+        up = self.up
+        front[0] = fx
+        front[1] = fy
+        front[2] = fz
+        right[0] = rx
+        right[1] = 0.0
+        right[2] = rz
+        # up = right x front, unit length already
+        up[0] = -rz * fy
+        up[1] = rz * fx - rx * fz
+        up[2] = rx * fy
+
+        self._vectors_dirty = False
+        self._view_dirty = True
+
+    def _update_projection(self):
         if self.ortho:
-            self.projection = pyrr.matrix44.create_orthogonal_projection_matrix(0, 1280, 720, 0, 0.1, 100)
+            self.projection[:] = pyrr.matrix44.create_orthogonal_projection_matrix(
+                0, self.ortho_size * self._aspect_ratio, self.ortho_size, 0, 0.1, 100)
         else:
-            self.projection = pyrr.matrix44.create_perspective_projection_matrix(self._fov, self.aspect_ratio, 0.1, 1000)
+            self.projection[:] = pyrr.matrix44.create_perspective_projection_matrix(
+                self._fov, self._aspect_ratio, 0.1, 1000)
+
+        self._projection_dirty = False
+
+    def _update_view(self):
+        """
+        Look-at matrix (in pyrr's row vector layout) built from the basis vectors
+        """
+        view = self.view
+        eye = self._final_position
+        s = self.right
+        u = self.up
+        f = self.front
+
+        ex = float(eye[0])
+        ey = float(eye[1])
+        ez = float(eye[2])
+
+        view[0, 0] = s[0]
+        view[1, 0] = s[1]
+        view[2, 0] = s[2]
+        view[0, 1] = u[0]
+        view[1, 1] = u[1]
+        view[2, 1] = u[2]
+        view[0, 2] = -f[0]
+        view[1, 2] = -f[1]
+        view[2, 2] = -f[2]
+        view[3, 0] = -(s[0]*ex + s[1]*ey + s[2]*ez)
+        view[3, 1] = -(u[0]*ex + u[1]*ey + u[2]*ez)
+        view[3, 2] = f[0]*ex + f[1]*ey + f[2]*ez
+
+        self._view_eye[0] = ex
+        self._view_eye[1] = ey
+        self._view_eye[2] = ez
+        self._view_dirty = False
+
+    def update_matrices(self) -> int:
+        """
+        Rebuild whatever changed and return the current version
+        """
+        self.update_vectors()
+
+        eye = self._final_position
+        last_eye = self._view_eye
+        moved = eye[0] != last_eye[0] or eye[1] != last_eye[1] or eye[2] != last_eye[2]
+
+        if not (self._view_dirty or self._projection_dirty or moved):
+            return self.version
+
+        if self._projection_dirty: self._update_projection()
+        self._update_view()
+        numpy.matmul(self.view, self.projection, out=self.view_projection)
+
+        self.version = next(Camera._versions)
+        return self.version
 
 
 class FirstPersonController(Camera):
@@ -68,12 +226,18 @@ class FirstPersonController(Camera):
         self.velocity = pyrr.Vector3([0.0, 0.0, 0.0])
         self.jump_height = 0.2
 
+        self._previous_position = pyrr.Vector3(position, dtype=numpy.float32)
+
         self.movement_speed = movement_speed
         self._default_movement_speed = movement_speed
         self.mouse_sensitivity = 0.17
 
         self.noclip = False
 
+        # Without a collision world the ground is a constant plane
+        self.collision_world = None
+        self.collider = Capsule()
+
         self.on_ground = False
         self.is_sprinting = False
         self.is_ducking = False
@@ -97,7 +261,13 @@ class FirstPersonController(Camera):
             offset_y: float,
             events: list[pygame.event.Event],
             keys: list[int],
-            constrain_pitch: bool = True):
+            constrain_pitch: bool = True,
+            ticks: int = None):
+        """
+        Apply a frame of mouse movement, events and held keys. Head bobbing is
+        timed with 'ticks' in milliseconds, pygame.time.get_ticks() if not
+        given, so replayed input bobs the same way it was recorded.
+        """
 
         offset_x *= self.mouse_sensitivity
         offset_y *= self.mouse_sensitivity
@@ -151,6 +321,8 @@ class FirstPersonController(Camera):
                     self.on_ground = False
 
         self.is_walking = False
+        previous_position = self._previous_position
+        previous_position[:] = self.position
 
         if keys[self.key_map["forward"]]:
             self.is_walking = True
@@ -183,27 +355,52 @@ class FirstPersonController(Camera):
         if self.noclip and keys[self.key_map["down"]]:
             self.position -= self.up * self.movement_speed
 
-        self.final_position = self.position.copy()
-
         # Applying gravity
         if not self.noclip:
             self.velocity.y += 0.008
-        
-            if self.position.y - self.velocity.y < -2.1:
-                self.velocity.y = 0
-                self.on_ground = True
 
-            self.position.y -= self.velocity.y
+            if self.collision_world is None:
+                if self.position.y - self.velocity.y < -2.1:
+                    self.velocity.y = 0
+                    self.on_ground = True
+
+                self.position.y -= self.velocity.y
 
-            if self.is_ducking:
-                self.final_position.y = self.position.y - 0.9
             else:
-                self.final_position.y = self.position.y
+                self.position.y -= self.velocity.y
+                self.collide(previous_position)
+
+        final_position = self.final_position
+        final_position[:] = self.position
+
+        if not self.noclip and self.is_ducking:
+            final_position[1] -= 0.9
 
         # Head obbing
         if not self.noclip and self.is_walking and not self.is_ducking:
             if self.is_sprinting: bobbing_factor = 2.14
             else: bobbing_factor = 1.4
 
-            self.final_position += self.right * sin(pygame.time.get_ticks()*bobbing_factor*0.005) / 3
-            self.final_position.y += cos(pygame.time.get_ticks()*(bobbing_factor*2)*0.005) / 5
\ No newline at end of file
+            if ticks is None: ticks = pygame.time.get_ticks()
+            sway = sin(ticks*bobbing_factor*0.005) / 3
+            final_position[0] += self.right[0] * sway
+            final_position[1] += self.right[1] * sway + cos(ticks*(bobbing_factor*2)*0.005) / 5
+            final_position[2] += self.right[2] * sway
+
+    def collide(self, previous_position: pyrr.Vector3):
+        """
+        Resolve this frame's movement against the collision world
+        """
+        position, contact = self.collision_world.move_capsule(
+            self.collider, previous_position, self.position - previous_position)
+
+        self.position.x, self.position.y, self.position.z = position
+
+        if contact.ground:
+            if self.velocity.y > 0: self.velocity.y = 0
+            self.on_ground = True
+        else:
+            self.on_ground = False
+
+        if contact.ceiling and self.velocity.y < 0:
+            self.velocity.y = 0
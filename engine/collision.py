@@ -0,0 +1,532 @@
+"""
+Collision detection
+
+Static geometry is stored in triangle BVHs built from loaded meshes, moving
+bodies are capsules tracked in a uniform grid broadphase. Narrowphase tests
+run over all candidate triangles at once with NumPy.
+"""
+
+from math import ceil, sqrt, floor
+import numpy
+
+
+def _dot(a: numpy.ndarray, b: numpy.ndarray) -> numpy.ndarray:
+    return numpy.einsum("...i,...i->...", a, b)
+
+
+def closest_points_on_triangles(
+        p: numpy.ndarray,
+        a: numpy.ndarray,
+        b: numpy.ndarray,
+        c: numpy.ndarray) -> numpy.ndarray:
+    """
+    Closest point on each triangle (a, b, c) to the point(s) p
+
+    Vectorized form of the Voronoi region test from Ericson's
+    "Real-Time Collision Detection", section 5.1.5.
+    """
+    ab = b - a
+    ac = c - a
+    p = numpy.broadcast_to(p, a.shape)
+
+    # All six edge/point dot products in one pass
+    d = numpy.einsum("i...j,k...j->ik...", numpy.stack((ab, ac)), numpy.stack((p - a, p - b, p - c)))
+    d1, d3, d5 = d[0]
+    d2, d4, d6 = d[1]
+
+    va = d3*d6 - d5*d4
+    vb = d5*d2 - d1*d6
+    vc = d1*d4 - d3*d2
+
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        denom = 1.0 / (va + vb + vc)
+        result = a + ab * (vb*denom)[..., None] + ac * (vc*denom)[..., None]
+
+        # Regions are written from last to first so earlier tests take precedence
+        mask = (va <= 0) & (d4 - d3 >= 0) & (d5 - d6 >= 0)
+        w = (d4 - d3) / ((d4 - d3) + (d5 - d6))
+        result = numpy.where(mask[..., None], b + (c - b) * w[..., None], result)
+
+        mask = (vb <= 0) & (d2 >= 0) & (d6 <= 0)
+        w = d2 / (d2 - d6)
+        result = numpy.where(mask[..., None], a + ac * w[..., None], result)
+
+        mask = (d6 >= 0) & (d5 <= d6)
+        result = numpy.where(mask[..., None], c, result)
+
+        mask = (vc <= 0) & (d1 >= 0) & (d3 <= 0)
+        v = d1 / (d1 - d3)
+        result = numpy.where(mask[..., None], a + ab * v[..., None], result)
+
+        mask = (d3 >= 0) & (d4 <= d3)
+        result = numpy.where(mask[..., None], b, result)
+
+        mask = (d1 <= 0) & (d2 <= 0)
+        result = numpy.where(mask[..., None], a, result)
+
+    return result
+
+
+class TriangleBVH:
+    """
+    Bounding volume hierarchy over an (n, 3, 3) array of triangles
+
+    Triangles are reordered so every node covers a contiguous range,
+    'indices' maps them back to the input order.
+    """
+    def __init__(self, triangles: numpy.ndarray, leaf_size: int = 8):
+        triangles = numpy.asarray(triangles, dtype=numpy.float64).reshape(-1, 3, 3)
+        self.leaf_size = leaf_size
+
+        n = len(triangles)
+        self._order = numpy.arange(n)
+        self._tri_min = triangles.min(axis=1)
+        self._tri_max = triangles.max(axis=1)
+        self._centroids = triangles.mean(axis=1)
+
+        self._mins = []
+        self._maxs = []
+        self._starts = []
+        self._counts = []
+        self._lefts = []
+        self._rights = []
+
+        if n > 0: self._build(0, n)
+
+        self.indices = self._order
+        self.triangles = triangles[self._order]
+
+        normals = numpy.cross(self.triangles[:, 1] - self.triangles[:, 0], self.triangles[:, 2] - self.triangles[:, 0])
+        with numpy.errstate(divide="ignore", invalid="ignore"):
+            self.normals = normals / numpy.linalg.norm(normals, axis=1)[:, None]
+        self.node_min = numpy.array(self._mins).reshape(-1, 3)
+        self.node_max = numpy.array(self._maxs).reshape(-1, 3)
+        self.node_start = numpy.array(self._starts, dtype=numpy.int64)
+        self.node_count = numpy.array(self._counts, dtype=numpy.int64)
+        self.node_left = numpy.array(self._lefts, dtype=numpy.int64)
+        self.node_right = numpy.array(self._rights, dtype=numpy.int64)
+
+        del self._order, self._tri_min, self._tri_max, self._centroids
+        del self._mins, self._maxs, self._starts, self._counts, self._lefts, self._rights
+
+    def _build(self, start: int, end: int) -> int:
+        idx = self._order[start:end]
+
+        node = len(self._mins)
+        self._mins.append(self._tri_min[idx].min(axis=0))
+        self._maxs.append(self._tri_max[idx].max(axis=0))
+        self._starts.append(start)
+        self._counts.append(end - start)
+        self._lefts.append(-1)
+        self._rights.append(-1)
+
+        if end - start <= self.leaf_size:
+            return node
+
+        # Median split on the longest axis of the centroid bounds
+        centroids = self._centroids[idx]
+        axis = numpy.argmax(centroids.max(axis=0) - centroids.min(axis=0))
+        mid = (end - start) // 2
+        self._order[start:end] = idx[numpy.argpartition(centroids[:, axis], mid)]
+
+        self._lefts[node] = self._build(start, start + mid)
+        self._rights[node] = self._build(start + mid, end)
+        return node
+
+    def __len__(self) -> int:
+        return len(self.triangles)
+
+    @property
+    def bounds(self) -> tuple[numpy.ndarray, numpy.ndarray]:
+        return self.node_min[0], self.node_max[0]
+
+    def query_aabb(self, lo: numpy.ndarray, hi: numpy.ndarray) -> numpy.ndarray:
+        """
+        Indices (into self.triangles) of triangles whose bounds overlap the box
+        """
+        if len(self.triangles) == 0:
+            return numpy.empty(0, dtype=numpy.int64)
+
+        node_min = self.node_min
+        node_max = self.node_max
+        lx, ly, lz = lo
+        hx, hy, hz = hi
+
+        ranges = []
+        stack = [0]
+        while stack:
+            node = stack.pop()
+            nmin = node_min[node]
+            nmax = node_max[node]
+            if (nmin[0] > hx or nmin[1] > hy or nmin[2] > hz or
+                nmax[0] < lx or nmax[1] < ly or nmax[2] < lz):
+                continue
+
+            left = self.node_left[node]
+            if left < 0:
+                start = self.node_start[node]
+                ranges.append(numpy.arange(start, start + self.node_count[node]))
+            else:
+                stack.append(left)
+                stack.append(self.node_right[node])
+
+        if not ranges:
+            return numpy.empty(0, dtype=numpy.int64)
+        return numpy.concatenate(ranges)
+
+
+class Capsule:
+    """
+    Moving body, a vertical capsule whose bottom is at position + offset
+    """
+    def __init__(self,
+            radius: float = 0.4,
+            height: float = 3.1,
+            offset: tuple[float, float, float] = (0.0, -2.9, 0.0),
+            position: tuple[float, float, float] = (0.0, 0.0, 0.0)):
+
+        self.radius = radius
+        self.height = height
+        self.offset = numpy.array(offset, dtype=numpy.float64)
+        self.position = numpy.array(position, dtype=numpy.float64)
+
+    def segment(self, position: numpy.ndarray = None) -> tuple[numpy.ndarray, numpy.ndarray]:
+        if position is None: position = self.position
+        bottom = position + self.offset
+        return (bottom + (0.0, self.radius, 0.0), bottom + (0.0, self.height - self.radius, 0.0))
+
+    def aabb(self, position: numpy.ndarray = None) -> tuple[numpy.ndarray, numpy.ndarray]:
+        a, b = self.segment(position)
+        return numpy.minimum(a, b) - self.radius, numpy.maximum(a, b) + self.radius
+
+
+class Contact:
+    """
+    Result of moving a capsule through the world
+    """
+
+    # Contacts with normals steeper than this are walkable ground
+    GROUND_SLOPE = 0.7
+
+    def __init__(self):
+        self.hit = False
+        self.ground = False
+        self.ceiling = False
+        self.normal = numpy.zeros(3)
+
+    def add(self, normal: numpy.ndarray):
+        self.hit = True
+        self.normal = normal
+        if normal[1] > Contact.GROUND_SLOPE: self.ground = True
+        if normal[1] < -Contact.GROUND_SLOPE: self.ceiling = True
+
+
+class UniformGrid:
+    """
+    Spatial hash of axis-aligned boxes, the broadphase for moving bodies
+    """
+    def __init__(self, cell_size: float = 4.0):
+        self.cell_size = cell_size
+        self.cells: dict[tuple[int, int, int], set] = {}
+        self._objects: dict[object, list[tuple[int, int, int]]] = {}
+
+    def _cells(self, lo: numpy.ndarray, hi: numpy.ndarray) -> list[tuple[int, int, int]]:
+        s = self.cell_size
+        x0, y0, z0 = (floor(v / s) for v in lo)
+        x1, y1, z1 = (floor(v / s) for v in hi)
+        return [(x, y, z)
+            for x in range(x0, x1+1)
+            for y in range(y0, y1+1)
+            for z in range(z0, z1+1)]
+
+    def insert(self, obj, lo: numpy.ndarray, hi: numpy.ndarray):
+        cells = self._cells(lo, hi)
+        self._objects[obj] = cells
+        for cell in cells:
+            self.cells.setdefault(cell, set()).add(obj)
+
+    def remove(self, obj):
+        for cell in self._objects.pop(obj, ()):
+            members = self.cells[cell]
+            members.discard(obj)
+            if not members: del self.cells[cell]
+
+    def update(self, obj, lo: numpy.ndarray, hi: numpy.ndarray):
+        cells = self._cells(lo, hi)
+        if self._objects.get(obj) == cells: return
+        self.remove(obj)
+        self.insert(obj, lo, hi)
+
+    def __contains__(self, obj) -> bool:
+        return obj in self._objects
+
+    def query(self, lo: numpy.ndarray, hi: numpy.ndarray) -> set:
+        found = set()
+        for cell in self._cells(lo, hi):
+            found.update(self.cells.get(cell, ()))
+        return found
+
+    def pairs(self) -> set[tuple]:
+        pairs = set()
+        for members in self.cells.values():
+            if len(members) < 2: continue
+            members = sorted(members, key=id)
+            for i, a in enumerate(members):
+                for b in members[i+1:]:
+                    pairs.add((a, b))
+        return pairs
+
+
+def _closest_on_segments(a0, a1, b0, b1) -> tuple[numpy.ndarray, numpy.ndarray]:
+    d1 = a1 - a0
+    d2 = b1 - b0
+    r = a0 - b0
+    a = d1 @ d1
+    e = d2 @ d2
+    f = d2 @ r
+    c = d1 @ r
+    b = d1 @ d2
+    denom = a*e - b*b
+
+    s = min(max((b*f - c*e) / denom, 0.0), 1.0) if denom > 1e-12 else 0.0
+    t = (b*s + f) / e if e > 1e-12 else 0.0
+    if t < 0.0:
+        t = 0.0
+        s = min(max(-c / a, 0.0), 1.0) if a > 1e-12 else 0.0
+    elif t > 1.0:
+        t = 1.0
+        s = min(max((b - c) / a, 0.0), 1.0) if a > 1e-12 else 0.0
+
+    return a0 + d1*s, b0 + d2*t
+
+
+class CollisionWorld:
+    """
+    Static triangle meshes and dynamic capsule bodies
+    """
+    def __init__(self, cell_size: float = 4.0, iterations: int = 3):
+        self.iterations = iterations
+
+        self.meshes: dict[object, TriangleBVH] = {}
+        self._mesh_keys: list = []
+        self._mesh_min = numpy.empty((0, 3))
+        self._mesh_max = numpy.empty((0, 3))
+
+        self.bodies: list[Capsule] = []
+        self.grid = UniformGrid(cell_size)
+
+    def _update_bounds(self):
+        self._mesh_keys = list(self.meshes.keys())
+        if not self._mesh_keys:
+            self._mesh_min = numpy.empty((0, 3))
+            self._mesh_max = numpy.empty((0, 3))
+            return
+
+        self._mesh_min = numpy.array([self.meshes[k].bounds[0] for k in self._mesh_keys])
+        self._mesh_max = numpy.array([self.meshes[k].bounds[1] for k in self._mesh_keys])
+
+    def add_triangles(self, key, triangles: numpy.ndarray):
+        """
+        Add static geometry given as world space triangles, 'key' is used to remove it
+        """
+        triangles = numpy.asarray(triangles, dtype=numpy.float64).reshape(-1, 3, 3)
+
+        # Degenerate triangles have no normal to push out along
+        area = numpy.linalg.norm(numpy.cross(triangles[:, 1] - triangles[:, 0], triangles[:, 2] - triangles[:, 0]), axis=1)
+        triangles = triangles[area > 1e-12]
+        if len(triangles) == 0: return
+
+        self.meshes[key] = TriangleBVH(triangles)
+        self._update_bounds()
+
+    def add_model(self, model):
+        """
+        Add a loaded model as static geometry with its current transform
+        """
+        self.add_triangles(model, model.world_vertices().reshape(-1, 3, 3))
+
+    def remove(self, key):
+        if self.meshes.pop(key, None) is not None:
+            self._update_bounds()
+
+    def add_body(self, body: Capsule):
+        self.bodies.append(body)
+        self.grid.insert(body, *body.aabb())
+
+    def remove_body(self, body: Capsule):
+        self.bodies.remove(body)
+        self.grid.remove(body)
+
+    def query_triangles(self, lo: numpy.ndarray, hi: numpy.ndarray) -> tuple[numpy.ndarray, numpy.ndarray]:
+        """
+        All static triangles overlapping the box as an (n, 3, 3) array and their unit normals
+        """
+        overlap = numpy.all((self._mesh_min <= hi) & (self._mesh_max >= lo), axis=1)
+
+        triangles = []
+        normals = []
+        for i in numpy.flatnonzero(overlap):
+            bvh = self.meshes[self._mesh_keys[i]]
+            idx = bvh.query_aabb(lo, hi)
+            if len(idx):
+                triangles.append(bvh.triangles[idx])
+                normals.append(bvh.normals[idx])
+
+        if not triangles:
+            return numpy.empty((0, 3, 3)), numpy.empty((0, 3))
+        return numpy.concatenate(triangles), numpy.concatenate(normals)
+
+    def _resolve(self,
+            body: Capsule,
+            position: numpy.ndarray,
+            triangles: numpy.ndarray,
+            normals: numpy.ndarray,
+            contact: Contact) -> numpy.ndarray:
+        """
+        Push the capsule out of the candidate triangles, deepest contact first
+        """
+        r = body.radius
+        p0, p1 = body.segment(position)
+
+        # Triangles whose plane is further than the radius from both ends
+        # of the capsule axis (on the same side) can't touch it
+        h0 = _dot(normals, p0 - triangles[:, 0])
+        h1 = _dot(normals, p1 - triangles[:, 0])
+        near = (numpy.minimum(h0, h1) <= r) & (numpy.maximum(h0, h1) >= -r)
+        if not near.all():
+            triangles = triangles[near]
+            normals = normals[near]
+
+        if len(triangles) == 0:
+            return position
+
+        ta = triangles[:, 0]
+        tb = triangles[:, 1]
+        tc = triangles[:, 2]
+
+        for _ in range(self.iterations):
+            p0, p1 = body.segment(position)
+            d = p1 - p0
+
+            # Reference point: where the capsule axis meets each triangle plane,
+            # clamped to the segment and then to the triangle
+            nd = normals @ d
+            with numpy.errstate(divide="ignore", invalid="ignore"):
+                t = numpy.where(numpy.abs(nd) > 1e-9, _dot(normals, ta - p0) / nd, 0.0)
+            plane_points = p0 + d * numpy.clip(t, 0.0, 1.0)[:, None]
+            reference = closest_points_on_triangles(plane_points, ta, tb, tc)
+
+            # Closest point on the axis to the reference, then sphere vs triangle
+            s = numpy.clip((reference - p0) @ d / (d @ d), 0.0, 1.0)
+            centers = p0 + d * s[:, None]
+            closest = closest_points_on_triangles(centers, ta, tb, tc)
+
+            delta = centers - closest
+            dist = numpy.sqrt(_dot(delta, delta))
+            depth = r - dist
+
+            i = numpy.argmax(depth)
+            if depth[i] <= 1e-6: break
+
+            if dist[i] > 1e-9:
+                normal = delta[i] / dist[i]
+            else:
+                normal = normals[i] if normals[i] @ (centers[i] - ta[i]) >= 0 else -normals[i]
+
+            position = position + normal * depth[i]
+            contact.add(normal)
+
+            # A single contact is fully resolved by one push
+            if numpy.count_nonzero(depth > 1e-6) == 1: break
+
+        return position
+
+    def _resolve_bodies(self, body: Capsule, position: numpy.ndarray, contact: Contact) -> numpy.ndarray:
+        lo, hi = body.aabb(position)
+        a0, a1 = body.segment(position)
+
+        for other in self.grid.query(lo, hi):
+            if other is body: continue
+
+            b0, b1 = other.segment()
+            pa, pb = _closest_on_segments(a0, a1, b0, b1)
+            delta = pa - pb
+            dist = sqrt(delta @ delta)
+            depth = body.radius + other.radius - dist
+            if depth <= 0 or dist < 1e-9: continue
+
+            normal = delta / dist
+            position = position + normal * depth
+            a0 = a0 + normal * depth
+            a1 = a1 + normal * depth
+            contact.add(normal)
+
+        return position
+
+    def move_capsule(self,
+            body: Capsule,
+            start: numpy.ndarray,
+            delta: numpy.ndarray) -> tuple[numpy.ndarray, Contact]:
+        """
+        Move the capsule from 'start' by 'delta' resolving collisions along the way
+
+        The move is split into steps no longer than the radius so fast
+        bodies don't tunnel through thin geometry.
+        """
+        start = numpy.asarray(start, dtype=numpy.float64)
+        delta = numpy.asarray(delta, dtype=numpy.float64)
+        contact = Contact()
+
+        # One broadphase query for the whole swept volume
+        lo0, hi0 = body.aabb(start)
+        lo1, hi1 = body.aabb(start + delta)
+        lo = numpy.minimum(lo0, lo1)
+        hi = numpy.maximum(hi0, hi1)
+        triangles, normals = self.query_triangles(lo, hi)
+        tri_min = triangles.min(axis=1)
+        tri_max = triangles.max(axis=1)
+
+        steps = max(1, ceil(sqrt(delta @ delta) / (body.radius * 0.5)))
+        step = delta / steps
+        position = start
+
+        for _ in range(steps):
+            position = position + step
+
+            lo, hi = body.aabb(position)
+            near = numpy.all((tri_min <= hi) & (tri_max >= lo), axis=1)
+            if near.any():
+                position = self._resolve(body, position, triangles[near], normals[near], contact)
+
+        if self.bodies:
+            position = self._resolve_bodies(body, position, contact)
+
+        body.position = position
+        if body in self.grid:
+            self.grid.update(body, *body.aabb(position))
+
+        return position, contact
+
+    def step(self):
+        """
+        Separate overlapping dynamic bodies and push them out of static geometry
+        """
+        for a, b in self.grid.pairs():
+            a0, a1 = a.segment()
+            b0, b1 = b.segment()
+            pa, pb = _closest_on_segments(a0, a1, b0, b1)
+            delta = pa - pb
+            dist = sqrt(delta @ delta)
+            depth = a.radius + b.radius - dist
+            if depth <= 0 or dist < 1e-9: continue
+
+            push = delta / dist * (depth * 0.5)
+            a.position = a.position + push
+            b.position = b.position - push
+
+        for body in self.bodies:
+            lo, hi = body.aabb()
+            triangles, normals = self.query_triangles(lo, hi)
+            if len(triangles):
+                body.position = self._resolve(body, body.position, triangles, normals, Contact())
+            self.grid.update(body, *body.aabb())
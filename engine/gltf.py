@@ -0,0 +1,391 @@
+"""
+Reads glTF 2.0 files (.gltf with external or embedded buffers and .glb)
+
+Accessors are returned as NumPy arrays viewing the loaded buffers, matrices
+are converted to row-major (n, 4, 4) arrays transforming column vectors.
+Buffer views are memoryview slices of the loaded buffers, so vertex data can
+be uploaded to the GPU as it is in the file. Only what the engine uses is
+read: meshes with their skinning attributes and morph targets, base color
+materials, node hierarchy, skins and animations.
+"""
+
+from typing import Union, Optional, Iterator
+
+from pathlib import Path
+import io
+import json
+from urllib.parse import unquote
+import base64
+import struct
+import numpy
+import pygame
+
+
+GLB_MAGIC = b"glTF"
+GLB_JSON = 0x4E4F534A
+GLB_BIN = 0x004E4942
+
+COMPONENT_TYPES = {
+    5120: numpy.int8,
+    5121: numpy.uint8,
+    5122: numpy.int16,
+    5123: numpy.uint16,
+    5125: numpy.uint32,
+    5126: numpy.float32
+}
+
+# moderngl formats of the (componentType, normalized) pairs OpenGL can read
+# from a buffer as float attributes without converting them first
+VERTEX_FORMATS = {
+    (5126, False): "f",
+    (5121, True): "f1"
+}
+
+TYPE_SIZES = {
+    "SCALAR": 1,
+    "VEC2": 2,
+    "VEC3": 3,
+    "VEC4": 4,
+    "MAT2": 4,
+    "MAT3": 9,
+    "MAT4": 16
+}
+
+
+def quaternion_matrices(q: numpy.ndarray) -> numpy.ndarray:
+    """
+    (..., 4) quaternions in glTF's x, y, z, w order to (..., 3, 3) rotation matrices
+    """
+    x, y, z, w = q[..., 0], q[..., 1], q[..., 2], q[..., 3]
+
+    m = numpy.empty(q.shape[:-1] + (3, 3), dtype=q.dtype)
+    m[..., 0, 0] = 1 - 2*(y*y + z*z)
+    m[..., 0, 1] = 2*(x*y - z*w)
+    m[..., 0, 2] = 2*(x*z + y*w)
+    m[..., 1, 0] = 2*(x*y + z*w)
+    m[..., 1, 1] = 1 - 2*(x*x + z*z)
+    m[..., 1, 2] = 2*(y*z - x*w)
+    m[..., 2, 0] = 2*(x*z - y*w)
+    m[..., 2, 1] = 2*(y*z + x*w)
+    m[..., 2, 2] = 1 - 2*(x*x + y*y)
+    return m
+
+
+def trs_matrices(translation: numpy.ndarray, rotation: numpy.ndarray, scale: numpy.ndarray) -> numpy.ndarray:
+    """
+    (..., 4, 4) matrices from translations, quaternions and scales
+    """
+    m = numpy.zeros(translation.shape[:-1] + (4, 4), dtype=translation.dtype)
+    m[..., :3, :3] = quaternion_matrices(rotation) * scale[..., None, :]
+    m[..., :3, 3] = translation
+    m[..., 3, 3] = 1
+    return m
+
+
+class Primitive:
+    """
+    Vertex data of a mesh primitive, attributes missing from the file are None
+    """
+    def __init__(self,
+            positions: numpy.ndarray,
+            normals: Optional[numpy.ndarray],
+            uv: Optional[numpy.ndarray],
+            joints: Optional[numpy.ndarray],
+            weights: Optional[numpy.ndarray],
+            indices: Optional[numpy.ndarray],
+            targets: list[dict[str, numpy.ndarray]],
+            material: Optional[int]):
+
+        self.positions = positions
+        self.normals = normals
+        self.uv = uv
+        self.joints = joints
+        self.weights = weights
+        self.indices = indices
+        self.targets = targets
+        self.material = material
+
+    @property
+    def vertex_count(self) -> int:
+        return len(self.positions)
+
+
+class GLTFFile:
+    def __init__(self, filepath: Union[Path, str]):
+        self.filepath = Path(filepath)
+
+        with open(filepath, "rb") as f:
+            data = f.read()
+
+        binary = None
+        if data[:4] == GLB_MAGIC:
+            self.json, binary = self._read_glb(data)
+        else:
+            self.json = json.loads(data)
+
+        self.buffers = [self._read_buffer(buffer, binary) for buffer in self.json.get("buffers", [])]
+
+        self.nodes: list[dict] = self.json.get("nodes", [])
+        self.parents = [-1] * len(self.nodes)
+        for i, node in enumerate(self.nodes):
+            for child in node.get("children", []):
+                self.parents[child] = i
+
+    def _read_glb(self, data: bytes) -> tuple[dict, Optional[memoryview]]:
+        magic, version, length = struct.unpack_from("<4sII", data)
+        if version != 2:
+            raise ValueError(f"{self.filepath} has glTF version {version}, expected 2")
+
+        view = memoryview(data)
+        document = None
+        binary = None
+
+        offset = 12
+        while offset < length:
+            chunk_length, chunk_type = struct.unpack_from("<II", data, offset)
+            chunk = view[offset+8:offset+8+chunk_length]
+
+            if chunk_type == GLB_JSON: document = json.loads(bytes(chunk))
+            elif chunk_type == GLB_BIN and binary is None: binary = chunk
+
+            offset += 8 + chunk_length
+
+        if document is None:
+            raise ValueError(f"{self.filepath} has no JSON chunk")
+
+        return document, binary
+
+    def _read_buffer(self, buffer: dict, binary: Optional[memoryview]) -> memoryview:
+        uri = buffer.get("uri")
+
+        if uri is None:
+            if binary is None:
+                raise ValueError(f"{self.filepath} refers to a missing GLB binary chunk")
+            return binary
+
+        if uri.startswith("data:"):
+            return memoryview(base64.b64decode(uri.split(",", 1)[1]))
+
+        with open(self.filepath.parent / uri, "rb") as f:
+            return memoryview(f.read())
+
+    def buffer_view(self, index: int) -> memoryview:
+        """
+        Bytes of a buffer view, a slice of its buffer without copying
+        """
+        view = self.json["bufferViews"][index]
+        offset = view.get("byteOffset", 0)
+        return self.buffers[view["buffer"]][offset:offset+view["byteLength"]]
+
+    def vertex_layout(self, index: int) -> Optional[tuple[int, str, int, int]]:
+        """
+        Buffer view, moderngl format, byte offset and byte stride to bind an
+        accessor straight from its buffer view, None if the data has to be
+        converted with 'accessor' first
+        """
+        accessor = self.json["accessors"][index]
+        fmt = VERTEX_FORMATS.get((accessor["componentType"], accessor.get("normalized", False)))
+        if fmt is None or "bufferView" not in accessor or "sparse" in accessor:
+            return None
+
+        components = TYPE_SIZES[accessor["type"]]
+        view = self.json["bufferViews"][accessor["bufferView"]]
+        stride = view.get("byteStride", components * numpy.dtype(COMPONENT_TYPES[accessor["componentType"]]).itemsize)
+
+        return accessor["bufferView"], f"{components}{fmt}", accessor.get("byteOffset", 0), stride
+
+    def index_data(self, index: int) -> tuple[memoryview, int]:
+        """
+        Bytes of an index accessor and their element size, tightly packed
+        indices are a slice of the buffer view
+        """
+        accessor = self.json["accessors"][index]
+        size = numpy.dtype(COMPONENT_TYPES[accessor["componentType"]]).itemsize
+
+        if "bufferView" not in accessor:
+            return memoryview(self.accessor(index).tobytes()), size
+
+        offset = accessor.get("byteOffset", 0)
+        return self.buffer_view(accessor["bufferView"])[offset:offset+accessor["count"]*size], size
+
+    def accessor(self, index: int) -> numpy.ndarray:
+        """
+        (count, components) array, or (count, 4, 4) for MAT4, normalized
+        integers are converted to floats
+        """
+        accessor = self.json["accessors"][index]
+        if "sparse" in accessor:
+            raise ValueError("sparse accessors are not supported")
+
+        dtype = numpy.dtype(COMPONENT_TYPES[accessor["componentType"]])
+        components = TYPE_SIZES[accessor["type"]]
+        count = accessor["count"]
+
+        if "bufferView" not in accessor:
+            array = numpy.zeros((count, components), dtype=dtype)
+
+        else:
+            view = self.json["bufferViews"][accessor["bufferView"]]
+            data = self.buffers[view["buffer"]]
+            offset = view.get("byteOffset", 0) + accessor.get("byteOffset", 0)
+            stride = view.get("byteStride", components * dtype.itemsize)
+
+            array = numpy.ndarray(
+                (count, components),
+                dtype=dtype,
+                buffer=data,
+                offset=offset,
+                strides=(stride, dtype.itemsize))
+
+        if accessor.get("normalized", False):
+            array = array.astype(numpy.float32) / numpy.iinfo(dtype).max
+
+        if accessor["type"] == "MAT4":
+            return array.reshape(count, 4, 4).transpose(0, 2, 1)
+
+        return array
+
+    def node_trs(self, index: int) -> tuple[numpy.ndarray, numpy.ndarray, numpy.ndarray]:
+        """
+        Translation, quaternion and scale of a node, matrices are decomposed
+        """
+        node = self.nodes[index]
+
+        if "matrix" in node:
+            m = numpy.array(node["matrix"], dtype=numpy.float64).reshape(4, 4).T
+            scale = numpy.linalg.norm(m[:3, :3], axis=0)
+            r = m[:3, :3] / scale
+
+            # Rotation matrix to quaternion
+            w = numpy.sqrt(max(0.0, 1 + r[0, 0] + r[1, 1] + r[2, 2])) / 2
+            x = numpy.copysign(numpy.sqrt(max(0.0, 1 + r[0, 0] - r[1, 1] - r[2, 2])) / 2, r[2, 1] - r[1, 2])
+            y = numpy.copysign(numpy.sqrt(max(0.0, 1 - r[0, 0] + r[1, 1] - r[2, 2])) / 2, r[0, 2] - r[2, 0])
+            z = numpy.copysign(numpy.sqrt(max(0.0, 1 - r[0, 0] - r[1, 1] + r[2, 2])) / 2, r[1, 0] - r[0, 1])
+            return m[:3, 3].copy(), numpy.array([x, y, z, w]), scale
+
+        return (
+            numpy.array(node.get("translation", (0.0, 0.0, 0.0)), dtype=numpy.float64),
+            numpy.array(node.get("rotation", (0.0, 0.0, 0.0, 1.0)), dtype=numpy.float64),
+            numpy.array(node.get("scale", (1.0, 1.0, 1.0)), dtype=numpy.float64)
+        )
+
+    def node_matrix(self, index: int) -> numpy.ndarray:
+        node = self.nodes[index]
+        if "matrix" in node:
+            return numpy.array(node["matrix"], dtype=numpy.float64).reshape(4, 4).T
+
+        return trs_matrices(*self.node_trs(index))
+
+    def global_matrix(self, index: int) -> numpy.ndarray:
+        m = self.node_matrix(index)
+        parent = self.parents[index]
+        while parent >= 0:
+            m = self.node_matrix(parent) @ m
+            parent = self.parents[parent]
+        return m
+
+    def primitives(self, mesh: int) -> list[Primitive]:
+        primitives = []
+
+        for primitive in self.json["meshes"][mesh]["primitives"]:
+            if primitive.get("mode", 4) != 4:
+                raise ValueError("only triangle primitives are supported")
+
+            attributes = primitive["attributes"]
+
+            def read(name):
+                return self.accessor(attributes[name]) if name in attributes else None
+
+            indices = None
+            if "indices" in primitive:
+                indices = self.accessor(primitive["indices"]).reshape(-1)
+
+            targets = [
+                {name: self.accessor(index) for name, index in target.items()}
+                for target in primitive.get("targets", [])
+            ]
+
+            primitives.append(Primitive(
+                read("POSITION"),
+                read("NORMAL"),
+                read("TEXCOORD_0"),
+                read("JOINTS_0"),
+                read("WEIGHTS_0"),
+                indices,
+                targets,
+                primitive.get("material")
+            ))
+
+        return primitives
+
+    def mesh_instances(self, scene: Optional[int] = None) -> Iterator[tuple[int, int, numpy.ndarray]]:
+        """
+        Node, mesh and world matrix of every node with a mesh in 'scene',
+        the default scene if there's one or else every root node
+        """
+        if scene is None: scene = self.json.get("scene", 0)
+        scenes = self.json.get("scenes", [])
+
+        if scene < len(scenes):
+            roots = scenes[scene].get("nodes", [])
+        else:
+            roots = [i for i, parent in enumerate(self.parents) if parent < 0]
+
+        stack = [(root, numpy.identity(4)) for root in reversed(roots)]
+        while stack:
+            index, parent_matrix = stack.pop()
+            matrix = parent_matrix @ self.node_matrix(index)
+            node = self.nodes[index]
+
+            if "mesh" in node:
+                yield index, node["mesh"], matrix
+
+            for child in reversed(node.get("children", [])):
+                stack.append((child, matrix))
+
+    def material(self, index: Optional[int]) -> tuple[tuple[float, float, float, float], Optional[int]]:
+        """
+        Base color factor and base color image of a material, files without
+        a material are white
+        """
+        if index is None: return (1.0, 1.0, 1.0, 1.0), None
+
+        pbr = self.json["materials"][index].get("pbrMetallicRoughness", {})
+        factor = tuple(pbr.get("baseColorFactor", (1.0, 1.0, 1.0, 1.0)))
+
+        image = None
+        if "baseColorTexture" in pbr:
+            image = self.json["textures"][pbr["baseColorTexture"]["index"]].get("source")
+
+        return factor, image
+
+    def image(self, index: int) -> pygame.Surface:
+        """
+        Decodes an image stored in a buffer view, a data URI or a file
+        """
+        image = self.json["images"][index]
+        uri = image.get("uri")
+
+        if uri is None:
+            data = self.buffer_view(image["bufferView"])
+            hint = image.get("mimeType", "image/png").split("/")[-1]
+            return pygame.image.load(io.BytesIO(data), f"image.{hint}")
+
+        if uri.startswith("data:"):
+            hint = uri[5:].split(";", 1)[0].split("/")[-1]
+            return pygame.image.load(io.BytesIO(base64.b64decode(uri.split(",", 1)[1])), f"image.{hint}")
+
+        return pygame.image.load(self.filepath.parent / unquote(uri))
+
+    def mesh_node(self, mesh: int) -> Optional[int]:
+        """
+        First node instancing the mesh
+        """
+        for i, node in enumerate(self.nodes):
+            if node.get("mesh") == mesh:
+                return i
+        return None
+
+
+def load_gltf(filepath: Union[Path, str]) -> GLTFFile:
+    return GLTFFile(filepath)
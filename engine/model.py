@@ -1,7 +1,8 @@
-from typing import Union
+from typing import Union, Optional
 
 from pathlib import Path
 import struct
+import numpy
 import pygame
 import moderngl
 import pyrr
@@ -9,61 +10,211 @@ import pyrr
 from .objparser import parse
 from .camera import Camera
 from .light import BasicLight
+from .pack import AssetPack, texture_name
+from .atlas import TextureAtlas
+from .gltf import GLTFFile
+from .utils import rotation_matrix
+from .resources import Disposable, track, retain, release
+
+
+def _read_shader(filepath: str, pack: AssetPack = None) -> str:
+    if pack is not None and filepath in pack:
+        return pack.shader(filepath)
+
+    with open(filepath) as f:
+        return f.read()
+
+
+def _float_buffer(ctx: moderngl.Context, data, owner=None) -> moderngl.Buffer:
+    """
+    Packed data (e.g. memoryviews from an asset pack) is uploaded as is,
+    the buffer is tracked as created by 'owner'
+    """
+    if isinstance(data, (bytes, bytearray, memoryview)):
+        return track(ctx.buffer(data), owner)
+
+    if isinstance(data, numpy.ndarray):
+        return track(ctx.buffer(numpy.ascontiguousarray(data, dtype=numpy.float32)), owner)
+
+    return track(ctx.buffer(struct.pack(f"{len(data)}f", *data)), owner)
+
+
+# Camera version last uploaded to each program, programs are shared between
+# models so the camera uniforms only have to be written once per change
+_CAMERA_VERSIONS = {}
+def _write_camera(program: moderngl.Program, camera: Camera):
+    version = camera.update_matrices()
+    if _CAMERA_VERSIONS.get(program) == version: return
+
+    program["projection"].write(camera.projection)
+    program["view"].write(camera.view)
+    if "viewpos" in program:
+        program["viewpos"].write(camera.final_position)
+
+    _CAMERA_VERSIONS[program] = version
+
+
+def _bind_environment(program: moderngl.Program, environment, roughness: float = 0.0):
+    """
+    Bind the cube map models reflect (anything with 'texture' like Skybox or
+    a ReflectionProbe) to unit 1, rough materials sample its blurrier mip
+    levels if it has 'max_lod'. Without an environment only the level is
+    reset, the program is shared and keeps the last model's otherwise.
+    """
+    if environment is not None:
+        environment.texture.use(location=1)
+    if "reflection_lod" in program:
+        program["reflection_lod"].value = roughness * getattr(environment, "max_lod", 0.0)
 
 
 PROGRAMS = {}
-def _compile_programs(ctx: moderngl.Context, force: bool = False):
+def _compile_programs(ctx: moderngl.Context, force: bool = False, pack: AssetPack = None):
     """
     This function caches shader programs for models to use
 
-    'force' keyword recompiles all shaders
+    'force' keyword recompiles all shaders, the old programs are freed once
+    the models and batches holding them are disposed
+    'pack' keyword reads shader sources from an asset pack
     """
     if len(PROGRAMS) == 0 or force:
+        for program in PROGRAMS.values(): release(program)
         PROGRAMS.clear()
-        PROGRAMS["default"] = ctx.program(
-            vertex_shader   = open("shaders/default.vsh").read(),
-            fragment_shader = open("shaders/default.fsh").read()
-        )
-
-        PROGRAMS["unlit"] = ctx.program(
-            vertex_shader   = open("shaders/unlit.vsh").read(),
-            fragment_shader = open("shaders/unlit.fsh").read()
-        )
-
-        PROGRAMS["static"] = ctx.program(
-            vertex_shader   = open("shaders/static.vsh").read(),
-            fragment_shader = open("shaders/static.fsh").read()
-        )
-
-        PROGRAMS["skybox"] = ctx.program(
-            vertex_shader   = open("shaders/skybox.vsh").read(),
-            fragment_shader = open("shaders/skybox.fsh").read()
-        )
-
-        PROGRAMS["shadow"] = ctx.program(
-            vertex_shader   = open("shaders/shadow.vsh").read(),
-            fragment_shader = open("shaders/shadow.fsh").read()
-        )
-
-        PROGRAMS["shadowmap"] = ctx.program(
-            vertex_shader   = open("shaders/shadowmap.vsh").read(),
-            fragment_shader = open("shaders/shadowmap.fsh").read()
-        )
-
-        PROGRAMS["debug"] = ctx.program(
-            vertex_shader   = open("shaders/debug.vsh").read(),
-            fragment_shader = open("shaders/debug.fsh").read()
-        )
-
-
-class BaseModel:
+        _CAMERA_VERSIONS.clear()
+        PROGRAMS["default"] = track(ctx.program(
+            vertex_shader   = _read_shader("shaders/default.vsh", pack),
+            fragment_shader = _read_shader("shaders/default.fsh", pack)
+        ), "programs")
+
+        PROGRAMS["unlit"] = track(ctx.program(
+            vertex_shader   = _read_shader("shaders/unlit.vsh", pack),
+            fragment_shader = _read_shader("shaders/unlit.fsh", pack)
+        ), "programs")
+
+        PROGRAMS["static"] = track(ctx.program(
+            vertex_shader   = _read_shader("shaders/static.vsh", pack),
+            fragment_shader = _read_shader("shaders/static.fsh", pack)
+        ), "programs")
+
+        PROGRAMS["skybox"] = track(ctx.program(
+            vertex_shader   = _read_shader("shaders/skybox.vsh", pack),
+            fragment_shader = _read_shader("shaders/skybox.fsh", pack)
+        ), "programs")
+
+        PROGRAMS["shadow"] = track(ctx.program(
+            vertex_shader   = _read_shader("shaders/shadow.vsh", pack),
+            fragment_shader = _read_shader("shaders/shadow.fsh", pack)
+        ), "programs")
+
+        PROGRAMS["shadowmap"] = track(ctx.program(
+            vertex_shader   = _read_shader("shaders/shadowmap.vsh", pack),
+            fragment_shader = _read_shader("shaders/shadowmap.fsh", pack)
+        ), "programs")
+
+        PROGRAMS["debug"] = track(ctx.program(
+            vertex_shader   = _read_shader("shaders/debug.vsh", pack),
+            fragment_shader = _read_shader("shaders/debug.fsh", pack)
+        ), "programs")
+
+        PROGRAMS["picking"] = track(ctx.program(
+            vertex_shader   = _read_shader("shaders/picking.vsh", pack),
+            fragment_shader = _read_shader("shaders/picking.fsh", pack)
+        ), "programs")
+
+        PROGRAMS["batched"] = track(ctx.program(
+            vertex_shader   = _read_shader("shaders/batched.vsh", pack),
+            fragment_shader = _read_shader("shaders/default.fsh", pack)
+        ), "programs")
+
+        # Reflection cube maps are bound to unit 1, away from the sampler2D on 0
+        for name in ("default", "batched"):
+            if "skybox" in PROGRAMS[name]: PROGRAMS[name]["skybox"].value = 1
+
+        PROGRAMS["batched_unlit"] = track(ctx.program(
+            vertex_shader   = _read_shader("shaders/batched.vsh", pack),
+            fragment_shader = _read_shader("shaders/unlit.fsh", pack)
+        ), "programs")
+
+        PROGRAMS["skinned"] = track(ctx.program(
+            vertex_shader   = _read_shader("shaders/skinned.vsh", pack),
+            fragment_shader = _read_shader("shaders/default.fsh", pack)
+        ), "programs")
+
+        # Texture units used by SkinnedModel.render, a sampler2D and the
+        # samplerCube can't share unit 0 here like they do in "default"
+        for name, location in (("skybox", 1), ("bones", 2), ("morphs", 3), ("morph_weights", 4)):
+            if name in PROGRAMS["skinned"]: PROGRAMS["skinned"][name].value = location
+
+        PROGRAMS["instanced"] = track(ctx.program(
+            vertex_shader   = _read_shader("shaders/instanced.vsh", pack),
+            fragment_shader = _read_shader("shaders/default.fsh", pack)
+        ), "programs")
+        PROGRAMS["instanced"]["skybox"].value = 1
+
+        PROGRAMS["instanced_unlit"] = track(ctx.program(
+            vertex_shader   = _read_shader("shaders/instanced.vsh", pack),
+            fragment_shader = _read_shader("shaders/unlit.fsh", pack)
+        ), "programs")
+
+        PROGRAMS["particle_update"] = track(ctx.program(
+            vertex_shader = _read_shader("shaders/particle_update.vsh", pack),
+            varyings      = ["out_position", "out_age", "out_velocity", "out_lifetime"]
+        ), "programs")
+
+        PROGRAMS["particle"] = track(ctx.program(
+            vertex_shader   = _read_shader("shaders/particle.vsh", pack),
+            fragment_shader = _read_shader("shaders/particle.fsh", pack)
+        ), "programs")
+
+
+class Transformable:
+    """
+    Placement shared by models and model groups: 'posmat' (a translation
+    matrix, row vectors), 'rotation' and 'scale', and the flat 'model_coords'
+    they transform
+    """
+    def transform_matrix(self) -> numpy.ndarray:
+        """
+        Model to world matrix (column vectors) including the rotation and
+        scale the vertex shader applies before 'model'
+        """
+        m = numpy.identity(4)
+        m[:3, :3] = rotation_matrix(self.rotation) * self.scale
+        return self.posmat.T @ m
+
+    def world_vertices(self) -> numpy.ndarray:
+        """
+        Vertex positions in world space as an (n, 3) array
+        """
+        m = self.transform_matrix()
+        vertices = numpy.asarray(self.model_coords, dtype=numpy.float32).reshape(-1, 3)
+        return vertices @ m[:3, :3].T + m[:3, 3]
+
+    def bounds(self) -> tuple[numpy.ndarray, numpy.ndarray]:
+        """
+        World space axis aligned bounding box as (mins, maxs)
+        """
+        if self._local_bounds is None:
+            vertices = numpy.asarray(self.model_coords, dtype=numpy.float32).reshape(-1, 3)
+            self._local_bounds = (vertices.min(axis=0), vertices.max(axis=0))
+
+        lo, hi = self._local_bounds
+        corners = numpy.array([[x, y, z] for x in (lo[0], hi[0]) for y in (lo[1], hi[1]) for z in (lo[2], hi[2])])
+
+        m = self.transform_matrix()
+        corners = corners @ m[:3, :3].T + m[:3, 3]
+        return corners.min(axis=0), corners.max(axis=0)
+
+
+class BaseModel(Transformable, Disposable):
     """
     Base model class
     """
+    program_name = "default"
+
     def __init__(self,
             ctx: moderngl.Context,
             position: tuple[float, float, float],
-            texture: str,
+            texture: Union[str, pygame.Surface, moderngl.Texture],
             texture_format: str,
             vertices: list[tuple[float, float, float]],
             tex_coords: list[tuple[float, float]],
@@ -73,13 +224,19 @@ class BaseModel:
             build_mipmaps: bool = True):
 
         self.ctx = ctx
-        self.program = PROGRAMS["default"]
-        self.shadowmap_program = PROGRAMS["shadowmap"]
-        self.debug_program = PROGRAMS["debug"]
+
+        # Programs are held until disposed, recompiling the shaders doesn't
+        # free them from under existing models
+        self.program = retain(PROGRAMS[self.program_name])
+        self.shadowmap_program = retain(PROGRAMS["shadowmap"])
+        self.debug_program = retain(PROGRAMS["debug"])
 
         self.rotation = pyrr.Vector3([0.0, 0.0, 0.0])
         self.scale = pyrr.Vector3([1.0, 1.0, 1.0])
 
+        # 0 reflects sharply, 1 samples the blurriest level of the environment
+        self.roughness = 0.0
+
         self.texture_format = texture_format
         self.build_mipmaps = build_mipmaps
 
@@ -89,9 +246,28 @@ class BaseModel:
         self.texture_coords = tex_coords
         self.norm_coords = norm_coords
 
+        # Static batch drawing this model, see batching.StaticBatcher
+        self.batcher = None
+        self._static = False
+
+        # Model space bounding box, see bounds
+        self._local_bounds = None
+
         self.create_vao()
 
-        if from_filepath:
+        # An already uploaded texture is shared, the model holds a reference
+        self.texture = None
+        self.owns_texture = not isinstance(texture, moderngl.Texture)
+        if not self.owns_texture:
+            self.surface = None
+            self.texture = retain(texture)
+            return
+
+        if isinstance(texture, pygame.Surface):
+            surf = texture
+            if flip_texture: surf = pygame.transform.flip(surf, False, True)
+            self.surface = surf
+        elif from_filepath:
             surf = pygame.image.load(texture)
             if flip_texture: surf = pygame.transform.flip(surf, False, True)
             self.surface = surf
@@ -106,11 +282,12 @@ class BaseModel:
         self.create_texture()
 
     def create_texture(self):
-        self.texture = self.ctx.texture(
+        release(self.texture)
+        self.texture = track(self.ctx.texture(
             self.surface.get_size(),
             len(self.texture_format),
             pygame.image.tostring(self.surface, self.texture_format, True)
-        )
+        ), self)
 
         self.texture.repeat_x = False
         self.texture.repeat_y = False
@@ -123,44 +300,57 @@ class BaseModel:
         if self.build_mipmaps: self.texture.build_mipmaps()
 
     def create_vao(self):
-        pos = self.ctx.buffer(struct.pack(f"{len(self.model_coords)}f", *self.model_coords))
-        uv  = self.ctx.buffer(struct.pack(f"{len(self.texture_coords)}f", *self.texture_coords))
-        nor = self.ctx.buffer(struct.pack(f"{len(self.norm_coords)}f", *self.norm_coords))
+        pos = _float_buffer(self.ctx, self.model_coords, self)
+        uv  = _float_buffer(self.ctx, self.texture_coords, self)
+        nor = _float_buffer(self.ctx, self.norm_coords, self)
+        self.buffers = (pos, uv, nor)
 
-        if self.program == PROGRAMS["unlit"]:
-            self.vao = self.ctx.vertex_array(
+        if self.program_name == "unlit":
+            self.vao = track(self.ctx.vertex_array(
                 self.program, [
                     (pos, "3f", "a_position"),
                     (uv,  "2f", "a_texture")
-                ])
+                ]), self)
         else:
-            self.vao = self.ctx.vertex_array(
+            self.vao = track(self.ctx.vertex_array(
                 self.program, [
                     (pos, "3f", "a_position"),
                     (uv,  "2f", "a_texture"),
                     (nor, "3f", "a_normal")
-                ])
+                ]), self)
 
-        self.shadow_vao = self.ctx.vertex_array(
+        self.shadow_vao = track(self.ctx.vertex_array(
             self.shadowmap_program, [
                 (pos, "3f", "a_position")
-            ])
+            ]), self)
 
-        self.debug_vao = self.ctx.vertex_array(
+        self.debug_vao = track(self.ctx.vertex_array(
             self.debug_program, [
                 (pos, "3f", "a_position"),
                 (uv,  "2f", "a_texture"),
                 (pos, "3f", "a_position")
-            ])
+            ]), self)
+
+    @property
+    def static(self) -> bool:
+        """
+        Static models are drawn by their batcher, mark a model non-static before
+        moving it and only the batch chunk it was in is rebuilt
+        """
+        return self._static
+
+    @static.setter
+    def static(self, value: bool):
+        if value == self._static: return
+        self._static = value
+        if self.batcher is not None: self.batcher.update(self)
 
     def update(self, camera: Camera, light_source: BasicLight):
-        self.program["projection"].value = tuple(camera.projection.flatten())
-        self.program["view"].value = tuple(camera.get_view_matrix().flatten())
+        _write_camera(self.program, camera)
         self.program["model"].value = tuple(self.posmat.flatten())
         self.program["angle"].value = tuple(self.rotation.tolist())
         self.program["scale"].value = tuple(self.scale.tolist())
 
-        self.program["viewpos"].value = tuple(camera.final_position.tolist())
         self.program["lightpos"].value = tuple(light_source.position.tolist())
 
         self.program["color"].value = light_source.color
@@ -170,15 +360,14 @@ class BaseModel:
         self.program["specular_power"].value = light_source.specular_power
 
     def update_shadow(self, camera: Camera, camera2: Camera, light_source: BasicLight):
-        self.program["projection"].value = tuple(camera.projection.flatten())
-        self.program["view"].value = tuple(camera.get_view_matrix().flatten())
+        _write_camera(self.program, camera)
         self.program["model"].value = tuple(self.posmat.flatten())
-        self.program["lightprojection"].value = tuple(camera2.projection.flatten())
-        self.program["lightview"].value = tuple(camera2.get_view_matrix().flatten())
+        camera2.update_matrices()
+        self.program["lightprojection"].write(camera2.projection)
+        self.program["lightview"].write(camera2.view)
         self.program["angle"].value = tuple(self.rotation.tolist())
         self.program["scale"].value = tuple(self.scale.tolist())
 
-        self.program["viewpos"].value = tuple(camera.final_position.tolist())
         self.program["lightpos"].value = tuple(light_source.position.tolist())
 
         self.program["color"].value = light_source.color
@@ -188,18 +377,16 @@ class BaseModel:
         self.program["specular_power"].value = light_source.specular_power
 
     def update_shadowmap(self, camera: Camera):
-        self.shadowmap_program["projection"].value = tuple(camera.projection.flatten())
-        self.shadowmap_program["view"].value = tuple(camera.get_view_matrix().flatten())
+        _write_camera(self.shadowmap_program, camera)
         self.shadowmap_program["model"].value = tuple(self.posmat.flatten())
 
     def update_debug(self, camera: Camera):
-        self.debug_program["projection"].value = tuple(camera.projection.flatten())
-        self.debug_program["view"].value = tuple(camera.get_view_matrix().flatten())
+        _write_camera(self.debug_program, camera)
         self.debug_program["model"].value = tuple(self.posmat.flatten())
 
     def render(self, skybox=None):
         self.texture.use(location=0)
-        if skybox: skybox.texture.use(location=1)
+        _bind_environment(self.program, skybox, self.roughness)
         self.vao.render()
 
     def render_shadow(self):
@@ -208,15 +395,54 @@ class BaseModel:
     def render_debug(self):
         self.debug_vao.render()
 
+    def position_vao(self, program: moderngl.Program) -> moderngl.VertexArray:
+        """
+        Vertex array drawing only this model's positions with another program
+        (e.g. picking), it belongs to the caller
+        """
+        return track(self.ctx.vertex_array(program, [(self.buffers[0], "3f", "a_position")]), self)
+
+    def gpu_size(self) -> int:
+        """
+        Approximate GPU memory used by this model's buffers and texture in bytes,
+        shared textures are not counted
+        """
+        size = sum(buffer.size for buffer in self.buffers)
+        if not self.owns_texture: return size
+
+        w, h = self.texture.size
+        texture_size = w * h * self.texture.components
+        if self.build_mipmaps: texture_size = texture_size * 4 // 3
+        return size + texture_size
+
+    def dispose(self):
+        """
+        Free the GPU objects owned by this model and drop its references to a
+        shared texture and the programs
+        """
+        release(self.vao)
+        release(self.shadow_vao)
+        release(self.debug_vao)
+        for buffer in self.buffers: release(buffer)
+        release(self.texture)
+        self._release_programs()
+
+    def _release_programs(self):
+        release(self.program)
+        release(self.shadowmap_program)
+        release(self.debug_program)
+
 
 class UnlitModel(BaseModel):
     """
     Unlit model doesn't get effected by any light source
     """
+    program_name = "unlit"
+
     def __init__(self,
             ctx: moderngl.Context,
             position: tuple[float, float, float],
-            texture: str,
+            texture: Union[str, pygame.Surface, moderngl.Texture],
             texture_format: str,
             vertices: list[tuple[float, float, float]],
             tex_coords: list[tuple[float, float]],
@@ -237,12 +463,8 @@ class UnlitModel(BaseModel):
             from_filepath,
             build_mipmaps)
 
-        self.program = PROGRAMS["unlit"]
-        self.create_vao()
-
     def update(self, camera: Camera):
-        self.program["projection"].value = tuple(camera.projection.flatten())
-        self.program["view"].value = tuple(camera.get_view_matrix().flatten())
+        _write_camera(self.program, camera)
         self.program["model"].value = tuple(self.posmat.flatten())
         self.program["angle"].value = tuple(self.rotation.tolist())
         self.program["scale"].value = tuple(self.scale.tolist())
@@ -253,10 +475,12 @@ class StaticModel(BaseModel):
     Static model doesn't get effected by camera view
     mostly meant to be used as UI objects
     """
+    program_name = "static"
+
     def __init__(self,
             ctx: moderngl.Context,
             position: tuple[float, float, float],
-            texture: str,
+            texture: Union[str, pygame.Surface, moderngl.Texture],
             texture_format: str,
             vertices: list[tuple[float, float, float]],
             tex_coords: list[tuple[float, float]],
@@ -276,27 +500,324 @@ class StaticModel(BaseModel):
             from_filepath,
             build_mipmaps)
 
-        self.program = PROGRAMS["static"]
-        self.create_vao()
-
     def create_vao(self):
-        pos = self.ctx.buffer(struct.pack(f"{len(self.model_coords)}f", *self.model_coords))
-        uv  = self.ctx.buffer(struct.pack(f"{len(self.texture_coords)}f", *self.texture_coords))
+        pos = _float_buffer(self.ctx, self.model_coords, self)
+        uv  = _float_buffer(self.ctx, self.texture_coords, self)
+        self.buffers = (pos, uv)
 
-        self.vao = self.ctx.vertex_array(
+        self.vao = track(self.ctx.vertex_array(
             self.program, [
                 (pos, "3f", "a_position"),
                 (uv,  "2f", "a_texture"),
-            ])
+            ]), self)
+
+    def dispose(self):
+        release(self.vao)
+        for buffer in self.buffers: release(buffer)
+        release(self.texture)
+        self._release_programs()
+
+
+class IndexedModel(BaseModel):
+    """
+    Model drawn with an index buffer from vertex buffers it shares with
+    other models, like the buffer views of a glTF file
+
+    'attributes' maps shader attributes to (buffer, format, byte offset,
+    byte stride). 'matrix' is the model to world matrix (column vectors).
+    The buffers belong to whoever created them, see ModelGroup.
+    """
+    def __init__(self,
+            ctx: moderngl.Context,
+            matrix: numpy.ndarray,
+            texture: moderngl.Texture,
+            attributes: dict[str, tuple[moderngl.Buffer, str, int, int]],
+            index_buffer: Optional[moderngl.Buffer],
+            index_element_size: int,
+            positions: numpy.ndarray,
+            uv: Optional[numpy.ndarray],
+            normals: Optional[numpy.ndarray],
+            indices: Optional[numpy.ndarray]):
+
+        self.attributes = attributes
+        self.index_buffer = index_buffer
+        self.index_element_size = index_element_size
+
+        # CPU copies for collision, picking and batching, see model_coords
+        self.positions = positions
+        self.uv = uv
+        self.normals = normals
+        self.indices = indices
+
+        super().__init__(ctx, (0.0, 0.0, 0.0), texture, "RGBA", None, None, None, False)
+
+        self.posmat = numpy.ascontiguousarray(matrix.T, dtype=numpy.float32)
+
+    def _deindexed(self, array: Optional[numpy.ndarray], components: int) -> numpy.ndarray:
+        if array is None: array = numpy.zeros((len(self.positions), components), dtype=numpy.float32)
+        if self.indices is not None: array = array[self.indices]
+        return numpy.ascontiguousarray(array, dtype=numpy.float32).reshape(-1)
+
+    # Flat per-corner coordinates like the other models have, built on first
+    # use since only collision, picking and batching read them
+
+    @property
+    def model_coords(self) -> numpy.ndarray:
+        if self._model_coords is None: self._model_coords = self._deindexed(self.positions, 3)
+        return self._model_coords
+
+    @model_coords.setter
+    def model_coords(self, value):
+        self._model_coords = value
+
+    @property
+    def texture_coords(self) -> numpy.ndarray:
+        if self._texture_coords is None: self._texture_coords = self._deindexed(self.uv, 2)
+        return self._texture_coords
+
+    @texture_coords.setter
+    def texture_coords(self, value):
+        self._texture_coords = value
+
+    @property
+    def norm_coords(self) -> numpy.ndarray:
+        if self._norm_coords is None: self._norm_coords = self._deindexed(self.normals, 3)
+        return self._norm_coords
+
+    @norm_coords.setter
+    def norm_coords(self, value):
+        self._norm_coords = value
+
+    def create_vao(self):
+        self.buffers = ()
+        self.vao = self._vertex_array(self.program)
+        self.shadow_vao = self._vertex_array(self.shadowmap_program)
+        self.debug_vao = self._vertex_array(self.debug_program)
+
+    def _vertex_array(self, program: moderngl.Program) -> moderngl.VertexArray:
+        vao = track(self.ctx.vertex_array(program, [], index_buffer=self.index_buffer, index_element_size=self.index_element_size), self)
+
+        # Attributes the program doesn't use are left out, ones the model
+        # doesn't have (e.g. texture coordinates) read as zero
+        for name, (buffer, fmt, offset, stride) in self.attributes.items():
+            if name in program:
+                vao.bind(program[name].location, "f", buffer, fmt, offset=offset, stride=stride)
+
+        if self.index_buffer is None: vao.vertices = len(self.positions)
+        return vao
+
+    def position_vao(self, program: moderngl.Program) -> moderngl.VertexArray:
+        return self._vertex_array(program)
+
+
+class ModelGroup(Transformable, Disposable):
+    """
+    Models loaded from one file, owning the buffers and textures they share
+
+    It's placed, updated and rendered like a single model: 'posmat',
+    'rotation' and 'scale' move the whole group and are applied to each
+    model's own transform in the file. Models share their program's
+    uniforms, so 'update' only keeps the camera and light until 'render'
+    draws each model with its own transform.
+
+    'model_coords' are the models' vertices in group space, collision,
+    picking and culling see the group as one mesh.
+    """
+    def __init__(self,
+            models: list[BaseModel],
+            buffers: list[moderngl.Buffer],
+            textures: list[moderngl.Texture],
+            position: tuple[float, float, float] = (0.0, 0.0, 0.0)):
+
+        self.models = models
+        self.buffers = buffers
+        self.textures = textures
+
+        self.rotation = pyrr.Vector3([0.0, 0.0, 0.0])
+        self.scale = pyrr.Vector3([1.0, 1.0, 1.0])
+        self.posmat = pyrr.matrix44.create_from_translation(pyrr.Vector3(position))
+
+        # Each model's placement within the group, see _place_models
+        self._local_matrices = [numpy.array(model.posmat.T, dtype=numpy.float64) for model in models]
+        self._placed = None
+
+        self._model_coords = None
+        self._local_bounds = None
+
+        self._camera = None
+        self._light_source = None
+
+        self._place_models()
+
+    def _place_models(self):
+        """
+        Move the models by the group transform when it has changed
+        """
+        m = Transformable.transform_matrix(self)
+        placed = m.tobytes()
+        if placed == self._placed: return
+
+        for model, local in zip(self.models, self._local_matrices):
+            model.posmat = numpy.ascontiguousarray((m @ local).T, dtype=numpy.float32)
+        self._placed = placed
+
+    def transform_matrix(self) -> numpy.ndarray:
+        self._place_models()
+        return Transformable.transform_matrix(self)
+
+    @property
+    def model_coords(self) -> numpy.ndarray:
+        if self._model_coords is None:
+            coords = []
+            for model, local in zip(self.models, self._local_matrices):
+                m = numpy.identity(4)
+                m[:3, :3] = rotation_matrix(model.rotation) * model.scale
+                m = local @ m
+
+                vertices = numpy.asarray(model.model_coords, dtype=numpy.float64).reshape(-1, 3)
+                coords.append(vertices @ m[:3, :3].T + m[:3, 3])
+
+            self._model_coords = numpy.concatenate(coords).astype(numpy.float32).reshape(-1)
+        return self._model_coords
+
+    def __iter__(self):
+        return iter(self.models)
+
+    def __len__(self) -> int:
+        return len(self.models)
+
+    def update(self, camera: Camera, light_source: BasicLight):
+        self._place_models()
+        self._camera = camera
+        self._light_source = light_source
+
+    def update_shadowmap(self, camera: Camera):
+        self._place_models()
+        self._camera = camera
+
+    def update_debug(self, camera: Camera):
+        self._place_models()
+        self._camera = camera
 
+    def render(self, skybox=None):
+        for model in self.models:
+            model.update(self._camera, self._light_source)
+            model.render(skybox)
+
+    def render_shadow(self):
+        for model in self.models:
+            model.update_shadowmap(self._camera)
+            model.render_shadow()
+
+    def render_debug(self):
+        for model in self.models:
+            model.update_debug(self._camera)
+            model.render_debug()
+
+    def gpu_size(self) -> int:
+        """
+        Approximate GPU memory used by the group's buffers and textures in bytes
+        """
+        size = sum(buffer.size for buffer in self.buffers)
+        for texture in self.textures:
+            w, h = texture.size
+            size += w * h * texture.components * 4 // 3
+        return size + sum(model.gpu_size() for model in self.models)
+
+    def dispose(self):
+        """
+        Free the models and the GPU objects they share
+        """
+        for model in self.models: model.dispose()
+        for buffer in self.buffers: release(buffer)
+        for texture in self.textures: release(texture)
+
+
+class InstancedModel(Disposable):
+    """
+    Mesh drawn once per model matrix in a single call
+
+    'matrices' is an (n, 4, 4) array of model to world matrices (column
+    vectors) with rotation and scale included. The vertex buffers can be
+    shared between instanced models, they belong to whoever created them.
+    """
+    def __init__(self,
+            ctx: moderngl.Context,
+            buffers: tuple[moderngl.Buffer, moderngl.Buffer, moderngl.Buffer],
+            texture: moderngl.Texture,
+            matrices: numpy.ndarray,
+            unlit: bool = False):
 
-class Skybox:
-    def __init__(self, ctx, texture):
         self.ctx = ctx
+        self.program = retain(PROGRAMS["instanced_unlit" if unlit else "instanced"])
+        self.unlit = unlit
+        self.texture = texture
+
+        self.instance_buffer = None
+        self.write_matrices(matrices)
+
+        pos, uv, nor = buffers
+        content = [
+            (pos, "3f", "a_position"),
+            (uv,  "2f", "a_texture"),
+            (self.instance_buffer, "16f/i", "a_model")
+        ]
+        if "a_normal" in self.program: content.append((nor, "3f", "a_normal"))
+
+        self.vao = track(self.ctx.vertex_array(self.program, content), self)
+
+    def write_matrices(self, matrices: numpy.ndarray):
+        """
+        Replace the instances' model matrices, their count can change
+        """
+        self.count = len(matrices)
+
+        # GLSL reads matrices column by column
+        data = numpy.ascontiguousarray(numpy.asarray(matrices, dtype=numpy.float32).transpose(0, 2, 1))
+
+        if self.instance_buffer is not None and self.instance_buffer.size >= max(data.nbytes, 64):
+            self.instance_buffer.write(data)
+            return
+
+        if self.instance_buffer is not None: self.instance_buffer.orphan(max(data.nbytes, 64))
+        else: self.instance_buffer = track(self.ctx.buffer(reserve=max(data.nbytes, 64), dynamic=True), self)
+        self.instance_buffer.write(data)
+
+    def update(self, camera: Camera, light_source: BasicLight = None):
+        _write_camera(self.program, camera)
+        if self.unlit: return
+
+        self.program["lightpos"].value = tuple(light_source.position.tolist())
+
+        self.program["color"].value = light_source.color
+        self.program["ambient_intensity"].value = light_source.ambient_intensity
+        self.program["diffuse_intensity"].value = light_source.diffuse_intensity
+        self.program["specular_intensity"].value = light_source.specular_intensity
+        self.program["specular_power"].value = light_source.specular_power
+
+    def render(self, skybox=None):
+        if self.count == 0: return
+        self.texture.use(location=0)
+        if skybox: skybox.texture.use(location=1)
+        self.vao.render(instances=self.count)
+
+    def gpu_size(self) -> int:
+        """
+        Size of the instance buffer in bytes, the mesh and texture are shared
+        """
+        return self.instance_buffer.size
+
+    def dispose(self):
+        release(self.vao)
+        release(self.instance_buffer)
+        release(self.program)
 
-        objfile = parse("assets/models/cube.obj")
 
-        self.program = PROGRAMS["skybox"]
+class Skybox(Disposable):
+    def __init__(self, ctx, texture, pack: AssetPack = None):
+        self.ctx = ctx
+
+        self.program = retain(PROGRAMS["skybox"])
 
         self.rotation = pyrr.Vector3([0.0, 0.0, 0.0])
         self.scale = pyrr.Vector3([1.0, 1.0, 1.0])
@@ -305,24 +826,31 @@ class Skybox:
 
         self.posmat = pyrr.matrix44.create_from_translation(pyrr.Vector3([0.0, 0.0, 0.0]))
 
-        self.model_coords = objfile.vertices
-        self.texture_coords = objfile.uv_coords
-        self.norm_coords = objfile.vertex_normals
+        self.view = numpy.identity(4, dtype="f4")
+        self._camera_version = None
 
-        self.texture = texture
+        if pack is not None and "assets/models/cube.obj" in pack:
+            self.model_coords, self.texture_coords, self.norm_coords = pack.mesh("assets/models/cube.obj")
+        else:
+            objfile = parse("assets/models/cube.obj")
+            self.model_coords = objfile.vertices
+            self.texture_coords = objfile.uv_coords
+            self.norm_coords = objfile.vertex_normals
+
+        self.texture = retain(texture)
 
         #self.texture.anisotropy = 4
 
         self.create_vao()
 
     def update(self, camera: Camera):
-        self.program["projection"].value = tuple(camera.projection.flatten())
-        viewmatrix = camera.get_view_matrix()
+        if camera.update_matrices() == self._camera_version: return
 
-        viewmatrix[3][0] = 0
-        viewmatrix[3][1] = 0
-        viewmatrix[3][2] = 0
-        self.program["view"].value = tuple(viewmatrix.flatten())
+        # Skybox follows the camera, so the translation is dropped from the view
+        self.view[:3, :3] = camera.view[:3, :3]
+        self.program["projection"].write(camera.projection)
+        self.program["view"].write(self.view)
+        self._camera_version = camera.version
         #self.program["model"].value = tuple(pyrr.matrix44.create_from_translation(camera.position).flatten())#tuple(self.posmat.flatten())
 
         #self.program["viewpos"].value = tuple(camera.position.tolist())
@@ -332,14 +860,19 @@ class Skybox:
         self.vao.render()
 
     def create_vao(self):
-        pos = self.ctx.buffer(struct.pack(f"{len(self.model_coords)}f", *self.model_coords))
-        uv  = self.ctx.buffer(struct.pack(f"{len(self.texture_coords)}f", *self.texture_coords))
-        nor = self.ctx.buffer(struct.pack(f"{len(self.norm_coords)}f", *self.norm_coords))
+        # Only positions are read, they double as the cube map direction
+        self.buffer = _float_buffer(self.ctx, self.model_coords, self)
 
-        self.vao = self.ctx.vertex_array(
+        self.vao = track(self.ctx.vertex_array(
             self.program, [
-                (pos, "3f", "a_position"),
-            ])
+                (self.buffer, "3f", "a_position"),
+            ]), self)
+
+    def dispose(self):
+        release(self.vao)
+        release(self.buffer)
+        release(self.texture)
+        release(self.program)
 
 
 def load_obj(
@@ -349,34 +882,246 @@ def load_obj(
         position: tuple[float, float, float],
         texture_format: str = "RGB",
         flip_texture: bool = False,
-        unlit: bool = False) -> Union[BaseModel, UnlitModel]:
+        unlit: bool = False,
+        pack: AssetPack = None,
+        atlas: TextureAtlas = None) -> Union[BaseModel, UnlitModel]:
+    """
+    Assets found in 'pack' are used instead of reading and decoding the files
+
+    If the texture is in 'atlas', the model samples the shared atlas texture
+    and its texture coordinates are moved into the texture's region
+    """
+
+    _compile_programs(ctx, pack=pack)
+
+    if pack is not None and obj_filepath in pack:
+        vertices, uv_coords, vertex_normals = pack.mesh(obj_filepath)
+    else:
+        objfile = parse(obj_filepath)
+        vertices, uv_coords, vertex_normals = objfile.vertices, objfile.uv_coords, objfile.vertex_normals
+
+    texture = texture_filepath
+    owns_texture = False
+    if atlas is not None and texture_name(texture_filepath, flip_texture) in atlas:
+        uv_coords = atlas.remap(texture_name(texture_filepath, flip_texture), uv_coords)
+        texture = atlas.create_texture(ctx)
+        flip_texture = False
 
-    _compile_programs(ctx)
+    elif pack is not None and texture_filepath in pack:
+        texture = track(pack.texture(ctx, texture_filepath, flip=flip_texture), "load_obj")
+        flip_texture = False
+        owns_texture = True
 
-    objfile = parse(obj_filepath)
-    
     if unlit:
-        return UnlitModel(
+        model = UnlitModel(
             ctx,
             position,
-            texture_filepath,
+            texture,
             texture_format,
-            objfile.vertices,
-            objfile.uv_coords,
-            objfile.vertex_normals,
+            vertices,
+            uv_coords,
+            vertex_normals,
 
             flip_texture)
     else:
-        return BaseModel(
+        model = BaseModel(
             ctx,
             position,
-            texture_filepath,
+            texture,
             texture_format,
-            objfile.vertices,
-            objfile.uv_coords,
-            objfile.vertex_normals,
+            vertices,
+            uv_coords,
+            vertex_normals,
             flip_texture)
 
+    # The texture was created for this model alone, the model's reference
+    # is the only one left
+    if owns_texture:
+        model.owns_texture = True
+        release(texture)
+
+    return model
+
+
+def _vertex_normals(positions: numpy.ndarray, indices: Optional[numpy.ndarray]) -> numpy.ndarray:
+    """
+    Area weighted vertex normals for primitives that have none
+    """
+    triangles = indices.reshape(-1, 3) if indices is not None else numpy.arange(len(positions)).reshape(-1, 3)
+    corners = positions[triangles]
+    faces = numpy.cross(corners[:, 1] - corners[:, 0], corners[:, 2] - corners[:, 0])
+
+    normals = numpy.zeros(positions.shape, dtype=numpy.float32)
+    for i in range(3): numpy.add.at(normals, triangles[:, i], faces)
+
+    lengths = numpy.linalg.norm(normals, axis=1, keepdims=True)
+    return normals / numpy.where(lengths > 0, lengths, 1.0)
+
+
+def load_gltf_model(
+        ctx: moderngl.Context,
+        filepath: Union[Path, str],
+        position: tuple[float, float, float] = (0.0, 0.0, 0.0),
+        texture: Union[str, pygame.Surface] = None,
+        pack: AssetPack = None) -> ModelGroup:
+    """
+    Loads every mesh instanced by the default scene of a .glb or .gltf file,
+    each primitive is a model placed by its node's transform within a group
+    at 'position'
+
+    Buffer views holding float or normalized unsigned byte vertex attributes
+    are uploaded once as they are in the file and shared by all the primitives
+    reading them. Materials are their base color texture or a 1x1 texture of
+    their base color factor, 'texture' replaces them all.
+    """
+    _compile_programs(ctx, pack=pack)
+
+    gltf = GLTFFile(filepath)
+    buffers = []
+    textures = []
+
+    view_buffers = {}
+    def view_buffer(view: int) -> moderngl.Buffer:
+        if view not in view_buffers:
+            view_buffers[view] = track(ctx.buffer(gltf.buffer_view(view)), "ModelGroup")
+            buffers.append(view_buffers[view])
+        return view_buffers[view]
+
+    def upload_texture(surface: pygame.Surface) -> moderngl.Texture:
+        # glTF texture coordinates start at the top of the image, so images
+        # aren't flipped like the other models' are
+        tex = track(ctx.texture(surface.get_size(), 4, pygame.image.tostring(surface, "RGBA", False)), "ModelGroup")
+        tex.build_mipmaps()
+        textures.append(tex)
+        return tex
+
+    material_textures = {}
+    def material_texture(material: Optional[int]) -> moderngl.Texture:
+        if material not in material_textures:
+            factor, image = gltf.material(material)
+            if image is not None:
+                surface = gltf.image(image)
+            else:
+                surface = pygame.Surface((1, 1), pygame.SRCALPHA)
+                surface.fill([round(c * 255) for c in factor])
+            material_textures[material] = upload_texture(surface)
+        return material_textures[material]
+
+    if texture is not None:
+        shared_texture = upload_texture(texture if isinstance(texture, pygame.Surface) else pygame.image.load(texture))
+
+    # Primitives of meshes instanced by several nodes are uploaded once
+    mesh_primitives = {}
+
+    models = []
+    for _, mesh, matrix in gltf.mesh_instances():
+        if mesh not in mesh_primitives:
+            primitives = []
+
+            for source, primitive in zip(gltf.json["meshes"][mesh]["primitives"], gltf.primitives(mesh)):
+                attributes = {}
+                for attribute, name in (("POSITION", "a_position"), ("TEXCOORD_0", "a_texture"), ("NORMAL", "a_normal")):
+                    if attribute not in source["attributes"]: continue
+
+                    accessor = source["attributes"][attribute]
+                    layout = gltf.vertex_layout(accessor)
+                    if layout is not None:
+                        view, fmt, offset, stride = layout
+                        attributes[name] = (view_buffer(view), fmt, offset, stride)
+                    else:
+                        # Converted to floats, e.g. normalized shorts
+                        data = numpy.ascontiguousarray(gltf.accessor(accessor), dtype=numpy.float32)
+                        buffers.append(track(ctx.buffer(data), "ModelGroup"))
+                        attributes[name] = (buffers[-1], f"{data.shape[1]}f", 0, data.shape[1] * 4)
+
+                normals = primitive.normals
+                if normals is None:
+                    normals = _vertex_normals(primitive.positions, primitive.indices)
+                    buffers.append(track(ctx.buffer(normals.astype(numpy.float32)), "ModelGroup"))
+                    attributes["a_normal"] = (buffers[-1], "3f", 0, 12)
+
+                index_buffer, index_size = None, 4
+                if "indices" in source:
+                    data, index_size = gltf.index_data(source["indices"])
+                    index_buffer = track(ctx.buffer(data), "ModelGroup")
+                    buffers.append(index_buffer)
+
+                primitives.append((primitive, normals, attributes, index_buffer, index_size))
+
+            mesh_primitives[mesh] = primitives
+
+        for primitive, normals, attributes, index_buffer, index_size in mesh_primitives[mesh]:
+            models.append(IndexedModel(
+                ctx,
+                matrix,
+                shared_texture if texture is not None else material_texture(primitive.material),
+                attributes,
+                index_buffer,
+                index_size,
+                primitive.positions,
+                primitive.uv,
+                normals,
+                primitive.indices))
+
+    return ModelGroup(models, buffers, textures, position)
+
+
+def load_model(
+        ctx: moderngl.Context,
+        filepath: Union[Path, str],
+        texture_filepath: Union[Path, str] = None,
+        position: tuple[float, float, float] = (0.0, 0.0, 0.0),
+        texture_format: str = "RGB",
+        flip_texture: bool = False,
+        unlit: bool = False,
+        pack: AssetPack = None,
+        atlas: TextureAtlas = None) -> Union[BaseModel, UnlitModel, ModelGroup]:
+    """
+    Loads a model by its file extension, OBJ files with 'load_obj' and glTF
+    files (.glb and .gltf) with 'load_gltf_model'
+
+    glTF files give a ModelGroup, placed and moved like an OBJ model and
+    accepted wherever one is (collision, picking, culling, probes). They
+    bring their own materials, 'texture_filepath' replaces them if given.
+    They are always lit and don't use 'atlas'.
+    """
+    if Path(filepath).suffix.lower() in (".glb", ".gltf"):
+        if unlit:
+            raise ValueError("unlit glTF models are not supported")
+
+        return load_gltf_model(ctx, filepath, position, texture_filepath, pack)
+
+    if texture_filepath is None:
+        raise ValueError(f"{filepath} needs a texture")
+
+    return load_obj(
+        ctx,
+        filepath,
+        texture_filepath,
+        position,
+        texture_format,
+        flip_texture,
+        unlit,
+        pack,
+        atlas)
+
+
+def load_cubemap(ctx: moderngl.Context, name: str, pack: AssetPack = None) -> moderngl.TextureCube:
+    """
+    Cube map from the six images '<name>_right.png', '_left', '_top',
+    '_bottom', '_front' and '_back', or from 'pack' if it has 'name'
+    """
+    if pack is not None and name in pack:
+        return track(pack.cubemap(ctx, name), "cubemap")
+
+    faces = [
+        pygame.image.load(f"{name}_{face}.png").convert((255, 65280, 16711680, 0))
+        for face in ("right", "left", "top", "bottom", "front", "back")
+    ]
+    data = b"".join(face.get_view("1").raw for face in faces)
+
+    return track(ctx.texture_cube(faces[0].get_size(), 3, data), "cubemap")
+
 
-def create_skybox(ctx, texture):
-    return Skybox(ctx, texture)
\ No newline at end of file
+def create_skybox(ctx, texture, pack: AssetPack = None):
+    return Skybox(ctx, texture, pack)
@@ -3,8 +3,12 @@ Converts OBJ (Wavefront) files to vertex, texture and
 normal coordinates.
 
 The parser currently doesn't examine material data.
-Only triangular faces are supported
-  (f v/vt/vn v/vt/vn v/vt/vn)
+Faces can be triangles or convex polygons, which are split into
+triangle fans, in any of the forms
+  (f v v v), (f v/vt v/vt v/vt), (f v//vn v//vn v//vn), (f v/vt/vn v/vt/vn v/vt/vn)
+Negative indices count back from the last vertex read. Corners without
+texture coordinates get (0, 0) and faces without normals get their flat
+face normal.
 """
 
 from typing import Union
@@ -28,6 +32,15 @@ class ObjFile:
         self.smooth_shading = smooth_shading
 
 
+def _index(token: str, count: int) -> int:
+    """
+    Zero based index of a face index token, -1 if it's empty
+    """
+    if not token: return -1
+    i = int(token)
+    return i - 1 if i > 0 else count + i
+
+
 def parse(filepath: Union[Path, str]) -> ObjFile:
     object_name = ""
 
@@ -43,50 +56,78 @@ def parse(filepath: Union[Path, str]) -> ObjFile:
 
     with open(filepath, "r") as f:
 
-        for line in f.readlines():
+        for line in f:
             cnt = line.split()
 
-            if cnt[0] == "o":
+            # Blank lines and comments
+            if not cnt or cnt[0].startswith("#"):
+                continue
+
+            if cnt[0] == "o" and len(cnt) > 1:
                 object_name = cnt[1]
 
-            if cnt[0] == "v":
+            elif cnt[0] == "v":
                 vert_coords.append((float(cnt[1]), float(cnt[2]), float(cnt[3])))
 
             elif cnt[0] == "vt":
-                tex_coords.append((float(cnt[1]), float(cnt[2])))
+                # 'v' and 'w' are optional
+                u = float(cnt[1])
+                v = float(cnt[2]) if len(cnt) > 2 else 0.0
+                tex_coords.append((u, v))
 
             elif cnt[0] == "vn":
                 norm_coords.append((float(cnt[1]), float(cnt[2]), float(cnt[3])))
 
             elif cnt[0] == "f":
+                corners = []
                 for d in cnt[1:]:
                     h = d.split("/")
-                    vert_indices.append(int(h[0])-1)
-                    tex_indices.append(int(h[1])-1)
-                    norm_indices.append(int(h[2])-1)
-
-            elif cnt[0] == "s":
+                    corners.append((
+                        _index(h[0], len(vert_coords)),
+                        _index(h[1], len(tex_coords)) if len(h) > 1 else -1,
+                        _index(h[2], len(norm_coords)) if len(h) > 2 else -1
+                    ))
+
+                # Polygons are split into a fan around their first corner
+                for i in range(1, len(corners) - 1):
+                    for v, vt, vn in (corners[0], corners[i], corners[i + 1]):
+                        vert_indices.append(v)
+                        tex_indices.append(vt)
+                        norm_indices.append(vn)
+
+            elif cnt[0] == "s" and len(cnt) > 1:
                 if cnt[1] in ("on", "1"):
                     smooth_shading = True
                 else:
                     smooth_shading = False
-   
-    final_vert = []
-    final_tex = []
-    final_norm = []
-
-    for i in vert_indices:
-        final_vert.append(vert_coords[i])
-
-    for j in tex_indices:
-        final_tex.append(tex_coords[j])
-
-    for k in norm_indices:
-        final_norm.append(norm_coords[k])
-
-
-    final_vert = list(numpy.concatenate(final_vert).flat)
-    final_tex = list(numpy.concatenate(final_tex).flat)
-    final_norm = list(numpy.concatenate(final_norm).flat)
 
-    return ObjFile(object_name, final_vert, final_tex, final_norm, smooth_shading)
\ No newline at end of file
+    vert_indices = numpy.array(vert_indices, dtype=numpy.int64)
+    tex_indices = numpy.array(tex_indices, dtype=numpy.int64)
+    norm_indices = numpy.array(norm_indices, dtype=numpy.int64)
+
+    final_vert = numpy.array(vert_coords, dtype=numpy.float64).reshape(-1, 3)[vert_indices]
+
+    # Missing texture coordinates and normals are gathered from an extra
+    # row appended at index -1
+    tex = numpy.zeros((len(tex_coords) + 1, 2))
+    tex[:-1] = numpy.array(tex_coords, dtype=numpy.float64).reshape(-1, 2)
+    final_tex = tex[tex_indices]
+
+    nor = numpy.zeros((len(norm_coords) + 1, 3))
+    nor[:-1] = numpy.array(norm_coords, dtype=numpy.float64).reshape(-1, 3)
+    final_norm = nor[norm_indices]
+
+    missing = (norm_indices < 0).reshape(-1, 3).any(axis=1)
+    if missing.any():
+        triangles = final_vert.reshape(-1, 3, 3)[missing]
+        normals = numpy.cross(triangles[:, 1] - triangles[:, 0], triangles[:, 2] - triangles[:, 0])
+        lengths = numpy.linalg.norm(normals, axis=1, keepdims=True)
+        normals /= numpy.where(lengths > 0, lengths, 1.0)
+        final_norm.reshape(-1, 3, 3)[missing] = normals[:, None, :]
+
+    return ObjFile(
+        object_name,
+        final_vert.reshape(-1).tolist(),
+        final_tex.reshape(-1).tolist(),
+        final_norm.reshape(-1).tolist(),
+        smooth_shading)
@@ -0,0 +1,306 @@
+"""
+Hierarchical-Z occlusion culling on the CPU
+
+Occluders are rasterized into a small depth buffer by a software rasterizer
+vectorized with NumPy, then a chain of mip levels keeping the farthest depth
+of each 2x2 block is built from it. A bounding box is hidden when its nearest
+point is behind the farthest occluder depth of the (at most 2x2) texels
+covering it on the level matching its screen size, so every test reads four
+texels however big the box is.
+
+  culler.begin(camera)
+  culler.add_occluders([wall, building])
+  models = culler.cull(models)
+"""
+
+import time
+
+import numpy
+
+from .camera import Camera
+from .utils import frustum_planes, boxes_in_frustum
+
+
+# Bounding box sizes in pixels small triangles are rasterized in batches of
+TILE_SIZES = (4, 16, 64)
+
+# Samples rasterized at once, bounds the memory of a batch
+BATCH_SAMPLES = 1 << 20
+
+# Clip space w under which geometry is treated as crossing the near plane
+NEAR_W = 1e-3
+
+
+def box_corners(mins: numpy.ndarray, maxs: numpy.ndarray) -> numpy.ndarray:
+    """
+    (n, 8, 3) corners of (n, 3) boxes
+    """
+    corners = numpy.empty((len(mins), 8, 3), dtype=numpy.float64)
+    for i in range(8):
+        corners[:, i, 0] = maxs[:, 0] if i & 1 else mins[:, 0]
+        corners[:, i, 1] = maxs[:, 1] if i & 2 else mins[:, 1]
+        corners[:, i, 2] = maxs[:, 2] if i & 4 else mins[:, 2]
+    return corners
+
+
+class OcclusionCuller:
+    """
+    Culls bounding boxes hidden behind occluders, from the frustum of the
+    camera given to 'begin'
+
+    Occluders should be a few big, simple models like walls, floors and
+    buildings. Rasterized triangles only cover the pixels whose centers they
+    contain, and back faces and geometry crossing the near plane are skipped,
+    so the depth buffer never claims more is hidden than really is.
+    """
+    def __init__(self, resolution: tuple[int, int] = (256, 128)):
+        self.width, self.height = resolution
+        self.depth = numpy.ones((self.height, self.width), dtype=numpy.float32)
+        self.levels = [self.depth]
+        self._built = True
+
+        self.view_projection = numpy.identity(4, dtype=numpy.float64)
+        self.planes = frustum_planes(self.view_projection)
+
+        # World space triangles of occluder models, kept while they don't move
+        # and are added every frame. The previous frame's entries are dropped
+        # at 'begin' unless the model is added again.
+        self._occluder_cache = {}
+        self._previous_occluders = {}
+
+        self.occluder_triangles = 0
+        self.raster_time = 0.0
+        self.tested = 0
+        self.frustum_culled = 0
+        self.occluded = 0
+
+    def begin(self, camera: Camera):
+        """
+        Clear the depth buffer and the counters for a new frame
+        """
+        camera.update_matrices()
+        self.view_projection = camera.view_projection.astype(numpy.float64)
+        self.planes = frustum_planes(self.view_projection)
+
+        self.depth.fill(1.0)
+        self.levels = [self.depth]
+        self._built = True
+
+        self._previous_occluders = self._occluder_cache
+        self._occluder_cache = {}
+
+        self.occluder_triangles = 0
+        self.raster_time = 0.0
+        self.tested = 0
+        self.frustum_culled = 0
+        self.occluded = 0
+
+    def add_occluders(self, models: list):
+        """
+        Rasterize models' triangles (anything with 'world_vertices' and
+        'transform_matrix' like BaseModel)
+        """
+        for model in models:
+            transform = model.transform_matrix().tobytes()
+            cached = self._occluder_cache.get(model)
+            if cached is None: cached = self._previous_occluders.pop(model, None)
+
+            if cached is None or cached[0] != transform:
+                cached = (transform, model.world_vertices().astype(numpy.float64).reshape(-1, 3, 3))
+            self._occluder_cache[model] = cached
+
+            self.add_triangles(cached[1])
+
+    def forget(self, model):
+        """
+        Drop the cached triangles of an occluder that won't be used again
+        """
+        self._occluder_cache.pop(model, None)
+        self._previous_occluders.pop(model, None)
+
+    def add_triangles(self, triangles: numpy.ndarray):
+        """
+        Rasterize (n, 3, 3) world space triangles into the depth buffer
+        """
+        start = time.perf_counter()
+
+        triangles = numpy.asarray(triangles, dtype=numpy.float64).reshape(-1, 3, 3)
+        clip = triangles @ self.view_projection[:3] + self.view_projection[3]
+
+        # Triangles crossing the near plane are left out, clipping them would
+        # only add occlusion near the camera
+        w = clip[..., 3]
+        keep = numpy.all(w > NEAR_W, axis=1)
+        clip, w = clip[keep], w[keep]
+
+        ndc = clip[..., :3] / w[..., None]
+        x = (ndc[..., 0] * 0.5 + 0.5) * self.width
+        y = (ndc[..., 1] * 0.5 + 0.5) * self.height
+        z = ndc[..., 2] * 0.5 + 0.5
+
+        # Pixels whose centers are in the bounding box, clipped to the screen
+        x0 = numpy.maximum(numpy.ceil(x.min(axis=1) - 0.5), 0).astype(numpy.int64)
+        x1 = numpy.minimum(numpy.floor(x.max(axis=1) - 0.5), self.width - 1).astype(numpy.int64)
+        y0 = numpy.maximum(numpy.ceil(y.min(axis=1) - 0.5), 0).astype(numpy.int64)
+        y1 = numpy.minimum(numpy.floor(y.max(axis=1) - 0.5), self.height - 1).astype(numpy.int64)
+
+        # Back faces (clockwise on screen like the renderer culls them) are
+        # skipped, in closed meshes the front faces cover the same pixels
+        area = (x[:, 1] - x[:, 0]) * (y[:, 2] - y[:, 0]) - (x[:, 2] - x[:, 0]) * (y[:, 1] - y[:, 0])
+        keep = (x0 <= x1) & (y0 <= y1) & (area > 1e-12) & (z.min(axis=1) <= 1.0)
+
+        size = numpy.maximum(x1 - x0, y1 - y0) + 1
+        self.occluder_triangles += int(keep.sum())
+        self._built = False
+
+        # Small triangles are batched by the size of their bounding box, each
+        # one gets a tile x tile grid of samples. The few big ones get a grid
+        # the size of their own bounding box.
+        lower = 0
+        for tile in TILE_SIZES:
+            selected = numpy.nonzero(keep & (size > lower) & (size <= tile))[0]
+            lower = tile
+
+            batch = max(1, BATCH_SAMPLES // (tile * tile))
+            for i in range(0, len(selected), batch):
+                s = selected[i:i+batch]
+                self._rasterize(x[s], y[s], z[s], area[s], x0[s], y0[s], x1[s], y1[s], (tile, tile))
+
+        for i in numpy.nonzero(keep & (size > lower))[0]:
+            s = slice(i, i + 1)
+            self._rasterize(x[s], y[s], z[s], area[s], x0[s], y0[s], x1[s], y1[s], (y1[i] - y0[i] + 1, x1[i] - x0[i] + 1))
+
+        self.raster_time += time.perf_counter() - start
+
+    def _rasterize(self, x, y, z, area, x0, y0, x1, y1, grid: tuple[int, int]):
+        px = x0[:, None, None] + numpy.arange(grid[1])[None, None, :]
+        py = y0[:, None, None] + numpy.arange(grid[0])[None, :, None]
+        inside = (px <= x1[:, None, None]) & (py <= y1[:, None, None])
+
+        cx = px + 0.5
+        cy = py + 0.5
+
+        def edge(a, b):
+            return (x[:, b, None, None] - x[:, a, None, None]) * (cy - y[:, a, None, None]) \
+                 - (y[:, b, None, None] - y[:, a, None, None]) * (cx - x[:, a, None, None])
+
+        # Barycentric weights
+        inv = 1.0 / area[:, None, None]
+        w0 = edge(1, 2) * inv
+        w1 = edge(2, 0) * inv
+        w2 = 1.0 - w0 - w1
+        covered = inside & (w0 >= 0) & (w1 >= 0) & (w2 >= 0)
+
+        depth = w0 * z[:, 0, None, None] + w1 * z[:, 1, None, None] + w2 * z[:, 2, None, None]
+        covered &= depth >= 0.0
+
+        index = (py * self.width + px)[covered]
+        numpy.minimum.at(self.depth.reshape(-1), index, depth[covered].astype(numpy.float32))
+
+    def build(self):
+        """
+        Build the mip chain from the depth buffer, done by the first test
+        after occluders were added
+        """
+        self._built = True
+        self.levels = [self.depth]
+        level = self.depth
+
+        while level.shape[0] > 1 or level.shape[1] > 1:
+            h, w = level.shape
+            # Odd edges are padded with the far plane, so they never hide anything
+            padded = numpy.ones((h + h % 2, w + w % 2), dtype=numpy.float32)
+            padded[:h, :w] = level
+            level = padded.reshape(padded.shape[0] // 2, 2, padded.shape[1] // 2, 2).max(axis=(1, 3))
+            self.levels.append(level)
+
+    def test_boxes(self, mins: numpy.ndarray, maxs: numpy.ndarray) -> numpy.ndarray:
+        """
+        Boolean mask of the (n, 3) world space bounding boxes that are in the
+        frustum and not hidden behind occluders
+        """
+        mins = numpy.asarray(mins, dtype=numpy.float64).reshape(-1, 3)
+        maxs = numpy.asarray(maxs, dtype=numpy.float64).reshape(-1, 3)
+        count = len(mins)
+
+        visible = boxes_in_frustum(self.planes, mins, maxs)
+        self.tested += count
+        self.frustum_culled += count - int(visible.sum())
+
+        candidates = numpy.nonzero(visible)[0]
+        if len(candidates) == 0 or self.occluder_triangles == 0:
+            return visible
+
+        if not self._built: self.build()
+
+        corners = box_corners(mins[candidates], maxs[candidates])
+        clip = corners @ self.view_projection[:3] + self.view_projection[3]
+        w = clip[..., 3]
+
+        # Boxes reaching behind the camera are kept
+        testable = numpy.all(w > NEAR_W, axis=1)
+        candidates, clip, w = candidates[testable], clip[testable], w[testable]
+
+        ndc = clip[..., :3] / w[..., None]
+        x = (ndc[..., 0] * 0.5 + 0.5) * self.width
+        y = (ndc[..., 1] * 0.5 + 0.5) * self.height
+        nearest = (ndc[..., 2] * 0.5 + 0.5).min(axis=1)
+
+        px0 = numpy.clip(numpy.floor(x.min(axis=1)), 0, self.width - 1).astype(numpy.int64)
+        px1 = numpy.clip(numpy.floor(x.max(axis=1)), 0, self.width - 1).astype(numpy.int64)
+        py0 = numpy.clip(numpy.floor(y.min(axis=1)), 0, self.height - 1).astype(numpy.int64)
+        py1 = numpy.clip(numpy.floor(y.max(axis=1)), 0, self.height - 1).astype(numpy.int64)
+
+        # The level where the box covers at most 2x2 texels
+        span = numpy.maximum(px1 - px0, py1 - py0) + 1
+        level_index = numpy.minimum(numpy.ceil(numpy.log2(span)).astype(numpy.int64), len(self.levels) - 1)
+
+        farthest = numpy.empty(len(candidates), dtype=numpy.float32)
+        for l in numpy.unique(level_index):
+            s = numpy.nonzero(level_index == l)[0]
+            level = self.levels[l]
+            tx0, tx1 = px0[s] >> l, px1[s] >> l
+            ty0, ty1 = py0[s] >> l, py1[s] >> l
+            farthest[s] = numpy.maximum(
+                numpy.maximum(level[ty0, tx0], level[ty0, tx1]),
+                numpy.maximum(level[ty1, tx0], level[ty1, tx1]))
+
+        hidden = nearest > farthest
+        visible[candidates[hidden]] = False
+        self.occluded += int(hidden.sum())
+
+        return visible
+
+    def cull(self, models: list) -> list:
+        """
+        Models (anything with 'bounds' like BaseModel) that aren't hidden
+        """
+        if not models: return []
+
+        bounds = [model.bounds() for model in models]
+        mins = numpy.array([b[0] for b in bounds])
+        maxs = numpy.array([b[1] for b in bounds])
+
+        visible = self.test_boxes(mins, maxs)
+        return [model for model, v in zip(models, visible) if v]
+
+    @property
+    def visible(self) -> int:
+        return self.tested - self.frustum_culled - self.occluded
+
+    def stats(self) -> dict:
+        return {
+            "occluder_triangles": self.occluder_triangles,
+            "raster_ms": self.raster_time * 1000,
+            "tested": self.tested,
+            "frustum_culled": self.frustum_culled,
+            "occluded": self.occluded,
+            "visible": self.visible
+        }
+
+    def debug_image(self, level: int = 0) -> numpy.ndarray:
+        """
+        A level of the mip chain as an 8-bit grayscale image, near is dark
+        """
+        depth = self.levels[min(level, len(self.levels) - 1)]
+        return (numpy.flipud(depth) * 255).astype(numpy.uint8)
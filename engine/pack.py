@@ -0,0 +1,295 @@
+"""
+Packed asset archive
+
+All preprocessed assets (parsed meshes, decoded textures and cubemaps,
+PCM audio and shader sources) are stored in a single file so the engine
+can memory-map it at startup instead of opening and decoding every file.
+
+Layout:
+  header  magic, version, index offset and index size
+  blobs   raw entry data, each aligned to 16 bytes
+  index   UTF-8 JSON mapping entry names to offsets and metadata
+
+Entries are named after the source file path relative to the repository
+root (e.g. "assets/models/cube.obj"). Build a pack with:
+  python -m engine.pack [output]
+
+Each entry records the size and modification time of its source files. An
+entry whose sources have changed since the pack was built is treated as
+missing, so the asset is loaded from its files instead of the stale copy.
+"""
+
+from typing import Union
+
+from pathlib import Path
+import sys
+import mmap
+import json
+import struct
+import numpy
+import pygame
+import moderngl
+
+from .objparser import parse
+
+
+MAGIC = b"PGLPACK\0"
+VERSION = 1
+HEADER = struct.Struct("<8sIQQ")
+ALIGNMENT = 16
+
+
+def entry_name(path: Union[Path, str]) -> str:
+    return Path(path).as_posix()
+
+
+def texture_name(path: Union[Path, str], flipped: bool = False) -> str:
+    name = entry_name(path)
+    return name + "#flipped" if flipped else name
+
+
+def _source_stats(paths: list[Union[Path, str]]) -> dict[str, list[int]]:
+    stats = {}
+    for path in paths:
+        stat = Path(path).stat()
+        stats[entry_name(path)] = [stat.st_size, stat.st_mtime_ns]
+    return stats
+
+
+class PackBuilder:
+    """
+    Collects preprocessed assets and writes them to a pack file
+    """
+    def __init__(self):
+        self.entries: dict[str, tuple[dict, bytes]] = {}
+
+    def add_mesh(self, path: Union[Path, str]):
+        objfile = parse(path)
+
+        pos = numpy.asarray(objfile.vertices, dtype="f4").tobytes()
+        uv  = numpy.asarray(objfile.uv_coords, dtype="f4").tobytes()
+        nor = numpy.asarray(objfile.vertex_normals, dtype="f4").tobytes()
+
+        meta = {"type": "mesh", "sizes": [len(pos), len(uv), len(nor)], "sources": _source_stats([path])}
+        self.entries[entry_name(path)] = (meta, pos + uv + nor)
+
+    def add_texture(self, path: Union[Path, str]):
+        """
+        Textures are stored once, flipped ones are flipped when loaded
+        """
+        surface = pygame.image.load(path)
+
+        texture_format = "RGBA" if surface.get_flags() & pygame.SRCALPHA else "RGB"
+
+        meta = {"type": "texture", "size": surface.get_size(), "format": texture_format, "sources": _source_stats([path])}
+        self.entries[entry_name(path)] = (meta, pygame.image.tostring(surface, texture_format, True))
+
+    def add_cubemap(self, name: str, faces: list[Union[Path, str]]):
+        """
+        Faces are in OpenGL order: right, left, top, bottom, front, back
+        """
+        surfaces = [pygame.image.load(face) for face in faces]
+        data = b"".join(pygame.image.tostring(surface, "RGB") for surface in surfaces)
+
+        meta = {"type": "cubemap", "size": surfaces[0].get_size(), "format": "RGB", "sources": _source_stats(faces)}
+        self.entries[name] = (meta, data)
+
+    def add_sound(self, path: Union[Path, str]):
+        """
+        Sounds are stored as PCM in the current mixer format
+        """
+        if not pygame.mixer.get_init(): pygame.mixer.init()
+
+        sound = pygame.mixer.Sound(path)
+
+        meta = {"type": "sound", "mixer": pygame.mixer.get_init(), "sources": _source_stats([path])}
+        self.entries[entry_name(path)] = (meta, sound.get_raw())
+
+    def add_shader(self, path: Union[Path, str]):
+        with open(path, "rb") as f:
+            self.entries[entry_name(path)] = ({"type": "shader", "sources": _source_stats([path])}, f.read())
+
+    def write(self, filepath: Union[Path, str]):
+        index = {}
+
+        with open(filepath, "wb") as f:
+            f.write(b"\0" * HEADER.size)
+
+            for name, (meta, data) in self.entries.items():
+                f.write(b"\0" * (-f.tell() % ALIGNMENT))
+                index[name] = {**meta, "offset": f.tell(), "length": len(data)}
+                f.write(data)
+
+            index_data = json.dumps(index).encode("utf-8")
+            index_offset = f.tell()
+            f.write(index_data)
+
+            f.seek(0)
+            f.write(HEADER.pack(MAGIC, VERSION, index_offset, len(index_data)))
+
+
+class AssetPack:
+    """
+    Memory-mapped pack file
+
+    Data is handed out as memoryview slices of the mapping, so uploading it to
+    the GPU or the mixer doesn't decode or copy anything on the Python side.
+    """
+    def __init__(self, filepath: Union[Path, str]):
+        self.filepath = filepath
+
+        self._file = open(filepath, "rb")
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        self._view = memoryview(self._mmap)
+
+        magic, version, index_offset, index_size = HEADER.unpack_from(self._mmap)
+        if magic != MAGIC:
+            raise ValueError(f"{filepath} is not an asset pack")
+        if version != VERSION:
+            raise ValueError(f"{filepath} has pack version {version}, expected {VERSION}")
+
+        self.index: dict[str, dict] = json.loads(bytes(self._view[index_offset:index_offset+index_size]))
+
+        # Entries checked against their source files, see is_stale
+        self._stale: dict[str, bool] = {}
+
+    def __contains__(self, name: Union[Path, str]) -> bool:
+        """
+        Whether the pack has an up to date entry for 'name'
+        """
+        name = entry_name(name)
+        return name in self.index and not self.is_stale(name)
+
+    def is_stale(self, name: Union[Path, str]) -> bool:
+        """
+        Whether a source file of the entry changed since the pack was built.
+        Sources that don't exist (e.g. a game shipped with only the pack)
+        aren't checked, entries of packs built without source stats are
+        always stale.
+        """
+        name = entry_name(name)
+        if name not in self._stale:
+            sources = self.index[name].get("sources")
+            stale = sources is None
+
+            for path, (size, mtime) in (sources or {}).items():
+                try:
+                    stat = Path(path).stat()
+                except OSError:
+                    continue
+
+                if stat.st_size != size or stat.st_mtime_ns != mtime:
+                    stale = True
+                    break
+
+            self._stale[name] = stale
+
+        return self._stale[name]
+
+    def stale(self) -> list[str]:
+        """
+        Names of all the entries loaded from their files instead of the pack
+        """
+        return [name for name in self.index if self.is_stale(name)]
+
+    def view(self, name: Union[Path, str]) -> memoryview:
+        entry = self.index[entry_name(name)]
+        return self._view[entry["offset"]:entry["offset"]+entry["length"]]
+
+    def mesh(self, name: Union[Path, str]) -> tuple[memoryview, memoryview, memoryview]:
+        """
+        Returns position, texture coordinate and normal data as float32 views
+        """
+        entry = self.index[entry_name(name)]
+        view = self.view(name)
+
+        pos_size, uv_size, nor_size = entry["sizes"]
+        return (
+            view[:pos_size].cast("f"),
+            view[pos_size:pos_size+uv_size].cast("f"),
+            view[pos_size+uv_size:pos_size+uv_size+nor_size].cast("f")
+        )
+
+    def texture(self,
+            ctx: moderngl.Context,
+            name: Union[Path, str],
+            build_mipmaps: bool = True,
+            flip: bool = False) -> moderngl.Texture:
+        """
+        Upload a texture, 'flip' flips it vertically like loading the file
+        with flip_texture does (the rows are copied instead of uploaded as is)
+        """
+        entry = self.index[entry_name(name)]
+
+        data = self.view(name)
+        if flip:
+            data = numpy.frombuffer(data, dtype=numpy.uint8).reshape(entry["size"][1], -1)[::-1].tobytes()
+
+        texture = ctx.texture(entry["size"], len(entry["format"]), data)
+        texture.repeat_x = False
+        texture.repeat_y = False
+        if build_mipmaps: texture.build_mipmaps()
+
+        return texture
+
+    def cubemap(self, ctx: moderngl.Context, name: str) -> moderngl.TextureCube:
+        entry = self.index[name]
+        return ctx.texture_cube(entry["size"], len(entry["format"]), self.view(name))
+
+    def sound(self, name: Union[Path, str]) -> pygame.mixer.Sound:
+        """
+        Sounds packed with a different mixer format are loaded from their source file
+        """
+        entry = self.index[entry_name(name)]
+
+        if tuple(entry["mixer"]) != pygame.mixer.get_init():
+            return pygame.mixer.Sound(name)
+
+        return pygame.mixer.Sound(buffer=self.view(name))
+
+    def shader(self, name: Union[Path, str]) -> str:
+        return str(self.view(name), "utf-8")
+
+    def close(self):
+        try:
+            self._view.release()
+            self._mmap.close()
+        except BufferError:
+            # Views handed out are still alive, the mapping is closed when they're collected
+            pass
+        self._file.close()
+
+
+def build_default_pack(filepath: Union[Path, str]):
+    """
+    Pack every model, texture, skybox face, sound and shader in the repository
+    """
+    builder = PackBuilder()
+
+    for path in sorted(Path("assets/models").glob("*.obj")):
+        builder.add_mesh(path)
+
+    for path in sorted(Path("assets/textures").glob("*.png")):
+        builder.add_texture(path)
+
+    builder.add_cubemap("assets/skybox/generic", [
+        f"assets/skybox/generic_{face}.png"
+        for face in ("right", "left", "top", "bottom", "front", "back")
+    ])
+
+    for path in sorted(Path("assets/sounds").glob("*.wav")):
+        builder.add_sound(path)
+
+    for path in sorted(Path("shaders").glob("*.[vf]sh")):
+        builder.add_shader(path)
+
+    builder.write(filepath)
+    return builder
+
+
+if __name__ == "__main__":
+    output = sys.argv[1] if len(sys.argv) > 1 else "assets.pack"
+
+    pygame.mixer.init()
+    builder = build_default_pack(output)
+    print(f"Packed {len(builder.entries)} assets into {output} ({Path(output).stat().st_size} bytes)")
@@ -0,0 +1,204 @@
+"""
+GPU particles
+
+Particle state lives in two vertex buffers. Every update runs the state of
+one buffer through a vertex shader with transform feedback into the other,
+then the buffers swap. Emission respawns a moving window of the ring of
+particles inside the same pass. Particles are drawn as instanced quads facing
+the camera, so the CPU cost of a frame is a few uniform writes and two calls
+whatever the particle count.
+"""
+
+from typing import Union
+
+import numpy
+import pygame
+import moderngl
+
+from .model import PROGRAMS, _compile_programs, _write_camera
+from .camera import Camera
+from .resources import Disposable, track, retain, release
+from .pack import AssetPack
+
+
+# position (3f), age (1f), velocity (3f), lifetime (1f)
+PARTICLE_SIZE = 32
+
+
+class ParticleEmitter(Disposable):
+    """
+    Emits up to 'capacity' live particles at 'rate' particles per second
+
+    Ranges like 'lifetime' and 'speed' are (min, max) pairs picked from at
+    spawn, 'size' and the colors are interpolated over each particle's life.
+    """
+    def __init__(self,
+            ctx: moderngl.Context,
+            capacity: int,
+            position: tuple[float, float, float] = (0.0, 0.0, 0.0),
+            rate: float = 100.0,
+            lifetime: tuple[float, float] = (1.0, 2.0),
+            speed: tuple[float, float] = (1.0, 2.0),
+            direction: tuple[float, float, float] = (0.0, 1.0, 0.0),
+            spread: float = 0.3,
+            radius: float = 0.0,
+            gravity: tuple[float, float, float] = (0.0, -9.8, 0.0),
+            drag: float = 0.0,
+            size: tuple[float, float] = (0.2, 0.05),
+            color_start: tuple[float, float, float, float] = (1.0, 0.8, 0.3, 1.0),
+            color_end: tuple[float, float, float, float] = (1.0, 0.2, 0.0, 0.0),
+            texture: Union[str, pygame.Surface, moderngl.Texture] = None,
+            additive: bool = True,
+            pack: AssetPack = None):
+
+        self.ctx = ctx
+        self.capacity = capacity
+
+        self.position = position
+        self.rate = rate
+        self.lifetime = lifetime
+        self.speed = speed
+        self.direction = direction
+        self.spread = spread
+        self.radius = radius
+        self.gravity = gravity
+        self.drag = drag
+        self.size = size
+        self.color_start = color_start
+        self.color_end = color_end
+        self.additive = additive
+        self.emitting = True
+
+        _compile_programs(ctx, pack=pack)
+        self.update_program = retain(PROGRAMS["particle_update"])
+        self.program = retain(PROGRAMS["particle"])
+
+        self.owns_texture = texture is not None and not isinstance(texture, moderngl.Texture)
+        if self.owns_texture:
+            surface = texture if isinstance(texture, pygame.Surface) else pygame.image.load(texture)
+            texture = track(ctx.texture(surface.get_size(), 4, pygame.image.tostring(surface, "RGBA", True)), self)
+            texture.build_mipmaps()
+        else:
+            texture = retain(texture)
+        self.texture = texture
+
+        self._accumulator = 0.0
+        self._next = 0
+        self._pending = 0
+        self._seed = 0
+
+        self.create_buffers()
+
+    def create_buffers(self):
+        # Every particle starts dead, age past its lifetime
+        state = numpy.zeros((self.capacity, 8), dtype=numpy.float32)
+        state[:, 3] = 1.0
+
+        self.buffers = [track(self.ctx.buffer(state), self), track(self.ctx.buffer(state), self)]
+        self.corners = track(self.ctx.buffer(numpy.array([
+            -0.5, -0.5,
+             0.5, -0.5,
+            -0.5,  0.5,
+             0.5,  0.5
+        ], dtype=numpy.float32)), self)
+
+        self.update_vaos = [
+            track(self.ctx.vertex_array(self.update_program, [
+                (buffer, "3f 1f 3f 1f", "in_position", "in_age", "in_velocity", "in_lifetime")
+            ]), self)
+            for buffer in self.buffers
+        ]
+
+        self.render_vaos = [
+            track(self.ctx.vertex_array(self.program, [
+                (self.corners, "2f", "a_corner"),
+                (buffer, "3f 1f 12x 1f/i", "in_position", "in_age", "in_lifetime")
+            ]), self)
+            for buffer in self.buffers
+        ]
+
+        # Index of the buffer holding the current state
+        self.current = 0
+
+    def burst(self, count: int):
+        """
+        Spawn 'count' particles on the next update
+        """
+        self._pending += count
+
+    def update(self, dt: float):
+        """
+        Simulate 'dt' seconds on the GPU
+        """
+        if self.emitting:
+            self._accumulator += self.rate * dt
+
+        count = int(self._accumulator) + self._pending
+        self._accumulator -= int(self._accumulator)
+        self._pending = 0
+        count = min(count, self.capacity)
+
+        program = self.update_program
+        program["dt"].value = dt
+        program["seed"].value = self._seed
+        program["capacity"].value = self.capacity
+        program["emit_start"].value = self._next
+        program["emit_count"].value = count
+        program["emitter_position"].value = tuple(self.position)
+        program["emitter_radius"].value = self.radius
+        program["direction"].value = tuple(self.direction)
+        program["spread"].value = self.spread
+        program["speed"].value = tuple(self.speed)
+        program["lifetime"].value = tuple(self.lifetime)
+        program["gravity"].value = tuple(self.gravity)
+        program["drag"].value = self.drag
+
+        target = 1 - self.current
+        self.update_vaos[self.current].transform(self.buffers[target], moderngl.POINTS, vertices=self.capacity)
+        self.current = target
+
+        self._next = (self._next + count) % self.capacity
+        self._seed = (self._seed + 1) & 0xFFFFFFFF
+
+    def render(self, camera: Camera):
+        _write_camera(self.program, camera)
+        self.program["size"].value = tuple(self.size)
+        self.program["color_start"].value = tuple(self.color_start)
+        self.program["color_end"].value = tuple(self.color_end)
+        self.program["textured"].value = self.texture is not None
+
+        if self.texture is not None: self.texture.use(location=0)
+
+        # Particles are blended, they test against the depth buffer but don't write to it
+        fbo = self.ctx.fbo
+        fbo.depth_mask = False
+        self.ctx.enable(moderngl.BLEND)
+        if self.additive: self.ctx.blend_func = moderngl.ADDITIVE_BLENDING
+
+        self.render_vaos[self.current].render(moderngl.TRIANGLE_STRIP, vertices=4, instances=self.capacity)
+
+        self.ctx.blend_func = moderngl.DEFAULT_BLENDING
+        fbo.depth_mask = True
+
+    def read_state(self) -> numpy.ndarray:
+        """
+        (capacity, 8) copy of the particle state, for debugging
+        """
+        return numpy.frombuffer(self.buffers[self.current].read(), dtype=numpy.float32).reshape(-1, 8)
+
+    def alive(self) -> int:
+        """
+        Number of live particles, reads the state back from the GPU
+        """
+        state = self.read_state()
+        return int(numpy.count_nonzero(state[:, 3] < state[:, 7]))
+
+    def dispose(self):
+        for vao in self.update_vaos + self.render_vaos:
+            release(vao)
+        for buffer in self.buffers:
+            release(buffer)
+        release(self.corners)
+        release(self.texture)
+        release(self.update_program)
+        release(self.program)
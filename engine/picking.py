@@ -0,0 +1,385 @@
+"""
+Ray casting and object picking
+
+Rays are tested against a BVH of each model's mesh in model space, so the
+BVHs don't have to be rebuilt when models move. Many rays can be cast at
+once (e.g. line of sight checks), they traverse the BVH together as a packet.
+
+IdBufferPicker is the GPU alternative: it renders object ids into an
+offscreen framebuffer and reads back the pixel under the cursor.
+"""
+
+from typing import Optional, Iterable
+
+import weakref
+import numpy
+import moderngl
+
+from .model import BaseModel, ModelGroup, PROGRAMS, _compile_programs, _write_camera
+from .camera import Camera
+from .resources import Disposable, track, retain, release
+from .collision import TriangleBVH
+
+
+class RayHit:
+    """
+    Closest intersection of a ray with a model
+
+    'triangle' indexes the model's triangles in vertex order and
+    'barycentric' holds the weights of the triangle's three vertices.
+    """
+    def __init__(self,
+            model: BaseModel,
+            triangle: int,
+            barycentric: tuple[float, float, float],
+            distance: float,
+            point: numpy.ndarray):
+
+        self.model = model
+        self.triangle = triangle
+        self.barycentric = barycentric
+        self.distance = distance
+        self.point = point
+
+
+def _ray_box(origins, inv_directions, lo, hi) -> tuple[numpy.ndarray, numpy.ndarray]:
+    with numpy.errstate(invalid="ignore"):
+        t1 = (lo - origins) * inv_directions
+        t2 = (hi - origins) * inv_directions
+
+    # fmin/fmax skip the NaNs of rays parallel to a slab
+    near = numpy.fmin(t1, t2).max(axis=-1)
+    far = numpy.fmax(t1, t2).min(axis=-1)
+    return near, far
+
+
+def _ray_triangles(origins, directions, a, b, c):
+    """
+    Möller–Trumbore for every ray against every triangle, returns (rays, triangles) arrays
+    """
+    e1 = b - a
+    e2 = c - a
+
+    pvec = numpy.cross(directions[:, None], e2[None])
+    det = numpy.einsum("kj,mkj->mk", e1, pvec)
+
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        inv_det = 1.0 / det
+        tvec = origins[:, None] - a[None]
+        u = numpy.einsum("mkj,mkj->mk", tvec, pvec) * inv_det
+        qvec = numpy.cross(tvec, e1[None])
+        v = numpy.einsum("mj,mkj->mk", directions, qvec) * inv_det
+        t = numpy.einsum("kj,mkj->mk", e2, qvec) * inv_det
+
+        # Parallel rays give infinities here, the det test rejects them
+        valid = (numpy.abs(det) > 1e-12) & (u >= 0) & (v >= 0) & (u + v <= 1) & (t > 1e-6)
+    return numpy.where(valid, t, numpy.inf), u, v
+
+
+def raycast_bvh(
+        bvh: TriangleBVH,
+        origins: numpy.ndarray,
+        directions: numpy.ndarray,
+        max_distance: numpy.ndarray) -> tuple[numpy.ndarray, numpy.ndarray, numpy.ndarray, numpy.ndarray]:
+    """
+    Closest hits of (n, 3) rays against a BVH
+
+    Returns distances (inf for misses), triangle indices in the BVH's input
+    order (-1 for misses) and the u, v barycentric coordinates.
+    """
+    n = len(origins)
+    best_t = numpy.array(max_distance, dtype=numpy.float64)
+    best_tri = numpy.full(n, -1, dtype=numpy.int64)
+    best_u = numpy.zeros(n)
+    best_v = numpy.zeros(n)
+
+    if len(bvh) == 0:
+        return numpy.full(n, numpy.inf), best_tri, best_u, best_v
+
+    with numpy.errstate(divide="ignore"):
+        inv_directions = 1.0 / directions
+
+    stack = [(0, numpy.arange(n))]
+    while stack:
+        node, rays = stack.pop()
+
+        near, far = _ray_box(origins[rays], inv_directions[rays], bvh.node_min[node], bvh.node_max[node])
+        rays = rays[(near <= numpy.minimum(far, best_t[rays])) & (far >= 0)]
+        if len(rays) == 0: continue
+
+        left = bvh.node_left[node]
+        if left >= 0:
+            stack.append((left, rays))
+            stack.append((bvh.node_right[node], rays))
+            continue
+
+        start = bvh.node_start[node]
+        tris = bvh.triangles[start:start+bvh.node_count[node]]
+        t, u, v = _ray_triangles(origins[rays], directions[rays], tris[:, 0], tris[:, 1], tris[:, 2])
+
+        k = numpy.argmin(t, axis=1)
+        m = numpy.arange(len(rays))
+        closer = t[m, k] < best_t[rays]
+
+        hit = rays[closer]
+        best_t[hit] = t[m, k][closer]
+        best_tri[hit] = start + k[closer]
+        best_u[hit] = u[m, k][closer]
+        best_v[hit] = v[m, k][closer]
+
+    missed = best_tri < 0
+    best_t[missed] = numpy.inf
+    best_tri[~missed] = bvh.indices[best_tri[~missed]]
+    return best_t, best_tri, best_u, best_v
+
+
+def screen_ray(
+        camera: Camera,
+        x: float,
+        y: float,
+        window_size: tuple[float, float]) -> tuple[numpy.ndarray, numpy.ndarray]:
+    """
+    World space ray through a window coordinate (pygame's, origin at the top left)
+    """
+    ndc_x = 2.0 * x / window_size[0] - 1.0
+    ndc_y = 1.0 - 2.0 * y / window_size[1]
+
+    # pyrr matrices transform row vectors
+    camera.update_matrices()
+    inverse = numpy.linalg.inv(camera.view_projection.astype(numpy.float64))
+    near = numpy.array([ndc_x, ndc_y, -1.0, 1.0]) @ inverse
+    far = numpy.array([ndc_x, ndc_y, 1.0, 1.0]) @ inverse
+    near = near[:3] / near[3]
+    far = far[:3] / far[3]
+
+    direction = far - near
+    return near, direction / numpy.linalg.norm(direction)
+
+
+class Picker:
+    """
+    Casts rays against models using a BVH per model, built on first use
+    """
+    def __init__(self, models: Iterable[BaseModel] = ()):
+        self.models = list(models)
+        self._bvhs = weakref.WeakKeyDictionary()
+
+    def add(self, model: BaseModel):
+        self.models.append(model)
+
+    def remove(self, model: BaseModel):
+        self.models.remove(model)
+
+    def bvh(self, model: BaseModel) -> TriangleBVH:
+        if model not in self._bvhs:
+            vertices = numpy.asarray(model.model_coords, dtype=numpy.float64).reshape(-1, 3, 3)
+            self._bvhs[model] = TriangleBVH(vertices)
+        return self._bvhs[model]
+
+    def _bounds(self, models: list[BaseModel]) -> tuple[numpy.ndarray, numpy.ndarray]:
+        """
+        World space boxes around each model's transformed mesh bounds
+        """
+        lo = numpy.empty((len(models), 3))
+        hi = numpy.empty((len(models), 3))
+
+        for i, model in enumerate(models):
+            m = model.transform_matrix()
+            mesh_lo, mesh_hi = self.bvh(model).bounds
+            center = m[:3, :3] @ ((mesh_lo + mesh_hi) * 0.5) + m[:3, 3]
+            extent = numpy.abs(m[:3, :3]) @ ((mesh_hi - mesh_lo) * 0.5)
+            lo[i] = center - extent
+            hi[i] = center + extent
+
+        return lo, hi
+
+    def raycast_many(self,
+            origins: numpy.ndarray,
+            directions: numpy.ndarray,
+            max_distance: float = numpy.inf,
+            models: Iterable[BaseModel] = None) -> tuple[numpy.ndarray, list, numpy.ndarray, numpy.ndarray]:
+        """
+        Cast (n, 3) rays, directions should be normalized
+
+        Returns distances (inf for misses), the hit model of each ray (None
+        for misses), triangle indices and (n, 3) barycentric coordinates.
+        """
+        models = self.models if models is None else list(models)
+        origins = numpy.asarray(origins, dtype=numpy.float64).reshape(-1, 3)
+        directions = numpy.asarray(directions, dtype=numpy.float64).reshape(-1, 3)
+        n = len(origins)
+
+        distances = numpy.broadcast_to(numpy.asarray(max_distance, dtype=numpy.float64), (n,)).copy()
+        hit_model = numpy.full(n, -1, dtype=numpy.int64)
+        triangles = numpy.full(n, -1, dtype=numpy.int64)
+        barycentric = numpy.zeros((n, 3))
+
+        if models:
+            with numpy.errstate(divide="ignore"):
+                inv_directions = 1.0 / directions
+            lo, hi = self._bounds(models)
+
+            for i, model in enumerate(models):
+                near, far = _ray_box(origins, inv_directions, lo[i], hi[i])
+                rays = numpy.flatnonzero((near <= numpy.minimum(far, distances)) & (far >= 0))
+                if len(rays) == 0: continue
+
+                # Into model space, t stays the world space distance
+                m = model.transform_matrix()
+                inverse = numpy.linalg.inv(m)
+                local_origins = origins[rays] @ inverse[:3, :3].T + inverse[:3, 3]
+                local_directions = directions[rays] @ inverse[:3, :3].T
+
+                t, tri, u, v = raycast_bvh(self.bvh(model), local_origins, local_directions, distances[rays])
+
+                closer = tri >= 0
+                hit = rays[closer]
+                distances[hit] = t[closer]
+                hit_model[hit] = i
+                triangles[hit] = tri[closer]
+                barycentric[hit, 0] = 1.0 - u[closer] - v[closer]
+                barycentric[hit, 1] = u[closer]
+                barycentric[hit, 2] = v[closer]
+
+        distances[hit_model < 0] = numpy.inf
+        return distances, [models[i] if i >= 0 else None for i in hit_model], triangles, barycentric
+
+    def raycast(self,
+            origin: numpy.ndarray,
+            direction: numpy.ndarray,
+            max_distance: float = numpy.inf,
+            models: Iterable[BaseModel] = None) -> Optional[RayHit]:
+
+        origin = numpy.asarray(origin, dtype=numpy.float64)
+        direction = numpy.asarray(direction, dtype=numpy.float64)
+        direction = direction / numpy.linalg.norm(direction)
+
+        distances, hit_models, triangles, barycentric = self.raycast_many(
+            origin[None], direction[None], max_distance, models)
+
+        if hit_models[0] is None:
+            return None
+
+        return RayHit(
+            hit_models[0],
+            int(triangles[0]),
+            tuple(barycentric[0]),
+            float(distances[0]),
+            origin + direction * distances[0])
+
+    def pick_center(self, camera: Camera, max_distance: float = numpy.inf, models: Iterable[BaseModel] = None) -> Optional[RayHit]:
+        """
+        What is under the crosshair
+        """
+        return self.raycast(camera.final_position, camera.front, max_distance, models)
+
+    def pick_screen(self,
+            camera: Camera,
+            x: float,
+            y: float,
+            window_size: tuple[float, float],
+            max_distance: float = numpy.inf,
+            models: Iterable[BaseModel] = None) -> Optional[RayHit]:
+
+        origin, direction = screen_ray(camera, x, y, window_size)
+        return self.raycast(origin, direction, max_distance, models)
+
+    def line_of_sight(self,
+            origins: numpy.ndarray,
+            targets: numpy.ndarray,
+            models: Iterable[BaseModel] = None) -> numpy.ndarray:
+        """
+        Whether each origin can see its target, as a boolean array
+        """
+        origins = numpy.asarray(origins, dtype=numpy.float64).reshape(-1, 3)
+        delta = numpy.asarray(targets, dtype=numpy.float64).reshape(-1, 3) - origins
+        length = numpy.linalg.norm(delta, axis=1)
+
+        with numpy.errstate(divide="ignore", invalid="ignore"):
+            directions = delta / length[:, None]
+
+        distances, _, _, _ = self.raycast_many(origins, directions, length, models)
+        return ~numpy.isfinite(distances)
+
+
+class IdBufferPicker(Disposable):
+    """
+    Pixel exact picking by rendering object ids into an offscreen buffer
+    """
+    def __init__(self, ctx: moderngl.Context, size: tuple[int, int]):
+        self.ctx = ctx
+        self.size = size
+
+        _compile_programs(ctx)
+        self.program = retain(PROGRAMS["picking"])
+
+        self.texture = track(ctx.texture(size, 4), self)
+        self.depth = track(ctx.depth_renderbuffer(size), self)
+        self.fbo = track(ctx.framebuffer(color_attachments=[self.texture], depth_attachment=self.depth), self)
+
+        self.models: list[BaseModel] = []
+        self._vaos = weakref.WeakKeyDictionary()
+
+    def _vao(self, model: BaseModel) -> moderngl.VertexArray:
+        # Built by the model from its own position binding and index buffer
+        if model not in self._vaos:
+            self._vaos[model] = model.position_vao(self.program)
+        return self._vaos[model]
+
+    def forget(self, model: BaseModel):
+        """
+        Free the vertex array of a model that won't be picked again, call it
+        before disposing the model
+        """
+        for part in self._parts(model):
+            release(self._vaos.pop(part, None))
+
+    @staticmethod
+    def _parts(model) -> Iterable[BaseModel]:
+        # A model group is one object drawn as its models
+        return model.models if isinstance(model, ModelGroup) else (model,)
+
+    def render(self, camera: Camera, models: Iterable[BaseModel]):
+        """
+        Draw the models' ids, id 0 is the background
+        """
+        previous = self.ctx.fbo
+        self.models = list(models)
+
+        self.fbo.use()
+        self.fbo.clear(0.0, 0.0, 0.0, 0.0, depth=1.0)
+
+        _write_camera(self.program, camera)
+
+        for i, model in enumerate(self.models, start=1):
+            self.program["object_id"].value = i
+            # Places a group's models by its current transform
+            if isinstance(model, ModelGroup): model.transform_matrix()
+
+            for part in self._parts(model):
+                self.program["model"].value = tuple(part.posmat.flatten())
+                self.program["angle"].value = tuple(part.rotation.tolist())
+                self.program["scale"].value = tuple(part.scale.tolist())
+                self._vao(part).render()
+
+        previous.use()
+
+    def pick(self, x: int, y: int) -> Optional[BaseModel]:
+        """
+        Model at a buffer coordinate (origin at the top left) from the last render()
+        """
+        if not (0 <= x < self.size[0] and 0 <= y < self.size[1]):
+            return None
+
+        r, g, b, _ = self.fbo.read(viewport=(x, self.size[1] - 1 - y, 1, 1), components=4)
+        i = r | g << 8 | b << 16
+        return self.models[i - 1] if i > 0 else None
+
+    def dispose(self):
+        for vao in self._vaos.values():
+            release(vao)
+        self._vaos.clear()
+        release(self.fbo)
+        release(self.depth)
+        release(self.texture)
+        release(self.program)
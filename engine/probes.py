@@ -0,0 +1,320 @@
+"""
+Reflection probes
+
+A probe captures the scene around a point into a cube map, models in its
+range reflect it instead of the global skybox. Probes share a small, fixed
+pool of cube maps: the ones nearest the camera hold one and the others fall
+back to the skybox until they get one.
+
+Faces are captured one at a time, at most 'faces_per_frame' per update, and
+only when the probe just got its cube map or something tracked in its range
+moved. Keeping reflections current has a bounded cost per frame however
+many probes or moving models there are. Once all six faces are captured the
+mip chain is rebuilt, rough materials sample its blurrier levels.
+
+  probes = ReflectionProbes(ctx, capacity=4)
+  probes.add((0.0, 2.0, 0.0), radius=15.0)
+  probes.track(models)
+
+  probes.update(camera, draw)     # draw(probe_camera) renders the scene
+  model.render(probes.environment(position, skybox))
+"""
+
+from typing import Optional, Callable
+
+from math import log2
+import numpy
+import moderngl
+import pyrr
+
+from .camera import Camera
+from .resources import Disposable, track, release
+
+
+# Looking direction and up vector of the camera capturing each face, in the
+# order of the cube map faces (+X, -X, +Y, -Y, +Z, -Z). Framebuffers are read
+# bottom row first, so rendering "upside down" like this gives the rows in
+# the order cube map faces store them.
+FACES = (
+    ((1.0, 0.0, 0.0),  (0.0, -1.0, 0.0)),
+    ((-1.0, 0.0, 0.0), (0.0, -1.0, 0.0)),
+    ((0.0, 1.0, 0.0),  (0.0, 0.0, 1.0)),
+    ((0.0, -1.0, 0.0), (0.0, 0.0, -1.0)),
+    ((0.0, 0.0, 1.0),  (0.0, -1.0, 0.0)),
+    ((0.0, 0.0, -1.0), (0.0, -1.0, 0.0))
+)
+
+
+class ProbeCamera:
+    """
+    90 degree square camera looking down one face of a probe, has the
+    matrices and version models read from a Camera
+    """
+    def __init__(self, near: float = 0.1, far: float = 100.0):
+        self.projection = pyrr.matrix44.create_perspective_projection_matrix(90.0, 1.0, near, far).astype(numpy.float32)
+        self.view = numpy.identity(4, dtype=numpy.float32)
+        self.view_projection = numpy.zeros((4, 4), dtype=numpy.float32)
+        self.final_position = pyrr.Vector3([0.0, 0.0, 0.0], dtype=numpy.float32)
+        self.version = 0
+
+    @property
+    def position(self) -> pyrr.Vector3:
+        return self.final_position
+
+    def look(self, position: numpy.ndarray, face: int):
+        """
+        Move to 'position' and look down cube map face 'face'
+        """
+        f = numpy.array(FACES[face][0], dtype=numpy.float32)
+        u = numpy.array(FACES[face][1], dtype=numpy.float32)
+        s = numpy.cross(f, u)
+
+        # Same layout as Camera's look-at matrix
+        view = self.view
+        view[:3, 0] = s
+        view[:3, 1] = u
+        view[:3, 2] = -f
+        view[3, 0] = -numpy.dot(s, position)
+        view[3, 1] = -numpy.dot(u, position)
+        view[3, 2] = numpy.dot(f, position)
+
+        self.final_position[:] = position
+        numpy.matmul(self.view, self.projection, out=self.view_projection)
+        self.version = next(Camera._versions)
+
+    def update_matrices(self) -> int:
+        return self.version
+
+
+class ReflectionProbe:
+    """
+    A point whose surroundings models within 'radius' of it reflect
+    """
+    def __init__(self, position: tuple[float, float, float], radius: float):
+        self.position = numpy.array(position, dtype=numpy.float32)
+        self.radius = radius
+
+        # Cube map from the pool while the probe is resident
+        self.texture: Optional[moderngl.TextureCube] = None
+        self.max_lod = 0.0
+
+        # Faces left to capture, the probe is ready once it has been fully
+        # captured into its current cube map
+        self.dirty: list[int] = list(range(6))
+        self.ready = False
+        self.captures = 0
+
+    def invalidate(self):
+        """
+        Capture every face again, the old reflection is shown until done
+        """
+        self.dirty = list(range(6))
+
+    def intersects(self, mins: numpy.ndarray, maxs: numpy.ndarray) -> bool:
+        """
+        Whether a world space bounding box reaches into the probe's range
+        """
+        closest = numpy.clip(self.position, mins, maxs)
+        return float(numpy.sum((closest - self.position) ** 2)) <= self.radius * self.radius
+
+    def distance2(self, position) -> float:
+        return float(numpy.sum((numpy.asarray(position, dtype=numpy.float32) - self.position) ** 2))
+
+
+class ReflectionProbes(Disposable):
+    """
+    Probes placed in the scene and the pool of 'capacity' cube maps of
+    'size' x 'size' texels they are captured into
+
+    The levels rough materials sample are the cube maps' plain mip chain,
+    box filtered by build_mipmaps and not a prefiltered (e.g. GGX)
+    convolution. The chain is only rebuilt once all six faces are captured,
+    so while a probe is being captured again its level 0 faces are new but
+    the blurrier levels still show the previous capture.
+    """
+    def __init__(self,
+            ctx: moderngl.Context,
+            capacity: int = 4,
+            size: int = 128,
+            near: float = 0.1,
+            far: float = 100.0,
+            faces_per_frame: int = 1):
+
+        self.ctx = ctx
+        self.size = size
+        self.faces_per_frame = faces_per_frame
+
+        self.textures = [track(ctx.texture_cube((size, size), 3), self) for _ in range(capacity)]
+        self.free = list(self.textures)
+        self.max_lod = log2(size)
+
+        self.probes: list[ReflectionProbe] = []
+
+        # Tracked models and the transform and bounds they had when last checked
+        self._tracked = {}
+
+        # Faces are rendered here and copied to the cube map through a buffer,
+        # without leaving the GPU
+        self.camera = ProbeCamera(near, far)
+        self.color = track(ctx.texture((size, size), 3), self)
+        self.depth = track(ctx.depth_renderbuffer((size, size)), self)
+        self.fbo = track(ctx.framebuffer(self.color, self.depth), self)
+        self.pixels = track(ctx.buffer(reserve=size * size * 3), self)
+
+        self.captures = 0
+        self.invalidations = 0
+
+    def __len__(self) -> int:
+        return len(self.probes)
+
+    def add(self, position: tuple[float, float, float], radius: float = 10.0) -> ReflectionProbe:
+        probe = ReflectionProbe(position, radius)
+        self.probes.append(probe)
+        return probe
+
+    def remove(self, probe: ReflectionProbe):
+        self.probes.remove(probe)
+        self._evict(probe)
+
+    def _evict(self, probe: ReflectionProbe):
+        if probe.texture is None: return
+        self.free.append(probe.texture)
+        probe.texture = None
+        probe.ready = False
+
+    def track(self, models: list):
+        """
+        Watch models (anything with 'transform_matrix' and 'bounds' like
+        BaseModel) for movement, probes they move in or out of the range of
+        are captured again
+        """
+        for model in models:
+            bounds = model.bounds()
+            self._tracked[model] = (model.transform_matrix().tobytes(), bounds)
+            self.invalidate(*bounds)
+
+    def untrack(self, model):
+        tracked = self._tracked.pop(model, None)
+        if tracked is not None: self.invalidate(*tracked[1])
+
+    def invalidate(self, mins: numpy.ndarray = None, maxs: numpy.ndarray = None):
+        """
+        Capture again the probes whose range a box reaches into, or all of them
+        """
+        for probe in self.probes:
+            if mins is None or probe.intersects(mins, maxs):
+                probe.invalidate()
+                self.invalidations += 1
+
+    def _check_tracked(self):
+        for model, (transform, bounds) in self._tracked.items():
+            current = model.transform_matrix().tobytes()
+            if current == transform: continue
+
+            new_bounds = model.bounds()
+            self._tracked[model] = (current, new_bounds)
+            self.invalidate(*bounds)
+            self.invalidate(*new_bounds)
+
+    def _assign(self, position: numpy.ndarray):
+        """
+        Give the pool's cube maps to the probes nearest to 'position'
+        """
+        by_distance = sorted(self.probes, key=lambda probe: probe.distance2(position))
+        resident = by_distance[:len(self.textures)]
+
+        for probe in by_distance[len(self.textures):]:
+            self._evict(probe)
+
+        for probe in resident:
+            if probe.texture is None:
+                probe.texture = self.free.pop()
+                probe.max_lod = self.max_lod
+                probe.ready = False
+                probe.dirty = list(range(6))
+
+        return resident
+
+    def update(self, camera: Camera, draw: Callable[[ProbeCamera], None]):
+        """
+        Capture at most 'faces_per_frame' faces of the resident probes, the
+        nearest to the camera first. 'draw' is called with a ProbeCamera and
+        the capture framebuffer bound, it should draw the scene without
+        reflection probes.
+        """
+        self._check_tracked()
+
+        camera.update_matrices()
+        position = numpy.asarray(camera.final_position, dtype=numpy.float32)
+        resident = self._assign(position)
+
+        budget = self.faces_per_frame
+        for probe in resident:
+            while probe.dirty and budget > 0:
+                self._capture(probe, probe.dirty.pop(0), draw)
+                budget -= 1
+
+                if not probe.dirty:
+                    # Box filtered levels for rough materials
+                    probe.texture.build_mipmaps()
+                    probe.ready = True
+
+            if budget == 0: break
+
+    def _capture(self, probe: ReflectionProbe, face: int, draw: Callable[[ProbeCamera], None]):
+        previous = self.ctx.fbo
+
+        self.camera.look(probe.position, face)
+        self.fbo.use()
+        self.fbo.clear()
+        draw(self.camera)
+
+        self.fbo.read_into(self.pixels, components=3, alignment=1)
+        probe.texture.write(face, self.pixels, alignment=1)
+        previous.use()
+
+        probe.captures += 1
+        self.captures += 1
+
+    def environment(self, position, fallback=None):
+        """
+        Nearest captured probe whose range contains 'position', or 'fallback'
+        """
+        nearest = fallback
+        nearest_distance = None
+
+        for probe in self.probes:
+            if not probe.ready: continue
+
+            distance = probe.distance2(position)
+            if distance > probe.radius * probe.radius: continue
+
+            if nearest_distance is None or distance < nearest_distance:
+                nearest = probe
+                nearest_distance = distance
+
+        return nearest
+
+    def gpu_size(self) -> int:
+        """
+        Cube maps with their mip chains and the capture targets in bytes
+        """
+        face = self.size * self.size * 3
+        return len(self.textures) * 6 * face * 4 // 3 + face * 2 + self.size * self.size * 4
+
+    def stats(self) -> dict:
+        return {
+            "probes": len(self.probes),
+            "resident": len(self.textures) - len(self.free),
+            "ready": sum(probe.ready for probe in self.probes),
+            "dirty_faces": sum(len(probe.dirty) for probe in self.probes if probe.texture is not None),
+            "captures": self.captures,
+            "invalidations": self.invalidations
+        }
+
+    def dispose(self):
+        for texture in self.textures: release(texture)
+        release(self.color)
+        release(self.depth)
+        release(self.fbo)
+        release(self.pixels)
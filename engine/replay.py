@@ -0,0 +1,260 @@
+"""
+Input recording, replay and frame timing
+
+A recording holds the input the main loop read on each frame: the events,
+the watched keys held down, the relative mouse motion, the frame time and
+the ticks head bobbing is timed with. Replaying it drives the camera through
+the same session as fast as frames can be rendered, with or without a
+window, so frame time spikes can be reproduced and builds compared on the
+same workload.
+
+Recordings are JSON lines, a header followed by one line per frame.
+
+  recorder = InputRecorder("session.replay", camera.key_map.values())
+  recorder.record(events, keys, mouse_rel, clock.get_time(), pygame.time.get_ticks())
+
+  for frame in InputReplay("session.replay"):
+      camera.process(*frame.mouse_rel, frame.events, frame.keys, ticks=frame.ticks)
+"""
+
+from typing import Union, Iterable, Iterator
+
+from pathlib import Path
+import json
+import time
+import random
+import pygame
+
+
+REPLAY_VERSION = 1
+
+# Mouse motion is recorded as each frame's relative motion instead
+RECORDED_EVENTS = (
+    pygame.QUIT,
+    pygame.KEYDOWN,
+    pygame.KEYUP,
+    pygame.MOUSEBUTTONDOWN,
+    pygame.MOUSEBUTTONUP,
+    pygame.MOUSEWHEEL
+)
+
+
+def _event_to_dict(event: pygame.event.Event) -> dict:
+    """
+    Event type and its plain number, string and tuple attributes
+    """
+    data = {"type": event.type}
+    for name, value in event.dict.items():
+        if isinstance(value, (bool, int, float, str)):
+            data[name] = value
+        elif isinstance(value, (tuple, list)) and all(isinstance(v, (int, float)) for v in value):
+            data[name] = list(value)
+    return data
+
+
+def _event_from_dict(data: dict) -> pygame.event.Event:
+    attributes = {name: tuple(value) if isinstance(value, list) else value
+                  for name, value in data.items() if name != "type"}
+    return pygame.event.Event(data["type"], attributes)
+
+
+class KeyState:
+    """
+    Replayed keys, indexed by key constant like pygame.key.get_pressed()
+    """
+    def __init__(self, pressed: Iterable[int] = ()):
+        self.pressed = frozenset(pressed)
+
+    def __getitem__(self, key: int) -> bool:
+        return key in self.pressed
+
+
+class Frame:
+    """
+    One frame of recorded input, 'dt' and 'ticks' are in milliseconds
+    """
+    def __init__(self,
+            events: list[pygame.event.Event],
+            keys: KeyState,
+            mouse_rel: tuple[int, int],
+            dt: int,
+            ticks: int):
+
+        self.events = events
+        self.keys = keys
+        self.mouse_rel = mouse_rel
+        self.dt = dt
+        self.ticks = ticks
+
+
+class InputRecorder:
+    """
+    Writes each frame's input to 'filepath'
+
+    Only the keys in 'watch_keys' are recorded as held, the events of every
+    key are. 'seed' seeds the random module so random choices (like which
+    footstep sound plays) repeat on replay.
+    """
+    def __init__(self,
+            filepath: Union[Path, str],
+            watch_keys: Iterable[int],
+            seed: int = None,
+            metadata: dict = None):
+
+        self.watch_keys = sorted(set(watch_keys))
+        self.seed = random.randrange(1 << 31) if seed is None else seed
+        random.seed(self.seed)
+
+        self.frames = 0
+        self.file = open(filepath, "w", encoding="utf-8")
+        self.file.write(json.dumps({
+            "version": REPLAY_VERSION,
+            "pygame": pygame.version.ver,
+            "seed": self.seed,
+            "watch_keys": self.watch_keys,
+            "metadata": metadata or {}
+        }) + "\n")
+
+    def record(self,
+            events: list[pygame.event.Event],
+            keys,
+            mouse_rel: tuple[int, int],
+            dt: int,
+            ticks: int):
+        """
+        Record a frame, 'keys' is what pygame.key.get_pressed() returned
+        """
+        self.file.write(json.dumps({
+            "events": [_event_to_dict(e) for e in events if e.type in RECORDED_EVENTS],
+            "keys": [key for key in self.watch_keys if keys[key]],
+            "mouse": list(mouse_rel),
+            "dt": dt,
+            "ticks": ticks
+        }, separators=(",", ":")) + "\n")
+        self.frames += 1
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self) -> "InputRecorder":
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class InputReplay:
+    """
+    Frames of a recording, iterating seeds the random module like recording did
+    """
+    def __init__(self, filepath: Union[Path, str]):
+        with open(filepath, encoding="utf-8") as f:
+            lines = f.read().splitlines()
+
+        if not lines:
+            raise ValueError(f"'{filepath}' is not a recording")
+
+        header = json.loads(lines[0])
+        if header.get("version") != REPLAY_VERSION:
+            raise ValueError(f"unsupported recording version {header.get('version')}")
+
+        self.seed = header["seed"]
+        self.watch_keys = header["watch_keys"]
+        self.metadata = header.get("metadata", {})
+        self.pygame_version = header.get("pygame")
+        self._frames = [json.loads(line) for line in lines[1:] if line]
+
+    def __len__(self) -> int:
+        return len(self._frames)
+
+    def __iter__(self) -> Iterator[Frame]:
+        random.seed(self.seed)
+
+        for data in self._frames:
+            yield Frame(
+                [_event_from_dict(e) for e in data["events"]],
+                KeyState(data["keys"]),
+                tuple(data["mouse"]),
+                data["dt"],
+                data["ticks"])
+
+
+class FrameTimer:
+    """
+    Wall-clock duration of each frame and of the sections between its marks
+
+      timer.begin()
+      ...
+      timer.mark("update")
+      ...
+      timer.mark("render")
+      timer.end()
+    """
+    def __init__(self):
+        self.frames: list[float] = []
+        self.sections: list[dict[str, float]] = []
+        self.names: list[str] = []
+
+        self._start = 0.0
+        self._last = 0.0
+        self._current = {}
+
+    def begin(self):
+        self._start = self._last = time.perf_counter()
+        self._current = {}
+
+    def mark(self, name: str):
+        """
+        Time since the previous mark (or begin) is added to section 'name'
+        """
+        now = time.perf_counter()
+        self._current[name] = self._current.get(name, 0.0) + now - self._last
+        self._last = now
+        if name not in self.names: self.names.append(name)
+
+    def end(self) -> float:
+        """
+        Finish the frame and return its duration in seconds
+        """
+        duration = time.perf_counter() - self._start
+        self.frames.append(duration)
+        self.sections.append(self._current)
+        return duration
+
+    def __len__(self) -> int:
+        return len(self.frames)
+
+    def summary(self) -> dict:
+        """
+        Frame time statistics in milliseconds
+        """
+        if not self.frames: return {"frames": 0}
+
+        ordered = sorted(self.frames)
+        def percentile(p):
+            return ordered[min(len(ordered) - 1, int(p / 100 * len(ordered)))] * 1000
+
+        worst = max(range(len(self.frames)), key=self.frames.__getitem__)
+        return {
+            "frames": len(self.frames),
+            "avg_ms": sum(self.frames) / len(self.frames) * 1000,
+            "p50_ms": percentile(50),
+            "p95_ms": percentile(95),
+            "p99_ms": percentile(99),
+            "max_ms": ordered[-1] * 1000,
+            "worst_frame": worst,
+            "sections_ms": {
+                name: sum(s.get(name, 0.0) for s in self.sections) / len(self.sections) * 1000
+                for name in self.names
+            }
+        }
+
+    def save(self, filepath: Union[Path, str]):
+        """
+        One CSV row per frame, the total and each section in milliseconds
+        """
+        with open(filepath, "w", encoding="utf-8") as f:
+            f.write(",".join(["frame", "total_ms"] + [f"{name}_ms" for name in self.names]) + "\n")
+            for i, (total, sections) in enumerate(zip(self.frames, self.sections)):
+                row = [str(i), f"{total*1000:.3f}"] + [f"{sections.get(name, 0.0)*1000:.3f}" for name in self.names]
+                f.write(",".join(row) + "\n")
@@ -0,0 +1,250 @@
+"""
+GPU resource tracking
+
+Every buffer, vertex array, texture, framebuffer and program the engine
+creates is registered with its owner, kind and the line that created it.
+Resources are reference counted: 'retain' adds a user (e.g. a model sharing
+an atlas texture), 'release' drops one and frees the GL object when none are
+left. Objects that were never tracked are left to whoever created them.
+
+  buffer = track(ctx.buffer(data), owner=self)
+  texture = retain(shared_texture)
+  ...
+  release(buffer)
+  release(texture)
+
+Engine objects owning resources are Disposable, dispose() releases them and
+leaving a 'with' block disposes the object:
+
+  with load_model(ctx, "assets/models/cube.obj", "assets/textures/green.png") as model:
+      ...
+
+Anything still tracked can be listed with RESOURCES.report(), and
+RESOURCES.usage() gives the live memory use by kind and owner.
+"""
+
+from abc import ABC, abstractmethod
+
+import sys
+import os
+import moderngl
+
+
+_MIPMAP_FILTERS = (
+    moderngl.NEAREST_MIPMAP_NEAREST,
+    moderngl.LINEAR_MIPMAP_NEAREST,
+    moderngl.NEAREST_MIPMAP_LINEAR,
+    moderngl.LINEAR_MIPMAP_LINEAR
+)
+
+_THIS_FILE = os.path.normcase(os.path.abspath(__file__))
+
+
+def gl_size(obj) -> int:
+    """
+    Approximate GPU memory of a GL object in bytes, mip chains included
+    """
+    if isinstance(obj, moderngl.Buffer):
+        return obj.size
+
+    if isinstance(obj, (moderngl.Texture, moderngl.TextureCube, moderngl.TextureArray, moderngl.Texture3D, moderngl.Renderbuffer)):
+        texel = obj.components * int(obj.dtype[1:])
+        size = texel
+        for side in obj.size: size *= side
+
+        if isinstance(obj, moderngl.TextureCube): size *= 6
+        if getattr(obj, "samples", 0): size *= obj.samples
+        if getattr(obj, "filter", (None,))[0] in _MIPMAP_FILTERS: size = size * 4 // 3
+        return size
+
+    # Vertex arrays, framebuffers and programs hold no memory worth counting
+    return 0
+
+
+def _creation_site() -> str:
+    """
+    First frame outside this module, where the tracked object was created
+    """
+    frame = sys._getframe(1)
+    while frame is not None and os.path.normcase(os.path.abspath(frame.f_code.co_filename)) == _THIS_FILE:
+        frame = frame.f_back
+
+    if frame is None: return "?"
+    return f"{os.path.relpath(frame.f_code.co_filename)}:{frame.f_lineno} in {frame.f_code.co_name}"
+
+
+def _owner_name(owner) -> str:
+    if owner is None: return "-"
+    if isinstance(owner, str): return owner
+    return type(owner).__name__
+
+
+class Resource:
+    """
+    A tracked GL object and who made it
+    """
+    def __init__(self, obj, owner: str, site: str):
+        self.obj = obj
+        self.kind = type(obj).__name__
+        self.owner = owner
+        self.site = site
+        self.references = 1
+
+    @property
+    def size(self) -> int:
+        try:
+            return gl_size(self.obj)
+        except AttributeError:
+            # Released directly instead of through the tracker
+            return 0
+
+
+class ResourceTracker:
+    """
+    Reference counts of live GL objects, keyed by the objects themselves
+    """
+    def __init__(self):
+        self.resources: dict[int, Resource] = {}
+
+        # Totals since creation, a session that frees what it creates keeps
+        # 'created' - 'freed' flat
+        self.created = 0
+        self.freed = 0
+
+    def __len__(self) -> int:
+        return len(self.resources)
+
+    def __contains__(self, obj) -> bool:
+        return id(obj) in self.resources
+
+    def track(self, obj, owner=None):
+        """
+        Register a newly created GL object with one reference and return it
+        """
+        if id(obj) in self.resources:
+            raise ValueError(f"{type(obj).__name__} is already tracked")
+
+        self.resources[id(obj)] = Resource(obj, _owner_name(owner), _creation_site())
+        self.created += 1
+        return obj
+
+    def retain(self, obj):
+        """
+        Add a reference to a tracked object and return it, untracked objects
+        are returned as is
+        """
+        resource = self.resources.get(id(obj))
+        if resource is not None: resource.references += 1
+        return obj
+
+    def release(self, obj):
+        """
+        Drop a reference, the object is freed when it was the last one.
+        Untracked objects (e.g. textures passed in by the game) are left alone.
+        """
+        if obj is None: return
+
+        resource = self.resources.get(id(obj))
+        if resource is None: return
+
+        resource.references -= 1
+        if resource.references > 0: return
+
+        del self.resources[id(obj)]
+        obj.release()
+        self.freed += 1
+
+    def references(self, obj) -> int:
+        resource = self.resources.get(id(obj))
+        return 0 if resource is None else resource.references
+
+    def usage(self) -> dict:
+        """
+        Live object count and bytes in total, by kind and by owner
+        """
+        by_kind = {}
+        by_owner = {}
+        total = 0
+
+        for resource in self.resources.values():
+            size = resource.size
+            total += size
+            for table, key in ((by_kind, resource.kind), (by_owner, resource.owner)):
+                count, nbytes = table.get(key, (0, 0))
+                table[key] = (count + 1, nbytes + size)
+
+        return {
+            "objects": len(self.resources),
+            "bytes": total,
+            "by_kind": by_kind,
+            "by_owner": by_owner
+        }
+
+    @property
+    def total_bytes(self) -> int:
+        return sum(resource.size for resource in self.resources.values())
+
+    def snapshot(self) -> set[int]:
+        """
+        Ids of the live objects, compare with leaks() after a piece of work
+        """
+        return set(self.resources)
+
+    def leaks(self, since: set[int] = None) -> list[Resource]:
+        """
+        Objects still alive, or only those created after 'since' was taken
+        """
+        return [r for key, r in self.resources.items() if since is None or key not in since]
+
+    def report(self, since: set[int] = None, limit: int = 20) -> str:
+        """
+        Live objects grouped by creation site, biggest first
+        """
+        sites = {}
+        for resource in self.leaks(since):
+            key = (resource.site, resource.kind, resource.owner)
+            count, nbytes = sites.get(key, (0, 0))
+            sites[key] = (count + 1, nbytes + resource.size)
+
+        if not sites: return "No live GPU resources"
+
+        lines = [f"{sum(c for c, _ in sites.values())} live GPU resources, {sum(b for _, b in sites.values()) / 1024:.1f} KiB"]
+        ordered = sorted(sites.items(), key=lambda item: (-item[1][1], -item[1][0]))
+        for (site, kind, owner), (count, nbytes) in ordered[:limit]:
+            lines.append(f"  {count:>5} x {kind:<14} {nbytes / 1024:>10.1f} KiB  {owner:<16} {site}")
+        if len(ordered) > limit:
+            lines.append(f"  ... {len(ordered) - limit} more sites")
+
+        return "\n".join(lines)
+
+
+# Tracker used by the engine
+RESOURCES = ResourceTracker()
+
+
+def track(obj, owner=None):
+    return RESOURCES.track(obj, owner)
+
+
+def retain(obj):
+    return RESOURCES.retain(obj)
+
+
+def release(obj):
+    RESOURCES.release(obj)
+
+
+class Disposable(ABC):
+    """
+    Engine object owning GPU resources, freed by dispose() or at the end of
+    a 'with' block
+    """
+    @abstractmethod
+    def dispose(self):
+        ...
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.dispose()
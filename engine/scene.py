@@ -0,0 +1,529 @@
+"""
+Scene files
+
+A scene lists models with their transforms, lights, the skybox and UI
+elements. It's saved either as readable JSON or in a binary form: a JSON
+header with everything but the objects, followed by the objects as one packed
+array that is read back without touching each object in Python.
+
+Loading a scene uploads every mesh and texture once and draws all objects
+sharing a mesh, texture and shading with one instanced call. Their model
+matrices are built together as one array, so a large scene costs its distinct
+assets rather than its object count.
+
+  scene = Scene()
+  scene.add("assets/models/cube.obj", "assets/textures/green.png", (3, -3.4, 4))
+  scene.save("level.scene")
+
+  level = load_scene(ctx, "level.scene", (1280, 720))
+  level.render(camera)
+"""
+
+from typing import Union, Optional
+
+from pathlib import Path
+import time
+import json
+import struct
+import numpy
+import pygame
+import moderngl
+
+from .objparser import parse
+from .model import InstancedModel, Skybox, _compile_programs, _float_buffer, load_cubemap
+from .camera import Camera
+from .light import BasicLight
+from .ui import Image, Text
+from .pack import AssetPack
+from .resources import Disposable, track, release
+from .utils import rotation_matrix
+
+
+SCENE_MAGIC = b"SCNE"
+SCENE_VERSION = 1
+
+# One row per object, meshes and textures are indices into the scene's lists
+OBJECT_DTYPE = numpy.dtype([
+    ("mesh", "<u4"),
+    ("texture", "<u4"),
+    ("flags", "<u4"),
+    ("position", "<f4", (3,)),
+    ("rotation", "<f4", (3,)),
+    ("scale", "<f4", (3,))
+])
+
+# Object flags
+UNLIT = 1
+
+LIGHT_FIELDS = ("color", "ambient_intensity", "diffuse_intensity", "specular_intensity", "specular_power", "position")
+
+
+class Scene:
+    """
+    Description of a scene, see load_scene to create it
+    """
+    def __init__(self):
+        self.meshes: list[str] = []
+        self.textures: list[tuple[str, bool]] = []
+        self.lights: list[BasicLight] = []
+        self.skybox: Optional[str] = None
+        self.ui: list[dict] = []
+
+        self._objects = numpy.zeros(16, dtype=OBJECT_DTYPE)
+        self._count = 0
+
+        self._mesh_indices = {}
+        self._texture_indices = {}
+
+    def __len__(self) -> int:
+        return self._count
+
+    @property
+    def objects(self) -> numpy.ndarray:
+        """
+        Structured array of the objects (see OBJECT_DTYPE), edits are kept
+        """
+        return self._objects[:self._count]
+
+    def mesh_index(self, filepath: Union[Path, str]) -> int:
+        filepath = Path(filepath).as_posix()
+        if filepath not in self._mesh_indices:
+            self._mesh_indices[filepath] = len(self.meshes)
+            self.meshes.append(filepath)
+        return self._mesh_indices[filepath]
+
+    def texture_index(self, filepath: Union[Path, str], flip: bool = False) -> int:
+        key = (Path(filepath).as_posix(), bool(flip))
+        if key not in self._texture_indices:
+            self._texture_indices[key] = len(self.textures)
+            self.textures.append(key)
+        return self._texture_indices[key]
+
+    def _reserve(self, count: int) -> numpy.ndarray:
+        """
+        Rows for 'count' new objects, the array grows by doubling
+        """
+        if self._count + count > len(self._objects):
+            objects = numpy.zeros(max(2 * len(self._objects), self._count + count), dtype=OBJECT_DTYPE)
+            objects[:self._count] = self._objects[:self._count]
+            self._objects = objects
+
+        rows = self._objects[self._count:self._count+count]
+        self._count += count
+        return rows
+
+    def add(self,
+            mesh: Union[Path, str],
+            texture: Union[Path, str],
+            position: tuple[float, float, float],
+            rotation: tuple[float, float, float] = (0.0, 0.0, 0.0),
+            scale: tuple[float, float, float] = (1.0, 1.0, 1.0),
+            flip_texture: bool = False,
+            unlit: bool = False) -> int:
+        """
+        Add an object and return its index
+        """
+        row = self._reserve(1)
+        row["mesh"] = self.mesh_index(mesh)
+        row["texture"] = self.texture_index(texture, flip_texture)
+        row["flags"] = UNLIT if unlit else 0
+        row["position"] = position
+        row["rotation"] = rotation
+        row["scale"] = scale
+        return self._count - 1
+
+    def add_many(self,
+            mesh: Union[Path, str],
+            texture: Union[Path, str],
+            positions: numpy.ndarray,
+            rotations: numpy.ndarray = None,
+            scales: numpy.ndarray = None,
+            flip_texture: bool = False,
+            unlit: bool = False) -> numpy.ndarray:
+        """
+        Add one object for each of the (n, 3) positions and return their indices
+        """
+        rows = self._reserve(len(positions))
+        rows["mesh"] = self.mesh_index(mesh)
+        rows["texture"] = self.texture_index(texture, flip_texture)
+        rows["flags"] = UNLIT if unlit else 0
+        rows["position"] = positions
+        rows["rotation"] = 0.0 if rotations is None else rotations
+        rows["scale"] = 1.0 if scales is None else scales
+        return numpy.arange(self._count - len(positions), self._count)
+
+    def add_light(self, light: BasicLight):
+        self.lights.append(light)
+
+    def add_image(self,
+            texture: str,
+            size: tuple[float, float],
+            position: tuple[float, float],
+            texture_format: str = "RGB",
+            flip_texture: bool = False):
+
+        self.ui.append({
+            "type": "image",
+            "texture": texture,
+            "size": list(size),
+            "position": list(position),
+            "texture_format": texture_format,
+            "flip_texture": flip_texture
+        })
+
+    def add_text(self,
+            text: str,
+            position: tuple[float, float],
+            font: str = "Arial",
+            font_size: int = 20):
+
+        self.ui.append({
+            "type": "text",
+            "text": text,
+            "position": list(position),
+            "font": font,
+            "font_size": font_size
+        })
+
+    def transforms(self, indices: numpy.ndarray = None) -> numpy.ndarray:
+        """
+        (n, 4, 4) model to world matrices (column vectors) of the objects,
+        rotated and scaled like the model vertex shaders do
+        """
+        objects = self.objects if indices is None else self.objects[indices]
+
+        m = numpy.zeros((len(objects), 4, 4), dtype=numpy.float32)
+        m[:, :3, :3] = rotation_matrix(objects["rotation"]) * objects["scale"][:, None, :]
+        m[:, :3, 3] = objects["position"]
+        m[:, 3, 3] = 1.0
+        return m
+
+    def _header(self) -> dict:
+        return {
+            "version": SCENE_VERSION,
+            "meshes": self.meshes,
+            "textures": [{"path": path, "flip": flip} for path, flip in self.textures],
+            "lights": [
+                {name: numpy.asarray(getattr(light, name)).tolist() for name in LIGHT_FIELDS}
+                for light in self.lights
+            ],
+            "skybox": self.skybox,
+            "ui": self.ui
+        }
+
+    def _read_header(self, header: dict):
+        if header.get("version", SCENE_VERSION) > SCENE_VERSION:
+            raise ValueError(f"scene version {header['version']} is newer than {SCENE_VERSION}")
+
+        for mesh in header.get("meshes", []):
+            self.mesh_index(mesh)
+        for texture in header.get("textures", []):
+            self.texture_index(texture["path"], texture.get("flip", False))
+
+        self.lights = [
+            BasicLight(**{name: tuple(value) if isinstance(value, list) else value for name, value in light.items()})
+            for light in header.get("lights", [])
+        ]
+        self.skybox = header.get("skybox")
+        self.ui = header.get("ui", [])
+
+    def to_json(self) -> str:
+        document = self._header()
+
+        objects = []
+        columns = self.objects
+
+        # Rounded so float32 values print like they were written, 3.4 rather than 3.4000000953674316
+        def floats(name):
+            return columns[name].astype(numpy.float64).round(6).tolist()
+
+        for mesh, texture, flags, position, rotation, scale in zip(
+                columns["mesh"].tolist(), columns["texture"].tolist(), columns["flags"].tolist(),
+                floats("position"), floats("rotation"), floats("scale")):
+
+            path, flip = self.textures[texture]
+            entry = {"mesh": self.meshes[mesh], "texture": path, "position": position}
+
+            # Defaults are left out to keep the file readable
+            if flip: entry["flip_texture"] = True
+            if any(rotation): entry["rotation"] = rotation
+            if scale != [1.0, 1.0, 1.0]: entry["scale"] = scale
+            if flags & UNLIT: entry["unlit"] = True
+            objects.append(entry)
+
+        # One object per line, indenting each of their fields makes large
+        # scenes slow to write and long to scroll through
+        header = json.dumps(document, indent=2)[:-2]
+        lines = ",\n".join("    " + json.dumps(entry) for entry in objects)
+        return f'{header},\n  "objects": [\n{lines}\n  ]\n}}\n'
+
+    def to_bytes(self) -> bytes:
+        header = self._header()
+        header["objects"] = self._count
+
+        header = json.dumps(header, separators=(",", ":")).encode()
+        header += b" " * (-len(header) % 4)
+
+        return struct.pack("<4sII", SCENE_MAGIC, SCENE_VERSION, len(header)) + header + self.objects.tobytes()
+
+    def save(self, filepath: Union[Path, str]):
+        """
+        Saves the text form to .json files and the binary form to any other
+        """
+        if Path(filepath).suffix.lower() == ".json":
+            with open(filepath, "w") as f:
+                f.write(self.to_json())
+        else:
+            with open(filepath, "wb") as f:
+                f.write(self.to_bytes())
+
+    @classmethod
+    def from_json(cls, document: Union[str, dict]) -> "Scene":
+        if isinstance(document, str): document = json.loads(document)
+
+        scene = cls()
+        scene._read_header(document)
+
+        objects = document.get("objects", [])
+        rows = scene._reserve(len(objects))
+        rows["mesh"] = [scene.mesh_index(obj["mesh"]) for obj in objects]
+        rows["texture"] = [scene.texture_index(obj["texture"], obj.get("flip_texture", False)) for obj in objects]
+        rows["flags"] = [UNLIT if obj.get("unlit", False) else 0 for obj in objects]
+        rows["position"] = [obj["position"] for obj in objects]
+        rows["rotation"] = [obj.get("rotation", (0.0, 0.0, 0.0)) for obj in objects]
+        rows["scale"] = [obj.get("scale", (1.0, 1.0, 1.0)) for obj in objects]
+
+        return scene
+
+    @classmethod
+    def from_bytes(cls, data: Union[bytes, memoryview]) -> "Scene":
+        magic, version, header_length = struct.unpack_from("<4sII", data)
+        if magic != SCENE_MAGIC:
+            raise ValueError("not a binary scene")
+
+        header = json.loads(bytes(data[12:12+header_length]))
+
+        scene = cls()
+        scene._read_header(header)
+
+        count = header["objects"]
+        scene._objects = numpy.frombuffer(data, dtype=OBJECT_DTYPE, count=count, offset=12+header_length).copy()
+        scene._count = count
+
+        return scene
+
+
+def read_scene(filepath: Union[Path, str]) -> Scene:
+    """
+    Reads either form of a scene file
+    """
+    with open(filepath, "rb") as f:
+        data = f.read()
+
+    if data[:4] == SCENE_MAGIC:
+        return Scene.from_bytes(data)
+
+    return Scene.from_json(data.decode("utf-8"))
+
+
+class LoadedScene(Disposable):
+    """
+    A scene's GPU objects, drawn with one instanced call per mesh, texture
+    and shading
+
+    'asset_time' is the time spent reading and uploading meshes and
+    textures, 'object_time' the time spent on transforms, grouping and
+    instance buffer uploads (both in seconds, GPU work not waited for).
+    """
+    def __init__(self,
+            ctx: moderngl.Context,
+            scene: Scene,
+            window_size: tuple[float, float],
+            pack: AssetPack = None):
+
+        self.ctx = ctx
+        self.scene = scene
+
+        _compile_programs(ctx, pack=pack)
+
+        start = time.perf_counter()
+
+        objects = scene.objects
+        self.transforms = scene.transforms()
+
+        # Objects are grouped by mesh, texture and shading with one sort
+        keys = (objects["mesh"].astype(numpy.uint64) << numpy.uint64(32)) \
+             | (objects["texture"].astype(numpy.uint64) << numpy.uint64(1)) \
+             | (objects["flags"] & UNLIT).astype(numpy.uint64)
+        order = numpy.argsort(keys, kind="stable")
+        group_keys, starts, counts = numpy.unique(keys[order], return_index=True, return_counts=True)
+
+        self.group_objects: list[numpy.ndarray] = [order[start:start+count] for start, count in zip(starts, counts)]
+        self.object_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        self.meshes = {}
+        self.textures = {}
+        materials = []
+        for indices in self.group_objects:
+            obj = objects[indices[0]]
+            materials.append((self._mesh(int(obj["mesh"]), pack), self._texture(int(obj["texture"]), pack), bool(obj["flags"] & UNLIT)))
+        self.asset_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        self.groups: list[InstancedModel] = [
+            InstancedModel(ctx, mesh, texture, self.transforms[indices], unlit=unlit)
+            for indices, (mesh, texture, unlit) in zip(self.group_objects, materials)
+        ]
+
+        # Group of each object, to find what to rewrite when objects move
+        self.object_groups = numpy.empty(len(objects), dtype=numpy.int64)
+        for i, indices in enumerate(self.group_objects):
+            self.object_groups[indices] = i
+        self.object_time += time.perf_counter() - start
+
+        self.lights = [
+            BasicLight(**{name: getattr(light, name) for name in LIGHT_FIELDS})
+            for light in scene.lights
+        ]
+        self.light_source = self.lights[0] if self.lights else BasicLight()
+
+        self.skybox = None
+        if scene.skybox is not None:
+            cubemap = load_cubemap(ctx, scene.skybox, pack)
+            self.skybox = Skybox(ctx, cubemap, pack)
+            release(cubemap)
+
+        self.ui = []
+        for element in scene.ui:
+            if element["type"] == "image":
+                self.ui.append(Image(
+                    ctx,
+                    window_size,
+                    element["texture"],
+                    element["size"],
+                    element["position"],
+                    element.get("texture_format", "RGB"),
+                    element.get("flip_texture", False),
+                    pack))
+            elif element["type"] == "text":
+                self.ui.append(Text(
+                    ctx,
+                    window_size,
+                    element["position"],
+                    element["text"],
+                    element.get("font", "Arial"),
+                    element.get("font_size", 20)))
+            else:
+                raise ValueError(f"unknown UI element '{element['type']}'")
+
+    def _mesh(self, index: int, pack: Optional[AssetPack]) -> tuple[moderngl.Buffer, moderngl.Buffer, moderngl.Buffer]:
+        if index not in self.meshes:
+            filepath = self.scene.meshes[index]
+
+            if pack is not None and filepath in pack:
+                data = pack.mesh(filepath)
+            else:
+                objfile = parse(filepath)
+                data = objfile.vertices, objfile.uv_coords, objfile.vertex_normals
+
+            self.meshes[index] = tuple(_float_buffer(self.ctx, numpy.asarray(d, dtype=numpy.float32), self) for d in data)
+
+        return self.meshes[index]
+
+    def _texture(self, index: int, pack: Optional[AssetPack]) -> moderngl.Texture:
+        if index not in self.textures:
+            filepath, flip = self.scene.textures[index]
+
+            if pack is not None and filepath in pack:
+                texture = track(pack.texture(self.ctx, filepath, flip=flip), self)
+            else:
+                surface = pygame.image.load(filepath)
+                if flip: surface = pygame.transform.flip(surface, False, True)
+
+                texture = track(self.ctx.texture(surface.get_size(), 4, pygame.image.tostring(surface, "RGBA", True)), self)
+                texture.repeat_x = False
+                texture.repeat_y = False
+                texture.build_mipmaps()
+
+            self.textures[index] = texture
+
+        return self.textures[index]
+
+    def update_objects(self, indices: numpy.ndarray = None):
+        """
+        Upload the transforms of objects edited in 'scene.objects', or of
+        every object. Only the groups holding them are rewritten.
+        """
+        if indices is None:
+            self.transforms = self.scene.transforms()
+            groups = range(len(self.groups))
+        else:
+            indices = numpy.asarray(indices)
+            self.transforms[indices] = self.scene.transforms(indices)
+            groups = numpy.unique(self.object_groups[indices])
+
+        for group in groups:
+            self.groups[group].write_matrices(self.transforms[self.group_objects[group]])
+
+    def render(self, camera: Camera, light_source: BasicLight = None):
+        """
+        Draw the skybox, the models lit by 'light_source' (or the scene's
+        first light) and the UI
+        """
+        if light_source is None: light_source = self.light_source
+
+        if self.skybox is not None:
+            self.ctx.disable(moderngl.DEPTH_TEST)
+            self.ctx.front_face = "cw"
+            self.skybox.update(camera)
+            self.skybox.render()
+            self.ctx.front_face = "ccw"
+            self.ctx.enable(moderngl.DEPTH_TEST)
+
+        for model in self.groups:
+            model.update(camera, light_source)
+            model.render(self.skybox)
+
+        if self.ui:
+            self.ctx.disable(moderngl.DEPTH_TEST)
+            for element in self.ui:
+                element.render()
+            self.ctx.enable(moderngl.DEPTH_TEST)
+
+    @property
+    def draw_calls(self) -> int:
+        return len(self.groups)
+
+    def gpu_size(self) -> int:
+        """
+        Approximate GPU memory used by the scene's meshes, textures and instances in bytes
+        """
+        size = sum(buffer.size for buffers in self.meshes.values() for buffer in buffers)
+        for texture in self.textures.values():
+            w, h = texture.size
+            size += w * h * texture.components * 4 // 3
+        return size + sum(model.gpu_size() for model in self.groups)
+
+    def dispose(self):
+        for model in self.groups: model.dispose()
+        for buffers in self.meshes.values():
+            for buffer in buffers: release(buffer)
+        for texture in self.textures.values(): release(texture)
+        if self.skybox is not None: self.skybox.dispose()
+        for element in self.ui: element.dispose()
+
+
+def load_scene(
+        ctx: moderngl.Context,
+        scene: Union[Scene, Path, str],
+        window_size: tuple[float, float],
+        pack: AssetPack = None) -> LoadedScene:
+    """
+    Loads a scene file (or an already read Scene) to the GPU, assets found in
+    'pack' are used instead of reading and decoding the files
+    """
+    if not isinstance(scene, Scene):
+        scene = read_scene(scene)
+
+    return LoadedScene(ctx, scene, window_size, pack)
@@ -0,0 +1,456 @@
+"""
+World streaming
+
+The world is divided into square chunks on the XZ plane. Chunks around
+the camera (and ahead of it in the direction of travel) are loaded in
+background threads, uploaded to the GPU a few models per frame and evicted
+in least-recently-used order when the resident memory budget is exceeded.
+
+Parsing OBJ files and decoding images happen on worker threads, everything
+that touches the OpenGL context happens on the thread calling update().
+"""
+
+from typing import Union, Optional
+
+from pathlib import Path
+from math import floor, hypot
+from concurrent.futures import ThreadPoolExecutor, Future
+import pygame
+import moderngl
+import pyrr
+
+from .objparser import parse, ObjFile
+from .model import BaseModel, UnlitModel, _compile_programs
+from .camera import Camera
+from .light import BasicLight
+from .pack import AssetPack, texture_name
+from .atlas import TextureAtlas
+from .batching import StaticBatcher
+from .collision import CollisionWorld
+from .occlusion import OcclusionCuller
+from .probes import ReflectionProbes
+
+
+class ChunkEntry:
+    """
+    A model placed in the world, loaded when its chunk becomes resident
+    """
+    def __init__(self,
+            obj_filepath: Union[Path, str],
+            texture_filepath: Union[Path, str],
+            position: tuple[float, float, float],
+            texture_format: str = "RGB",
+            flip_texture: bool = False,
+            unlit: bool = False):
+
+        self.obj_filepath = obj_filepath
+        self.texture_filepath = texture_filepath
+        self.position = position
+        self.texture_format = texture_format
+        self.flip_texture = flip_texture
+        self.unlit = unlit
+
+
+class Chunk:
+    """
+    A square cell of the world and the models placed in it
+    """
+
+    UNLOADED = 0
+    LOADING = 1
+    LOADED = 2
+    RESIDENT = 3
+
+    # Loading raised, the chunk isn't requested again, see WorldStreamer.failed
+    FAILED = 4
+
+    def __init__(self, coord: tuple[int, int]):
+        self.coord = coord
+        self.entries: list[ChunkEntry] = []
+        self.state = Chunk.UNLOADED
+
+        self.future: Optional[Future] = None
+        self.error: Optional[Exception] = None
+        self.data: list[tuple[ChunkEntry, ObjFile, Optional[pygame.Surface]]] = []
+        self.models: list[BaseModel] = []
+
+        self.cpu_bytes = 0
+        self.gpu_bytes = 0
+        self.last_used = 0
+
+    def unload(self):
+        if self.future is not None:
+            self.future.cancel()
+            self.future = None
+
+        for model in self.models:
+            model.dispose()
+
+        self.data = []
+        self.models = []
+        self.cpu_bytes = 0
+        self.gpu_bytes = 0
+        self.error = None
+        self.state = Chunk.UNLOADED
+
+
+def _load_chunk_data(
+        entries: list[ChunkEntry],
+        atlas: TextureAtlas = None) -> list[tuple[ChunkEntry, ObjFile, Optional[pygame.Surface]]]:
+    """
+    Worker thread side of chunk loading, does not touch the OpenGL context
+
+    Textures found in 'atlas' are not loaded
+    """
+    meshes = {}
+    images = {}
+    data = []
+
+    for entry in entries:
+        if entry.obj_filepath not in meshes:
+            meshes[entry.obj_filepath] = parse(entry.obj_filepath)
+
+        if atlas is not None and texture_name(entry.texture_filepath, entry.flip_texture) in atlas:
+            data.append((entry, meshes[entry.obj_filepath], None))
+            continue
+
+        if entry.texture_filepath not in images:
+            images[entry.texture_filepath] = pygame.image.load(entry.texture_filepath)
+
+        data.append((entry, meshes[entry.obj_filepath], images[entry.texture_filepath]))
+
+    return data
+
+
+def _cpu_size(data: list[tuple[ChunkEntry, ObjFile, Optional[pygame.Surface]]]) -> int:
+    size = 0
+    seen = set()
+
+    for _, objfile, surface in data:
+        if id(objfile) not in seen:
+            seen.add(id(objfile))
+            size += (len(objfile.vertices) + len(objfile.uv_coords) + len(objfile.vertex_normals)) * 4
+
+        if surface is not None and id(surface) not in seen:
+            seen.add(id(surface))
+            size += surface.get_width() * surface.get_height() * surface.get_bytesize()
+
+    return size
+
+
+class WorldStreamer:
+    """
+    Loads and unloads world chunks around a camera within a memory budget
+
+    load_radius is measured in chunks around the camera's chunk, prefetch_frames
+    is how far ahead along the estimated velocity chunks are requested.
+    Models whose texture is in 'atlas' share the atlas texture. With a
+    'batcher', models are added to it as static and drawn by its render().
+    With 'wait_for_loads', update() waits for the chunks it needs instead of
+    collecting the ones that happen to be done, so the same camera path
+    always loads the same chunks on the same frames (e.g. replaying input).
+    """
+    def __init__(self,
+            ctx: moderngl.Context,
+            chunk_size: float = 30.0,
+            load_radius: int = 1,
+            prefetch_frames: int = 60,
+            cpu_budget: int = 256 * 1024 * 1024,
+            gpu_budget: int = 256 * 1024 * 1024,
+            max_workers: int = 2,
+            max_uploads_per_frame: int = 4,
+            pack: AssetPack = None,
+            collision_world: CollisionWorld = None,
+            atlas: TextureAtlas = None,
+            batcher: StaticBatcher = None,
+            wait_for_loads: bool = False):
+
+        self.ctx = ctx
+        self.chunk_size = chunk_size
+        self.load_radius = load_radius
+        self.prefetch_frames = prefetch_frames
+        self.cpu_budget = cpu_budget
+        self.gpu_budget = gpu_budget
+        self.max_uploads_per_frame = max_uploads_per_frame
+        self.collision_world = collision_world
+        self.atlas = atlas
+        self.batcher = batcher
+        self.wait_for_loads = wait_for_loads
+
+        self.chunks: dict[tuple[int, int], Chunk] = {}
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="chunk-loader")
+
+        self.velocity = pyrr.Vector3([0.0, 0.0, 0.0])
+        self._last_position: Optional[pyrr.Vector3] = None
+
+        self.frame = 0
+        self.stall_frames = 0
+        self.stalled_chunks: list[tuple[int, int]] = []
+        self.evictions = 0
+
+        self.cpu_bytes = 0
+        self.gpu_bytes = 0
+
+        # Running totals used to estimate the size of chunks not loaded yet
+        self._loaded_entries = 0
+        self._loaded_cpu_bytes = 0
+        self._loaded_gpu_bytes = 0
+
+        _compile_programs(ctx, pack=pack)
+
+    def chunk_coord(self, position: tuple[float, float, float]) -> tuple[int, int]:
+        return (floor(position[0] / self.chunk_size), floor(position[2] / self.chunk_size))
+
+    def add(self,
+            obj_filepath: Union[Path, str],
+            texture_filepath: Union[Path, str],
+            position: tuple[float, float, float],
+            texture_format: str = "RGB",
+            flip_texture: bool = False,
+            unlit: bool = False):
+        """
+        Place a model in the world, it's loaded once its chunk is needed
+        """
+        coord = self.chunk_coord(position)
+        if coord not in self.chunks:
+            self.chunks[coord] = Chunk(coord)
+
+        self.chunks[coord].entries.append(
+            ChunkEntry(obj_filepath, texture_filepath, position, texture_format, flip_texture, unlit))
+
+    def _around(self, coord: tuple[int, int]) -> set[tuple[int, int]]:
+        r = self.load_radius
+        return {(coord[0] + x, coord[1] + z) for z in range(-r, r+1) for x in range(-r, r+1)}
+
+    def _estimate_velocity(self, position: pyrr.Vector3):
+        if self._last_position is not None:
+            delta = position - self._last_position
+            self.velocity = self.velocity * 0.8 + delta * 0.2
+
+        self._last_position = position.copy()
+
+    def _estimate(self, chunk: Chunk) -> tuple[int, int]:
+        if chunk.state == Chunk.RESIDENT or self._loaded_entries == 0:
+            return chunk.cpu_bytes, chunk.gpu_bytes
+
+        n = len(chunk.entries)
+        return (n * self._loaded_cpu_bytes // self._loaded_entries,
+                n * self._loaded_gpu_bytes // self._loaded_entries)
+
+    def _request(self, chunk: Chunk):
+        chunk.state = Chunk.LOADING
+        chunk.future = self._executor.submit(_load_chunk_data, list(chunk.entries), self.atlas)
+
+    def _collect(self, chunk: Chunk):
+        if chunk.future is None: return
+        if not (self.wait_for_loads or chunk.future.done()): return
+
+        future = chunk.future
+        chunk.future = None
+
+        # A missing or broken file fails the chunk instead of the frame
+        try:
+            chunk.data = future.result()
+        except Exception as error:
+            chunk.error = error
+            chunk.state = Chunk.FAILED
+            return
+
+        chunk.cpu_bytes = _cpu_size(chunk.data)
+        chunk.state = Chunk.LOADED
+        self.cpu_bytes += chunk.cpu_bytes
+
+    def _upload(self, chunk: Chunk, budget: int) -> int:
+        while budget > 0 and len(chunk.models) < len(chunk.data):
+            entry, objfile, surface = chunk.data[len(chunk.models)]
+
+            texture = surface
+            uv_coords = objfile.uv_coords
+            flip_texture = entry.flip_texture
+            if surface is None:
+                name = texture_name(entry.texture_filepath, entry.flip_texture)
+                texture = self.atlas.create_texture(self.ctx)
+                uv_coords = self.atlas.remap(name, uv_coords)
+                flip_texture = False
+
+            cls = UnlitModel if entry.unlit else BaseModel
+            model = cls(
+                self.ctx,
+                entry.position,
+                texture,
+                entry.texture_format,
+                objfile.vertices,
+                uv_coords,
+                objfile.vertex_normals,
+                flip_texture)
+
+            if self.collision_world is not None:
+                self.collision_world.add_model(model)
+
+            if self.batcher is not None:
+                self.batcher.add(model)
+
+            size = model.gpu_size()
+            chunk.models.append(model)
+            chunk.gpu_bytes += size
+            self.gpu_bytes += size
+            budget -= 1
+
+        if len(chunk.models) == len(chunk.data):
+            chunk.state = Chunk.RESIDENT
+            self._loaded_entries += len(chunk.entries)
+            self._loaded_cpu_bytes += chunk.cpu_bytes
+            self._loaded_gpu_bytes += chunk.gpu_bytes
+
+        return budget
+
+    def _unload(self, chunk: Chunk):
+        if self.collision_world is not None:
+            for model in chunk.models:
+                self.collision_world.remove(model)
+
+        if self.batcher is not None:
+            for model in chunk.models:
+                self.batcher.remove(model)
+
+        chunk.unload()
+
+    def _evict(self, keep: set[tuple[int, int]], prefetch: set[tuple[int, int]]):
+        """
+        Unload least recently used chunks until both budgets are met,
+        chunks that are neither needed nor prefetched go first
+        """
+        if self.cpu_bytes <= self.cpu_budget and self.gpu_bytes <= self.gpu_budget:
+            return
+
+        candidates = [
+            c for c in self.chunks.values()
+            if c.state not in (Chunk.UNLOADED, Chunk.FAILED) and c.coord not in keep
+        ]
+        candidates.sort(key=lambda c: (c.coord in prefetch, c.last_used))
+
+        for chunk in candidates:
+            if self.cpu_bytes <= self.cpu_budget and self.gpu_bytes <= self.gpu_budget:
+                break
+
+            self.cpu_bytes -= chunk.cpu_bytes
+            self.gpu_bytes -= chunk.gpu_bytes
+            self._unload(chunk)
+            self.evictions += 1
+
+    def update(self, camera: Camera):
+        """
+        Schedule loads, upload finished chunks and enforce the memory budget,
+        call once per frame
+        """
+        self.frame += 1
+        self._estimate_velocity(camera.position)
+
+        current = self.chunk_coord(camera.position)
+        needed = {c for c in self._around(current) if c in self.chunks}
+
+        predicted = camera.position + self.velocity * self.prefetch_frames
+        ahead = {c for c in self._around(self.chunk_coord(predicted)) if c in self.chunks} - needed
+
+        for coord in needed:
+            self.chunks[coord].last_used = self.frame
+
+        def distance(coord):
+            return hypot(coord[0] - current[0], coord[1] - current[1])
+
+        # Only prefetch what fits in the budget next to the needed chunks,
+        # otherwise prefetched chunks would be evicted right after loading
+        cpu = gpu = 0
+        for coord in needed:
+            c, g = self._estimate(self.chunks[coord])
+            cpu += c
+            gpu += g
+
+        prefetch = set()
+        for coord in sorted(ahead, key=distance):
+            c, g = self._estimate(self.chunks[coord])
+            if cpu + c > self.cpu_budget or gpu + g > self.gpu_budget: break
+            cpu += c
+            gpu += g
+            prefetch.add(coord)
+
+        # Needed chunks first, then prefetches closest to the camera
+        for coord in sorted(needed, key=distance) + sorted(prefetch, key=distance):
+            chunk = self.chunks[coord]
+            if chunk.state == Chunk.UNLOADED:
+                self._request(chunk)
+
+        uploads = self.max_uploads_per_frame
+        for coord in sorted(needed, key=distance) + sorted(prefetch, key=distance):
+            chunk = self.chunks[coord]
+            if chunk.state == Chunk.LOADING:
+                self._collect(chunk)
+
+            if chunk.state == Chunk.LOADED and uploads > 0:
+                uploads = self._upload(chunk, uploads)
+
+        self._evict(needed, prefetch)
+
+        self.stalled_chunks = [c for c in needed if self.chunks[c].state not in (Chunk.RESIDENT, Chunk.FAILED)]
+        if self.stalled_chunks:
+            self.stall_frames += 1
+
+    @property
+    def failed(self) -> dict[tuple[int, int], Exception]:
+        """
+        Error of each chunk that failed to load
+        """
+        return {c.coord: c.error for c in self.chunks.values() if c.state == Chunk.FAILED}
+
+    @property
+    def models(self) -> list[BaseModel]:
+        models = []
+        for chunk in self.chunks.values():
+            if chunk.state == Chunk.RESIDENT:
+                models.extend(chunk.models)
+        return models
+
+    def render(self,
+            camera: Camera,
+            light_source: BasicLight,
+            skybox=None,
+            culler: OcclusionCuller = None,
+            probes: ReflectionProbes = None):
+        """
+        Draw the resident models that aren't batched, models hidden behind the
+        occluders of 'culler' are neither updated nor drawn. With 'probes'
+        each model reflects its nearest probe instead of 'skybox'.
+        """
+        models = [model for model in self.models if not (model.static and model.batcher is not None)]
+        if culler is not None: models = culler.cull(models)
+
+        for model in models:
+            if isinstance(model, UnlitModel):
+                model.update(camera)
+            else:
+                model.update(camera, light_source)
+
+            if probes is not None:
+                model.render(probes.environment(model.posmat[3][:3], skybox))
+            else:
+                model.render(skybox)
+
+    def stats(self) -> dict:
+        return {
+            "frames": self.frame,
+            "stall_frames": self.stall_frames,
+            "stalled_chunks": len(self.stalled_chunks),
+            "resident_chunks": sum(c.state == Chunk.RESIDENT for c in self.chunks.values()),
+            "loading_chunks": sum(c.state == Chunk.LOADING for c in self.chunks.values()),
+            "failed_chunks": sum(c.state == Chunk.FAILED for c in self.chunks.values()),
+            "evictions": self.evictions,
+            "cpu_bytes": self.cpu_bytes,
+            "gpu_bytes": self.gpu_bytes
+        }
+
+    def close(self):
+        self._executor.shutdown(wait=True, cancel_futures=True)
+        for chunk in self.chunks.values():
+            self._unload(chunk)
+        self.cpu_bytes = 0
+        self.gpu_bytes = 0
@@ -2,9 +2,19 @@ import moderngl
 import pygame
 
 from .model import StaticModel
+from .pack import AssetPack
+from .resources import Disposable, track, release
 
 
-class Image:
+# Fonts looked up once per name and size, SysFont searches the system fonts
+_FONTS = {}
+def _font(name: str, size: int) -> pygame.font.Font:
+    if (name, size) not in _FONTS:
+        _FONTS[(name, size)] = pygame.font.SysFont(name, size)
+    return _FONTS[(name, size)]
+
+
+class Image(Disposable):
     def __init__(self,
             ctx: moderngl.Context,
             window_size: tuple[float, float],
@@ -12,7 +22,8 @@ class Image:
             size: tuple[float, float],
             position: tuple[float, float],
             texture_format: str = "RGB",
-            flip_texture: bool = False):
+            flip_texture: bool = False,
+            pack: AssetPack = None):
 
         self.window_size = window_size
 
@@ -34,15 +45,24 @@ class Image:
             1, 0, 0, 1, 0, 0, 1, 0, 1, 1, 0, 1
         ]
 
+        texture = texture_filepath
+        if pack is not None and texture_filepath in pack:
+            texture = track(pack.texture(ctx, texture_filepath, build_mipmaps=False, flip=flip_texture), self)
+            flip_texture = False
+
         self._model = StaticModel(
             ctx,
             (0.0, 0.0, 0.0),
-            texture_filepath,
+            texture,
             texture_format,
             model_coords,
             texture_coords,
             flip_texture)
 
+        # The model holds the only reference to a texture from the pack
+        if self._model.texture is texture: release(texture)
+        self._model.owns_texture = True
+
         self._model.program["pos_x"].value = self.x / self.window_size[0]
         self._model.program["pos_y"].value = self.y / self.window_size[1]
 
@@ -51,8 +71,11 @@ class Image:
         self._model.program["pos_y"].value = self.y / self.window_size[1]
         self._model.render()
 
+    def dispose(self):
+        self._model.dispose()
+
 
-class Text:
+class Text(Disposable):
     def __init__(self,
             ctx: moderngl.Context,
             window_size: tuple[float, float],
@@ -89,25 +112,28 @@ class Text:
             1, 0, 0, 1, 0, 0, 1, 0, 1, 1, 0, 1
         ]
 
+        # The texture keeps the size of the first text, later ones are drawn
+        # into it
         self._model = StaticModel(
             ctx,
             (0.0, 0.0, 0.0),
-            None,
+            self.surface,
             "RGBA",
             model_coords,
             texture_coords,
-            False,
-            from_filepath = False)
-
-        self._render_text()
-        self._model.surface = self.surface
-        self._model.create_texture()
+            False)
 
     def _render_text(self):
-        self.fontobj = pygame.font.SysFont(self.font, self.font_size)
+        self.fontobj = _font(self.font, self.font_size)
         self.surface = self.fontobj.render(self.text, True, (255, 255, 255)).convert_alpha()
 
     def change_text(self, text: str):
+        """
+        Redraw the text into the existing texture, nothing is reallocated on
+        the GPU
+        """
+        if text == self.text: return
+
         self.text = text
         self._render_text()
         self._model.surface.fill((0, 0, 0, 0))
@@ -117,4 +143,7 @@ class Text:
     def render(self):
         self._model.program["pos_x"].value = (self.x+self._w) / self.window_size[0]
         self._model.program["pos_y"].value = (self.y+self._h) / self.window_size[1]
-        self._model.render()
\ No newline at end of file
+        self._model.render()
+
+    def dispose(self):
+        self._model.dispose()
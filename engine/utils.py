@@ -1,6 +1,70 @@
 from pathlib import Path
+import numpy
 
 
 def get_path(path: str) -> Path:
     p = Path(__file__).parents[1]
-    return p / path
\ No newline at end of file
+    return p / path
+
+
+def rotation_matrix(angle) -> numpy.ndarray:
+    """
+    Rotation matrix matching the vertex shaders, which rotate around Y, then X, then Z
+
+    'angle' can also be an (n, 3) array of angles, giving (n, 3, 3) matrices
+    """
+    angle = numpy.asarray(angle, dtype=numpy.float64)
+    c = numpy.cos(angle)
+    s = numpy.sin(angle)
+
+    shape = angle.shape[:-1] + (3, 3)
+    rx = numpy.zeros(shape)
+    ry = numpy.zeros(shape)
+    rz = numpy.zeros(shape)
+
+    rx[..., 0, 0] = 1
+    rx[..., 1, 1] = c[..., 0]
+    rx[..., 1, 2] = s[..., 0]
+    rx[..., 2, 1] = -s[..., 0]
+    rx[..., 2, 2] = c[..., 0]
+
+    ry[..., 0, 0] = c[..., 1]
+    ry[..., 0, 2] = -s[..., 1]
+    ry[..., 1, 1] = 1
+    ry[..., 2, 0] = s[..., 1]
+    ry[..., 2, 2] = c[..., 1]
+
+    rz[..., 0, 0] = c[..., 2]
+    rz[..., 0, 1] = s[..., 2]
+    rz[..., 1, 0] = -s[..., 2]
+    rz[..., 1, 1] = c[..., 2]
+    rz[..., 2, 2] = 1
+
+    return rz @ rx @ ry
+
+
+def frustum_planes(view_projection: numpy.ndarray) -> numpy.ndarray:
+    """
+    The six (4,) planes of a pyrr view-projection matrix as a (6, 4) array,
+    a point p is inside when dot(plane[:3], p) + plane[3] >= 0 for every plane
+    """
+    # pyrr matrices transform row vectors, so the clip coordinates are its columns
+    m = numpy.asarray(view_projection, dtype=numpy.float64).T
+    planes = numpy.array([
+        m[3] + m[0], m[3] - m[0],
+        m[3] + m[1], m[3] - m[1],
+        m[3] + m[2], m[3] - m[2]
+    ])
+    return planes / numpy.linalg.norm(planes[:, :3], axis=1)[:, None]
+
+
+def boxes_in_frustum(planes: numpy.ndarray, mins: numpy.ndarray, maxs: numpy.ndarray) -> numpy.ndarray:
+    """
+    Boolean mask of the (n, 3) bounding boxes that intersect the frustum
+    """
+    centers = (mins + maxs) * 0.5
+    extents = (maxs - mins) * 0.5
+
+    distance = centers @ planes[:, :3].T + planes[:, 3]
+    radius = extents @ numpy.abs(planes[:, :3]).T
+    return numpy.all(distance + radius >= 0, axis=1)
@@ -1,54 +1,127 @@
-import time
-import random
+import os
+import argparse
+
+parser = argparse.ArgumentParser(description="Pygame OpenGL experiment")
+parser.add_argument("--record", metavar="FILE", help="record the input of this session to FILE")
+parser.add_argument("--replay", metavar="FILE", help="replay a recorded session as fast as possible")
+parser.add_argument("--headless", action="store_true", help="replay without a window (needs --replay)")
+parser.add_argument("--timings", metavar="FILE", help="write per-frame timings to FILE as CSV")
+args = parser.parse_args()
+
+if args.headless and not args.replay:
+    parser.error("--headless needs --replay")
+
+if args.record and args.replay:
+    parser.error("--record and --replay can't be used together")
+
+if args.headless:
+    os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+    os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+
 import pygame
 import moderngl
 from numpy import pi
 import pyrr
 
-from engine.model import load_obj, create_skybox
+from engine.model import load_model, load_cubemap, create_skybox
 from engine.light import BasicLight
 from engine.camera import FirstPersonController
 from engine.ui import Image, Text
+from engine.streaming import WorldStreamer
+from engine.pack import AssetPack
+from engine.atlas import load_atlas
+from engine.batching import StaticBatcher
+from engine.audio import SoundBank, AudioManager
+from engine.collision import CollisionWorld
+from engine.picking import Picker
+from engine.occlusion import OcclusionCuller
+from engine.probes import ReflectionProbes
+from engine.replay import InputRecorder, InputReplay, FrameTimer
 
 
 pygame.init()
 WINDOW_WIDTH, WINDOW_HEIGHT = 1280, 720
-pygame.display.gl_set_attribute(pygame.GL_MULTISAMPLEBUFFERS, 1)
-pygame.display.gl_set_attribute(pygame.GL_MULTISAMPLESAMPLES, 8)
-window = pygame.display.set_mode((WINDOW_WIDTH, WINDOW_HEIGHT), pygame.OPENGL | pygame.DOUBLEBUF)
+
+if args.headless:
+    # The window is only there for pygame, frames are rendered offscreen
+    window = pygame.display.set_mode((64, 64))
+    try:
+        ctx = moderngl.create_standalone_context(backend="egl")
+    except Exception:
+        ctx = moderngl.create_standalone_context()
+    screen = ctx.simple_framebuffer((WINDOW_WIDTH, WINDOW_HEIGHT))
+
+else:
+    pygame.display.gl_set_attribute(pygame.GL_MULTISAMPLEBUFFERS, 1)
+    pygame.display.gl_set_attribute(pygame.GL_MULTISAMPLESAMPLES, 8)
+    window = pygame.display.set_mode((WINDOW_WIDTH, WINDOW_HEIGHT), pygame.OPENGL | pygame.DOUBLEBUF)
+    ctx = moderngl.create_context()
+    screen = ctx.screen
+
 clock = pygame.time.Clock()
 # These two lines creates a "virtual mouse" so you can move it freely
 pygame.event.set_grab(True)
 pygame.mouse.set_visible(False)
 running = True
 
-ctx = moderngl.create_context()
 ctx.enable(moderngl.DEPTH_TEST | moderngl.CULL_FACE | moderngl.BLEND)
 ctx.multisample = True
 
+# Built with "python -m engine.pack", assets are loaded from files if it doesn't exist
+pack = AssetPack("assets.pack") if os.path.exists("assets.pack") else None
+stale = pack.stale() if pack is not None else []
+if stale:
+    print(f"assets.pack is out of date for {len(stale)} assets, they are loaded from their files (rebuild with \"python -m engine.pack\")")
+
+# Model textures share one atlas texture, rebuilt only when a source texture changes
+atlas = load_atlas([
+    ("assets/textures/obamium.png", True),
+    "assets/textures/green.png",
+    "assets/textures/white.png",
+    "assets/textures/wood.png"
+], cache="cache/atlas")
+
 camera = FirstPersonController(WINDOW_WIDTH / WINDOW_HEIGHT)
 camera.noclip = True
 
+collision_world = CollisionWorld()
+camera.collision_world = collision_world
+
 light_source = BasicLight()
 light_source.ambient_intensity = 0.6
 
 
-floors = []
-for z in range(3):
-    for x in range(3):
-        floors.append(load_obj(ctx, "assets/models/plane.obj", "assets/textures/wood.png", (x*10, -5, z*10)))
+# Static models are merged per material and 20x20 cell, matching the streaming chunks
+batcher = StaticBatcher(ctx, cell_size=20.0, pack=pack)
 
-obj = load_obj(ctx, "assets/models/obamium.obj", "assets/textures/obamium.png", (-4, -3.5, -5), flip_texture=True)
+# Replays wait for chunk loads so every run streams in the same chunks on the same frames
+world = WorldStreamer(ctx, chunk_size=20.0, gpu_budget=160 * 1024 * 1024, pack=pack, collision_world=collision_world, atlas=atlas, batcher=batcher, wait_for_loads=args.replay is not None)
+for z in range(-20, 20):
+    for x in range(-20, 20):
+        world.add("assets/models/plane.obj", "assets/textures/wood.png", (x*10, -5, z*10))
 
-obj3 = load_obj(ctx, "assets/models/cube.obj", "assets/textures/green.png", (3, -3.4, 4))
+obj = load_model(ctx, "assets/models/obamium.obj", "assets/textures/obamium.png", (-4, -3.5, -5), flip_texture=True, pack=pack, atlas=atlas)
+
+obj3 = load_model(ctx, "assets/models/cube.obj", "assets/textures/green.png", (3, -3.4, 4), pack=pack, atlas=atlas)
 obj3.rotation.x = 0.7
 obj3.rotation.z = -0.2
 
-obj4 = load_obj(ctx, "assets/models/sphere.obj", "assets/textures/white.png", (1.0, 0.0, 1.0), unlit=True)
+obj4 = load_model(ctx, "assets/models/sphere.obj", "assets/textures/white.png", (1.0, 0.0, 1.0), unlit=True, pack=pack, atlas=atlas)
 
-obj6 = load_obj(ctx, "assets/models/wolf.obj", "assets/textures/white.png", (9, -5.2, 6))
+obj6 = load_model(ctx, "assets/models/wolf.obj", "assets/textures/white.png", (9, -5.2, 6), pack=pack, atlas=atlas)
 obj6.rotation.y = 1.5
 
+for model in (obj3, obj4, obj6):
+    collision_world.add_model(model)
+    batcher.add(model)
+
+picker = Picker([obj3, obj4, obj6])
+
+# Batch chunks and streamed models behind the big occluders are skipped
+culler = OcclusionCuller((256, 128))
+occluders = [obj3, obj6]
+picked_label = ""
+
 
 img = Image(
     ctx,
@@ -56,7 +129,8 @@ img = Image(
     "assets/textures/crosshair.png",
     (20, 20),
     (0, 0),
-    texture_format = "RGBA")
+    texture_format = "RGBA",
+    pack = pack)
 
 text = Text(
     ctx,
@@ -90,72 +164,79 @@ text1.change_text("to be a")
 text2.change_text("UI text")
 
 
-running_sounds = (
-    pygame.mixer.Sound("assets/sounds/f1.wav"),
-    pygame.mixer.Sound("assets/sounds/f2.wav"),
-    pygame.mixer.Sound("assets/sounds/f3.wav"),
-    pygame.mixer.Sound("assets/sounds/f4.wav"),
-    pygame.mixer.Sound("assets/sounds/f5.wav"),
-    pygame.mixer.Sound("assets/sounds/f6.wav"),
-    pygame.mixer.Sound("assets/sounds/f7.wav"),
-    pygame.mixer.Sound("assets/sounds/f8.wav"),
-    pygame.mixer.Sound("assets/sounds/f9.wav"),
-    pygame.mixer.Sound("assets/sounds/f10.wav")
-)
-
-walking_sounds = (
-    pygame.mixer.Sound("assets/sounds/fs0.wav"),
-    pygame.mixer.Sound("assets/sounds/fs1.wav"),
-    pygame.mixer.Sound("assets/sounds/fs2.wav"),
-    pygame.mixer.Sound("assets/sounds/fs3.wav")
-)
-
-jump_sound = pygame.mixer.Sound("assets/sounds/jump.wav")
-
-last_sound = time.time()
-last_i = -1
-def walking_sound():
-    global last_sound, last_i
-
-    if not camera.noclip and camera.on_ground:
-        if camera.is_sprinting and time.time() - last_sound > 0.23:
-            last_sound = time.time()
+bank = SoundBank({
+    "run": {
+        "sounds": [f"assets/sounds/f{i}.wav" for i in range(1, 5)],
+        "priority": 1,
+        "cooldown": 230
+    },
+    "walk": {
+        "sounds": [f"assets/sounds/fs{i}.wav" for i in range(5)],
+        "priority": 1,
+        "cooldown": 470
+    },
+    "jump": {
+        "sounds": ["assets/sounds/jump.wav"],
+        "priority": 2
+    }
+}, pack)
+audio = AudioManager(bank, voices=8)
+
+
+cubemap = load_cubemap(ctx, "assets/skybox/generic", pack)
+skybox = create_skybox(ctx, cubemap, pack)
+
+# Models near a probe reflect their surroundings instead of the skybox, one
+# probe face is re-captured per frame after something in its range moves
+probes = ReflectionProbes(ctx, capacity=2, size=128)
+probes.add((3, -2.0, 4), radius=12.0)
+probes.add((-4, -2.0, -5), radius=12.0)
+probes.track([obj3, obj4, obj6])
+
+
+def draw_scene(view, culler=None, probes=None):
+    ctx.disable(moderngl.DEPTH_TEST)
+    ctx.front_face = 'cw'
+    skybox.update(view)
+    skybox.render()
+    ctx.front_face = 'ccw'
+    ctx.enable(moderngl.DEPTH_TEST)
 
-            i = last_i
-            while i == last_i:
-                i = random.randint(0, 3)
-            last_i = i
-            running_sounds[i].play()
+    world.render(view, light_source, skybox, culler=culler, probes=probes)
+    batcher.render(view, light_source, skybox, culler=culler, probes=probes)
 
-        elif time.time() - last_sound > 0.47:
-            last_sound = time.time()
 
-            i = last_i
-            while i == last_i:
-               i = random.randint(0, len(walking_sounds)-1)
-            last_i = i
-            walking_sounds[i].play()
+recorder = InputRecorder(args.record, camera.key_map.values()) if args.record else None
+replay = iter(InputReplay(args.replay)) if args.replay else None
+timer = FrameTimer() if args.timings else None
 
 
-top = pygame.image.load("assets/skybox/generic_top.png").convert((255, 65280, 16711680, 0))
-bottom = pygame.image.load("assets/skybox/generic_bottom.png").convert((255, 65280, 16711680, 0))
-left = pygame.image.load("assets/skybox/generic_left.png").convert((255, 65280, 16711680, 0))
-front = pygame.image.load("assets/skybox/generic_front.png").convert((255, 65280, 16711680, 0))
-right = pygame.image.load("assets/skybox/generic_right.png").convert((255, 65280, 16711680, 0))
-back = pygame.image.load("assets/skybox/generic_back.png").convert((255, 65280, 16711680, 0))
+while running:
+    if replay is not None:
+        # Replays run as fast as frames render, the recorded times drive the
+        # audio clock and head bobbing
+        clock.tick()
+        frame = next(replay, None)
+        if frame is None: break
 
-data = right.get_view("1").raw + left.get_view("1").raw + top.get_view("1").raw + bottom.get_view("1").raw + front.get_view("1").raw + back.get_view("1").raw
+        pygame.event.pump()
+        events, keys, (rx, ry) = frame.events, frame.keys, frame.mouse_rel
+        dt, ticks = frame.dt, frame.ticks
 
-cubemap = ctx.texture_cube((900, 900), 3, data)
+    else:
+        clock.tick(60)
+        dt, ticks = clock.get_time(), pygame.time.get_ticks()
 
-skybox = create_skybox(ctx, cubemap)
+        events = pygame.event.get()
+        keys = pygame.key.get_pressed()
+        rx, ry = pygame.mouse.get_rel()
+        if recorder is not None: recorder.record(events, keys, (rx, ry), dt, ticks)
 
+    if timer is not None: timer.begin()
 
-while running:
-    clock.tick(60)
-    pygame.display.set_caption(f"Pygame OpenGL Experiment  @{clock.get_fps():.4}FPS  —  pygame {pygame.version.ver}  moderngl {moderngl.__version__}")
+    audio.update(dt)
+    pygame.display.set_caption(f"Pygame OpenGL Experiment  @{clock.get_fps():.4}FPS  stalls: {world.stall_frames}  failed chunks: {len(world.failed)}  draws: {batcher.draw_calls}  occluded: {culler.occluded}  —  pygame {pygame.version.ver}  moderngl {moderngl.__version__}")
 
-    events = pygame.event.get()
     for event in events:
         if event.type == pygame.QUIT:
             running = False
@@ -165,47 +246,42 @@ while running:
                 running = False
 
             if event.key == camera.key_map["jump"] and camera.on_ground:
-                jump_sound.play()
+                audio.play("jump")
 
         elif event.type == pygame.MOUSEWHEEL:
             if camera.on_ground:
-                jump_sound.play()
+                audio.play("jump")
 
-    keys = pygame.key.get_pressed()
-    mx, my = pygame.mouse.get_pos()
-    rx, ry = pygame.mouse.get_rel()
     ry *= -1
 
-    camera.process(rx, ry, events, keys)
+    camera.process(rx, ry, events, keys, ticks=ticks)
+    world.update(camera)
 
-    if camera.is_walking:
-        walking_sound()
+    # What is under the crosshair
+    hit = picker.pick_center(camera, max_distance=100.0, models=picker.models + world.models)
+    label = f"{hit.distance:.1f}" if hit else "UI text"
+    if label != picked_label:
+        picked_label = label
+        text2.change_text(label)
 
+    if camera.is_walking and not camera.noclip and camera.on_ground:
+        audio.trigger("run" if camera.is_sprinting else "walk", timer="footstep")
 
-    ctx.screen.use()
-    ctx.screen.clear()
+    if timer is not None: timer.mark("update")
 
-    ctx.disable(moderngl.DEPTH_TEST)
-    ctx.front_face = 'cw'
-    skybox.update(camera)
-    skybox.render()
-    ctx.front_face = 'ccw'
-    ctx.enable(moderngl.DEPTH_TEST)
 
-    for floor in floors:
-       floor.update(camera, light_source)
-       floor.render()
+    screen.use()
+    probes.update(camera, draw_scene)
+    if timer is not None: timer.mark("probes")
 
-    obj.update(camera, light_source)
+    screen.clear()
 
-    obj3.update(camera, light_source)
-    obj3.render(skybox)
+    culler.begin(camera)
+    culler.add_occluders(occluders)
 
-    obj4.update(camera)
-    obj4.render()
+    obj.update(camera, light_source)
 
-    obj6.update(camera, light_source)
-    obj6.render()
+    draw_scene(camera, culler, probes)
 
     ctx.disable(moderngl.DEPTH_TEST)
     img.render()
@@ -214,6 +290,26 @@ while running:
     text2.render()
     ctx.enable(moderngl.DEPTH_TEST)
 
-    pygame.display.flip()
+    if timer is not None:
+        timer.mark("render")
+        # Waiting for the GPU here puts its time in the frame it belongs to
+        ctx.finish()
+        timer.mark("gpu")
+
+    if not args.headless: pygame.display.flip()
+
+    if timer is not None:
+        timer.mark("present")
+        timer.end()
+
+if recorder is not None:
+    recorder.close()
+    print(f"Recorded {recorder.frames} frames to {args.record}")
+
+if timer is not None:
+    timer.save(args.timings)
+    print(timer.summary())
 
+world.close()
+if pack is not None: pack.close()
 pygame.quit()